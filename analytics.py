@@ -0,0 +1,240 @@
+# analytics.py
+"""
+12週間プログラムのコホート分析（継続率・実施率・回答分布・離脱）
+
+企業の exercise_history を列ごとのNumPy配列（評価結果はint8、週番号はint16、
+ユーザーはint32の連番）に読み込み、bincountなどのベクトル演算でまとめて集計する。
+行ごとのPythonループを使わないため、100万行でも100ミリ秒程度で計算できる。
+
+    python analytics.py --bot-id company3
+    python analytics.py --benchmark --rows 1000000
+"""
+import time
+import json
+import argparse
+from datetime import date
+import numpy as np
+from sqlalchemy import text
+
+RESULT_LABELS = ("A", "B", "C", "D", "?")  # 評価結果コード 0〜4（4=未設定）
+UNKNOWN_RESULT_CODE = len(RESULT_LABELS) - 1
+MAX_WEEK = 12
+MAX_DAYS = 7
+EPOCH = date(1970, 1, 1)
+
+DEFAULT_INACTIVE_DAYS = 14  # 最後の回答からこの日数が経つと離脱とみなす
+LOAD_CHUNK_SIZE = 100000
+
+class HistoryArrays:
+    """運動履歴を列ごとに保持する（1要素=1回答）"""
+
+    __slots__ = ("user_index", "week", "result", "days", "day", "user_count")
+
+    def __init__(self, user_index, week, result, days, day, user_count):
+        self.user_index = user_index  # int32 ユーザーの連番（0〜user_count-1）
+        self.week = week              # int16 週番号（0=未設定）
+        self.result = result          # int8 評価結果コード
+        self.days = days              # int8 運動日数
+        self.day = day                # int32 回答日（1970-01-01からの日数）
+        self.user_count = user_count
+
+    def __len__(self):
+        return len(self.week)
+
+    @property
+    def nbytes(self):
+        return sum(getattr(self, name).nbytes for name in ("user_index", "week", "result", "days", "day"))
+
+# 評価結果のコード化・欠損値の補完はSQL側で行い、整数だけを受け取る
+HISTORY_ARRAY_QUERY = text(
+    "SELECT user_id, "
+    "COALESCE(week_number, 0), "
+    "COALESCE(array_position(ARRAY['A','B','C','D'], foot_check_result::text), 5) - 1, "
+    "COALESCE(response_days, 0), "
+    "response_date::date - DATE '1970-01-01' "
+    "FROM exercise_history WHERE company_id = :company_id"
+)
+
+def load_history_arrays(session, company_id, chunk_size=LOAD_CHUNK_SIZE):
+    """企業の運動履歴をサーバーサイドカーソルで読み込み、HistoryArraysにする"""
+    connection = session.connection().execution_options(stream_results=True, max_row_buffer=chunk_size)
+    result = connection.execute(HISTORY_ARRAY_QUERY, {"company_id": company_id})
+    chunks = [np.array(rows, dtype=np.int32) for rows in result.partitions(chunk_size)]
+    data = np.concatenate(chunks) if chunks else np.empty((0, 5), dtype=np.int32)
+
+    # user_id（DBの主キー）を0からの連番に詰める
+    user_ids, user_index = np.unique(data[:, 0], return_inverse=True)
+    return HistoryArrays(
+        user_index=user_index.astype(np.int32),
+        week=np.clip(data[:, 1], 0, MAX_WEEK).astype(np.int16),
+        result=data[:, 2].astype(np.int8),
+        days=np.clip(data[:, 3], 0, MAX_DAYS).astype(np.int8),
+        day=data[:, 4].copy(),
+        user_count=len(user_ids),
+    )
+
+def _rate(numerator, denominator):
+    """0除算を0にした割合（配列）"""
+    numerator = np.asarray(numerator, dtype=np.float64)
+    denominator = np.asarray(denominator, dtype=np.float64)
+    return np.divide(numerator, denominator, out=np.zeros_like(numerator), where=denominator > 0)
+
+def compute_analytics(arrays, today=None, inactive_days=DEFAULT_INACTIVE_DAYS):
+    """
+    コホート指標を計算する
+
+    - retention: 第N週に回答したユーザーのうち第N+1週にも回答した割合
+    - adherence: 評価結果グループ×週ごとの回答ユーザー数と平均運動日数（実施率=日数/7）
+    - response_days_distribution: 週ごとの運動日数（0〜7日）の件数
+    - dropoff: 第N週を最後に回答が途絶えたユーザー（最終回答からinactive_days日以上経過）
+    """
+    today = today or date.today()
+    today_day = (today - EPOCH).days
+    weeks = np.arange(1, MAX_WEEK + 1)
+    groups = len(RESULT_LABELS)
+    n_users = arrays.user_count
+    n_weeks = MAX_WEEK + 1  # 0列目は週番号未設定
+
+    # ユーザー×週の回答有無（同じ週に複数回答があっても1とする）
+    responded = np.zeros((n_users, n_weeks), dtype=bool)
+    responded[arrays.user_index, arrays.week] = True
+    responded[:, 0] = False
+
+    # ユーザーごとの最終回答（週番号・日付・その時点の評価結果）
+    last_day = np.zeros(n_users, dtype=np.int32)
+    np.maximum.at(last_day, arrays.user_index, arrays.day)
+    is_last = arrays.day == last_day[arrays.user_index]
+    user_group = np.full(n_users, UNKNOWN_RESULT_CODE, dtype=np.int8)
+    user_group[arrays.user_index[is_last]] = arrays.result[is_last]
+    # 最後に回答した週（回答した週の最大値、なければ0）
+    last_week = np.where(responded.any(axis=1), MAX_WEEK - np.argmax(responded[:, ::-1], axis=1), 0)
+
+    # 継続率（週N → 週N+1）
+    active = responded[:, 1:].sum(axis=0)
+    retained = (responded[:, 1:-1] & responded[:, 2:]).sum(axis=0)
+    retention_rate = _rate(retained, active[:-1])
+
+    # 評価結果グループ×週の回答件数・運動日数合計・回答ユーザー数
+    valid = arrays.week > 0
+    group_week = arrays.result[valid].astype(np.int64) * n_weeks + arrays.week[valid]
+    response_counts = np.bincount(group_week, minlength=groups * n_weeks).reshape(groups, n_weeks)
+    days_sums = np.bincount(group_week, weights=arrays.days[valid], minlength=groups * n_weeks).reshape(groups, n_weeks)
+    user_rows, user_weeks = np.nonzero(responded)
+    group_users = np.bincount(
+        user_group[user_rows].astype(np.int64) * n_weeks + user_weeks, minlength=groups * n_weeks
+    ).reshape(groups, n_weeks)
+    average_days = _rate(days_sums, response_counts)
+
+    # 週×運動日数の分布
+    distribution = np.bincount(
+        arrays.week[valid].astype(np.int64) * (MAX_DAYS + 1) + arrays.days[valid],
+        minlength=n_weeks * (MAX_DAYS + 1)
+    ).reshape(n_weeks, MAX_DAYS + 1)
+
+    # 離脱：最終回答からinactive_days日以上経過し、12週を終えていないユーザー
+    dropped = (today_day - last_day >= inactive_days) & (last_week > 0) & (last_week < MAX_WEEK)
+    reached = np.bincount(last_week, minlength=n_weeks)[::-1].cumsum()[::-1]  # last_week >= N のユーザー数
+    dropped_after = np.bincount(last_week[dropped], minlength=n_weeks)
+    in_progress = (today_day - last_day < inactive_days) & (last_week > 0) & (last_week < MAX_WEEK)
+
+    return {
+        "total_users": int(n_users),
+        "total_responses": int(len(arrays)),
+        "completed_users": int((last_week == MAX_WEEK).sum()),
+        "in_progress_users": int(in_progress.sum()),
+        "dropped_users": int(dropped.sum()),
+        "retention": [
+            {"week": int(w), "users": int(active[w - 1]), "retained": int(retained[w - 1]),
+             "rate": round(float(retention_rate[w - 1]), 4)}
+            for w in weeks[:-1]
+        ],
+        "adherence": {
+            label: [
+                {"week": int(w), "users": int(group_users[g, w]), "responses": int(response_counts[g, w]),
+                 "average_exercise_days": round(float(average_days[g, w]), 3),
+                 "adherence": round(float(average_days[g, w]) / MAX_DAYS, 4)}
+                for w in weeks
+            ]
+            for g, label in enumerate(RESULT_LABELS)
+            if response_counts[g].any()
+        },
+        "response_days_distribution": {
+            str(int(w)): {str(d): int(distribution[w, d]) for d in range(MAX_DAYS + 1) if distribution[w, d]}
+            for w in weeks
+        },
+        "dropoff": [
+            {"week": int(w), "reached": int(reached[w]), "dropped": int(dropped_after[w]),
+             "rate": round(float(_rate(dropped_after[w], reached[w])), 4)}
+            for w in weeks[:-1]
+        ],
+        "inactive_days": inactive_days,
+    }
+
+def company_analytics(session, company, today=None, inactive_days=DEFAULT_INACTIVE_DAYS):
+    """企業のコホート指標（/analytics/<bot_id> 用）"""
+    arrays = load_history_arrays(session, company.id)
+    result = {"company": company.name}
+    result.update(compute_analytics(arrays, today, inactive_days))
+    return result
+
+def synthetic_history(rows, seed=0):
+    """ベンチマーク用の合成データ（1ユーザーあたり平均8回答、週が進むほど離脱）"""
+    rng = np.random.default_rng(seed)
+    user_count = max(rows // 8, 1)
+    user_result = rng.integers(0, 4, user_count).astype(np.int8)
+    user_start = rng.integers(0, 365, user_count).astype(np.int32) + (date(2025, 1, 1) - EPOCH).days
+    user_index = rng.integers(0, user_count, rows).astype(np.int32)
+    week = np.minimum(rng.geometric(0.12, rows), MAX_WEEK).astype(np.int16)
+    days = rng.choice(np.array([0, 2, 5], dtype=np.int8), rows, p=[0.3, 0.45, 0.25])
+    return HistoryArrays(
+        user_index=user_index,
+        week=week,
+        result=user_result[user_index],
+        days=days,
+        day=user_start[user_index] + week.astype(np.int32) * 7,
+        user_count=user_count,
+    )
+
+def run_benchmark(rows, repeat=5):
+    arrays = synthetic_history(rows)
+    print(f"Synthetic history: {len(arrays):,} rows, {arrays.user_count:,} users, {arrays.nbytes / 1e6:.1f} MB")
+    compute_analytics(arrays, today=date(2026, 1, 1))  # ウォームアップ
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        compute_analytics(arrays, today=date(2026, 1, 1))
+        timings.append(time.perf_counter() - started)
+    best = min(timings)
+    print(f"compute_analytics: best {best * 1000:.1f} ms, median {sorted(timings)[len(timings) // 2] * 1000:.1f} ms "
+          f"({len(arrays) / best / 1e6:.1f}M rows/s)")
+
+def main():
+    parser = argparse.ArgumentParser(description="運動履歴のコホート分析")
+    parser.add_argument("--bot-id", help="対象企業のbot_id")
+    parser.add_argument("--inactive-days", type=int, default=DEFAULT_INACTIVE_DAYS)
+    parser.add_argument("--benchmark", action="store_true", help="合成データで計算時間を測る")
+    parser.add_argument("--rows", type=int, default=1000000, help="ベンチマークの行数")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        run_benchmark(args.rows)
+        return
+    if not args.bot_id:
+        parser.error("--bot-id or --benchmark is required")
+
+    from config import DATABASE_URL, DATABASE_READ_URL
+    from db_models import get_read_session, Company
+
+    with get_read_session(DATABASE_URL, DATABASE_READ_URL) as session:
+        company = session.query(Company).filter_by(bot_id=args.bot_id).first()
+        if not company:
+            print(f"Company not found for bot_id: {args.bot_id}")
+            return
+        started = time.perf_counter()
+        result = company_analytics(session, company, inactive_days=args.inactive_days)
+        elapsed = time.perf_counter() - started
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    print(f"{result['total_responses']} responses analyzed in {elapsed * 1000:.0f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+# bulkhead.py
+"""
+Webhook処理の企業（bot_id）ごとのバルクヘッド
+
+1社の友だち追加の集中などで処理スレッドが埋まり、他の企業の返信が遅れて
+reply tokenの有効期限を過ぎるのを防ぐ。
+
+- 同時に処理するWebhookは全体で WEBHOOK_MAX_CONCURRENCY 件、1社あたり WEBHOOK_TENANT_MAX_CONCURRENCY 件まで
+- 空きがなければ企業ごとの待ち行列に並ぶ。空きができたら、待っている企業の中から
+  重み（WEBHOOK_TENANT_WEIGHTS）に比例するように smooth weighted round-robin で次の企業を選ぶ
+- 待ち行列が WEBHOOK_TENANT_QUEUE_MAX 件を超える場合や、WEBHOOK_QUEUE_TIMEOUT_SECONDS 秒待っても
+  順番が来ない場合は BulkheadRejected（/callback は503を返し、LINEの再送に任せる）
+
+    with webhook_bulkhead.slot(bot_id):
+        handle_events(events, bot_id)
+"""
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+from metrics import metrics
+from config import (
+    WEBHOOK_MAX_CONCURRENCY, WEBHOOK_TENANT_MAX_CONCURRENCY, WEBHOOK_TENANT_QUEUE_MAX,
+    WEBHOOK_QUEUE_TIMEOUT_SECONDS, WEBHOOK_TENANT_WEIGHTS
+)
+
+metrics.describe("webhook_queue_depth", "gauge", "Webhook requests waiting for a bulkhead slot")
+metrics.describe("webhook_in_flight", "gauge", "Webhook requests being processed")
+metrics.describe("webhook_queue_wait_seconds_sum", "counter", "Total time webhook requests waited for a slot")
+metrics.describe("webhook_queue_wait_seconds_count", "counter", "Webhook requests that got a slot")
+metrics.describe("webhook_rejected_total", "counter", "Webhook requests rejected by the bulkhead (queue_full, timeout)")
+
+class BulkheadRejected(Exception):
+    """待ち行列が一杯、または待ち時間の上限を超えた"""
+
+    def __init__(self, bot_id, reason):
+        super().__init__(f"webhook bulkhead rejected {bot_id}: {reason}")
+        self.bot_id = bot_id
+        self.reason = reason
+
+class _Waiter:
+    __slots__ = ("event", "granted", "queued_at")
+
+    def __init__(self, queued_at):
+        self.event = threading.Event()
+        self.granted = False
+        self.queued_at = queued_at
+
+class _Tenant:
+    """1社分の待ち行列と実行中の件数"""
+
+    def __init__(self, bot_id, weight, max_concurrency):
+        self.bot_id = bot_id
+        self.weight = weight
+        self.max_concurrency = max_concurrency
+        self.queue = deque()
+        self.in_flight = 0
+        self.current_weight = 0  # smooth weighted round-robin の現在値
+        self.max_wait = 0.0
+        self.rejected = 0
+
+class Bulkhead:
+    """全体と企業ごとの同時実行数を制限し、待っている企業に重みに応じて順番を割り当てる"""
+
+    def __init__(self, max_concurrency, tenant_max_concurrency, queue_max, timeout_seconds,
+                 weights=None, clock=time.monotonic):
+        self.max_concurrency = max_concurrency
+        self.tenant_max_concurrency = tenant_max_concurrency
+        self.queue_max = queue_max
+        self.timeout_seconds = timeout_seconds
+        self.weights = weights or {}
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.tenants = {}
+        self.in_flight = 0
+
+    def _tenant(self, bot_id):
+        tenant = self.tenants.get(bot_id)
+        if tenant is None:
+            tenant = _Tenant(bot_id, self.weights.get(bot_id, 1), self.tenant_max_concurrency)
+            self.tenants[bot_id] = tenant
+        return tenant
+
+    def _update_gauges(self, tenant):
+        metrics.set_gauge("webhook_queue_depth", len(tenant.queue), bot_id=tenant.bot_id)
+        metrics.set_gauge("webhook_in_flight", tenant.in_flight, bot_id=tenant.bot_id)
+
+    def _dispatch(self):
+        """空いている枠を待っている企業に割り当てる（lockを保持して呼ぶ）"""
+        while self.in_flight < self.max_concurrency:
+            eligible = [t for t in self.tenants.values() if t.queue and t.in_flight < t.max_concurrency]
+            if not eligible:
+                return
+            total = 0
+            for tenant in eligible:
+                tenant.current_weight += tenant.weight
+                total += tenant.weight
+            chosen = max(eligible, key=lambda t: t.current_weight)
+            chosen.current_weight -= total
+            waiter = chosen.queue.popleft()
+            waiter.granted = True
+            chosen.in_flight += 1
+            self.in_flight += 1
+            self._update_gauges(chosen)
+            waiter.event.set()
+
+    def acquire(self, bot_id):
+        """枠を確保する（確保できなければBulkheadRejected）"""
+        now = self.clock()
+        with self.lock:
+            tenant = self._tenant(bot_id)
+            if len(tenant.queue) >= self.queue_max:
+                tenant.rejected += 1
+                metrics.inc("webhook_rejected_total", bot_id=bot_id, reason="queue_full")
+                raise BulkheadRejected(bot_id, "queue_full")
+            waiter = _Waiter(now)
+            tenant.queue.append(waiter)
+            self._dispatch()
+            self._update_gauges(tenant)
+
+        if not waiter.event.wait(self.timeout_seconds):
+            with self.lock:
+                if not waiter.granted:
+                    tenant.queue.remove(waiter)
+                    tenant.rejected += 1
+                    self._update_gauges(tenant)
+                    metrics.inc("webhook_rejected_total", bot_id=bot_id, reason="timeout")
+                    raise BulkheadRejected(bot_id, "timeout")
+
+        waited = self.clock() - waiter.queued_at
+        with self.lock:
+            tenant.max_wait = max(tenant.max_wait, waited)
+        metrics.inc("webhook_queue_wait_seconds_sum", waited, bot_id=bot_id)
+        metrics.inc("webhook_queue_wait_seconds_count", bot_id=bot_id)
+        return waited
+
+    def release(self, bot_id):
+        with self.lock:
+            tenant = self.tenants[bot_id]
+            tenant.in_flight -= 1
+            self.in_flight -= 1
+            self._update_gauges(tenant)
+            self._dispatch()
+
+    @contextmanager
+    def slot(self, bot_id):
+        self.acquire(bot_id)
+        try:
+            yield
+        finally:
+            self.release(bot_id)
+
+    def snapshot(self):
+        """/health 用：企業ごとの待ち行列・実行中の件数・待ち時間"""
+        with self.lock:
+            tenants = {}
+            for bot_id, tenant in sorted(self.tenants.items()):
+                waited = metrics.get("webhook_queue_wait_seconds_sum", bot_id=bot_id)
+                count = metrics.get("webhook_queue_wait_seconds_count", bot_id=bot_id)
+                tenants[bot_id] = {
+                    "weight": tenant.weight,
+                    "queued": len(tenant.queue),
+                    "in_flight": tenant.in_flight,
+                    "processed": count,
+                    "avg_wait_ms": round(waited / count * 1000, 1) if count else None,
+                    "max_wait_ms": round(tenant.max_wait * 1000, 1),
+                    "rejected": tenant.rejected,
+                }
+            return {"in_flight": self.in_flight, "max_concurrency": self.max_concurrency, "tenants": tenants}
+
+webhook_bulkhead = Bulkhead(
+    WEBHOOK_MAX_CONCURRENCY, WEBHOOK_TENANT_MAX_CONCURRENCY, WEBHOOK_TENANT_QUEUE_MAX,
+    WEBHOOK_QUEUE_TIMEOUT_SECONDS, WEBHOOK_TENANT_WEIGHTS
+)
@@ -0,0 +1,371 @@
+# campaigns.py
+"""
+企業ごとのお知らせ配信（キャンペーン）
+
+- 対象ユーザーは評価結果・週番号・未回答期間で絞り込み、users.id の昇順に
+  バッチサイズずつキーセットで読み出す（全員分をメモリに載せない）
+- 宛先が2人以上のバッチはmulticast（最大500人）、1人ならpushで送信する
+- 各バッチの宛先と X-Line-Retry-Key は送信前にキャンペーンの行（pending_batch / pending_retry_key）にコミットし、
+  再開後は対象の条件を検索し直さずに同じ宛先・同じキーで送り直すので、
+  送信後に進捗を記録できずに落ちても（その間に対象が変わっても）重複配信されない
+- バックグラウンドスレッドで送信し、進捗（cursor_user_id / sent_count）はバッチごとにコミットする。
+  一時停止・キャンセルはDBの status を変えるだけで、実行中のスレッドは次のバッチの前に止まる
+- rate_per_second で送信通数を制限し、LINEの月間通数の残りが足りなくなったら一時停止する
+  （残りは quota.py で企業ごとに追跡し、リマインダーより優先度の低い送信として扱う）
+"""
+import time
+import uuid
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import select, func, exists, text
+from linebot.v3.messaging import Message, PushMessageRequest, MulticastRequest
+from db_models import (Campaign, Company, User, ExerciseHistory, get_db_session, get_engine,
+                       CAMPAIGN_RUNNING, CAMPAIGN_PAUSED, CAMPAIGN_COMPLETED, CAMPAIGN_CANCELLED)
+from circuit_breaker import get_breaker, is_breaker_failure
+from line_errors import (classify_error, REASON_QUOTA_EXCEEDED, REASON_CONFLICT, REASON_AUTH, REASON_NETWORK,
+                         REASON_TIMEOUT)
+from quota import get_quota_tracker, PRIORITY_LOW, ALLOW as QUOTA_ALLOW
+from metrics import metrics
+from config import (
+    get_line_client, DATABASE_URL, LINE_HTTP_TIMEOUT, CIRCUIT_OPEN_SECONDS,
+    CAMPAIGN_BATCH_SIZE, CAMPAIGN_MAX_CONSECUTIVE_ERRORS
+)
+
+metrics.describe("campaign_messages_total", "counter", "Campaign recipients by result (sent, failed)")
+
+MULTICAST_MAX_RECIPIENTS = 500  # LINEのmulticastの宛先数上限
+CAMPAIGN_NAMESPACE = uuid.UUID("6f1c3d4e-8a2b-4c5d-9e7f-0a1b2c3d4e5f")  # retry_key生成用
+CAMPAIGN_LOCK_CLASS = 7301  # pg_advisory_lock(クラス, キャンペーンID)
+
+# このプロセスで送信中のキャンペーン（campaign_id -> Thread）
+campaign_threads = {}
+campaign_threads_lock = threading.Lock()
+
+def normalize_audience(data):
+    """
+    対象の絞り込み条件を検証して正規化する（不正な場合はValueError）
+
+    - foot_check_result: ["A", "B"] のような評価結果のリスト
+    - current_week_min / current_week_max: 現在の週番号の範囲（両端を含む）
+    - inactive_days: この日数以上、運動回数の回答がないユーザー
+    """
+    data = data or {}
+    audience = {}
+    unknown = set(data) - {"foot_check_result", "current_week_min", "current_week_max", "inactive_days"}
+    if unknown:
+        raise ValueError(f"Unknown audience filter(s): {', '.join(sorted(unknown))}")
+    if data.get("foot_check_result"):
+        results = data["foot_check_result"]
+        if isinstance(results, str):
+            results = [results]
+        if not all(r in ("A", "B", "C", "D") for r in results):
+            raise ValueError("foot_check_result must be a list of A/B/C/D")
+        audience["foot_check_result"] = sorted(set(results))
+    for key in ("current_week_min", "current_week_max", "inactive_days"):
+        if data.get(key) is not None:
+            value = int(data[key])
+            if value < 0:
+                raise ValueError(f"{key} must not be negative")
+            audience[key] = value
+    return audience
+
+def audience_filter(company_id, audience, now=None):
+    """絞り込み条件をSQLの条件式のリストにする（ブロックしたユーザー・pushが届かないユーザーは常に除く）"""
+    conditions = [User.company_id == company_id, User.active == True]
+    if audience.get("foot_check_result"):
+        conditions.append(User.foot_check_result.in_(audience["foot_check_result"]))
+    if audience.get("current_week_min") is not None:
+        conditions.append(User.current_week >= audience["current_week_min"])
+    if audience.get("current_week_max") is not None:
+        conditions.append(User.current_week <= audience["current_week_max"])
+    if audience.get("inactive_days") is not None:
+        cutoff = (now or datetime.utcnow()) - timedelta(days=audience["inactive_days"])
+        conditions.append(User.created_at <= cutoff)
+        conditions.append(~exists().where(
+            ExerciseHistory.user_id == User.id, ExerciseHistory.response_date > cutoff
+        ))
+    return conditions
+
+def count_audience(session, company_id, audience):
+    return session.execute(
+        select(func.count(User.id)).where(*audience_filter(company_id, audience))
+    ).scalar()
+
+def next_recipients(session, campaign, limit=CAMPAIGN_BATCH_SIZE):
+    """cursor_user_id より後の対象ユーザーを (users.id, line_user_id) で最大limit件返す"""
+    return session.execute(
+        select(User.id, User.line_user_id)
+        .where(User.id > campaign.cursor_user_id, *audience_filter(campaign.company_id, campaign.audience))
+        .order_by(User.id)
+        .limit(min(limit, MULTICAST_MAX_RECIPIENTS))
+    ).all()
+
+def batch_retry_key(campaign_id, recipients):
+    """バッチのretry_key（キャンペーンIDと宛先から決まるUUID）"""
+    return str(uuid.uuid5(CAMPAIGN_NAMESPACE, f"{campaign_id}:{recipients[0][0]}-{recipients[-1][0]}:{len(recipients)}"))
+
+def claim_batch(session, campaign):
+    """
+    次に送るバッチの (宛先, retry_key) を返す（対象がなければ ([], None)）
+    前回送信中のまま終わったバッチがあればそれを、なければ対象を検索して新しいバッチにする（保存は save_batch）
+    """
+    if campaign.pending_batch:
+        return [tuple(r) for r in campaign.pending_batch], campaign.pending_retry_key
+    recipients = next_recipients(session, campaign)
+    return recipients, batch_retry_key(campaign.id, recipients) if recipients else None
+
+def save_batch(campaign, recipients, retry_key):
+    """送信するバッチを記録する（送信前にコミットする）"""
+    campaign.pending_batch = [[user_id, line_user_id] for user_id, line_user_id in recipients]
+    campaign.pending_retry_key = retry_key
+
+def clear_batch(campaign):
+    campaign.pending_batch = None
+    campaign.pending_retry_key = None
+
+def send_batch(api, bot_id, retry_key, messages, recipients):
+    """
+    1バッチを送信し、"sent" / "retry" / "failed" / "quota" / "paused" / "deferred" と補足情報を返す
+    宛先が1人ならpush、2人以上ならmulticastを使う
+    """
+    operation = "multicast" if len(recipients) > 1 else "push"
+    breaker = get_breaker(bot_id, operation)
+    if not breaker.allow():
+        return "deferred", CIRCUIT_OPEN_SECONDS
+    try:
+        if operation == "multicast":
+            api.multicast(
+                MulticastRequest(to=[line_user_id for _, line_user_id in recipients], messages=messages),
+                x_line_retry_key=retry_key, _request_timeout=LINE_HTTP_TIMEOUT
+            )
+        else:
+            api.push_message(
+                PushMessageRequest(to=recipients[0][1], messages=messages),
+                x_line_retry_key=retry_key, _request_timeout=LINE_HTTP_TIMEOUT
+            )
+        breaker.record_success()
+        return "sent", None
+    except Exception as e:
+        # 判定は outbox.push と同じ line_errors.classify_error に従う
+        error_class = classify_error(e)
+        error = f"{type(e).__name__}: {(str(e).strip().splitlines() or [''])[0]}"
+        if error_class.reason == REASON_CONFLICT:
+            # 同じretry_keyのバッチは受付済み
+            breaker.record_success()
+            return "sent", None
+        if error_class.reason == REASON_QUOTA_EXCEEDED:
+            # 月間通数の上限（待っても回復しないので一時停止する）
+            breaker.record_success()
+            return "quota", "message quota exhausted (monthly limit)"
+        if error_class.reason in (REASON_NETWORK, REASON_TIMEOUT) or is_breaker_failure(e):
+            breaker.record_failure(e)
+        else:
+            breaker.record_success()
+        if error_class.reason == REASON_AUTH:
+            # アクセストークンの失効など企業全体のエラーは、残りのバッチも失敗するので一時停止する
+            return "paused", error
+        if not error_class.retryable:
+            return "failed", error
+        return "retry", (error_class.retry_after, error)
+
+def run_campaign(campaign_id, sleep=time.sleep):
+    """
+    キャンペーンを送信する（status が running でなくなるか、対象がなくなるまで）
+
+    同じキャンペーンを複数のワーカーで同時に送らないよう、advisory lockを取れた場合だけ実行する。
+    """
+    engine = get_engine(DATABASE_URL)
+    lock_conn = engine.connect()
+    try:
+        locked = lock_conn.execute(
+            text("SELECT pg_try_advisory_lock(:cls, :id)"), {"cls": CAMPAIGN_LOCK_CLASS, "id": campaign_id}
+        ).scalar()
+        lock_conn.commit()
+        if not locked:
+            print(f"Campaign {campaign_id} is already running in another worker")
+            return
+        _run_campaign_locked(campaign_id, sleep)
+    finally:
+        lock_conn.close()  # 接続を閉じるとadvisory lockも解放される
+        engine.dispose()
+
+def _run_campaign_locked(campaign_id, sleep):
+    with get_db_session(DATABASE_URL) as session:
+        campaign = session.get(Campaign, campaign_id)
+        bot_id = session.get(Company, campaign.company_id).bot_id
+        api = get_line_client(bot_id)
+        messages = [Message.from_dict(m) for m in campaign.payload]
+        quota = get_quota_tracker(bot_id)
+        quota.refresh(force=True)  # 送信量が多いので、開始時は最新の使用数で判定する
+        consecutive_errors = 0
+        window_started = time.monotonic()
+        window_sent = 0
+        print(f"Campaign {campaign_id} ({campaign.name}) started for {bot_id}")
+
+        while True:
+            session.refresh(campaign)  # 一時停止・キャンセルを反映
+            if campaign.status != CAMPAIGN_RUNNING:
+                print(f"Campaign {campaign_id} stopped: {campaign.status}")
+                return
+
+            recipients, retry_key = claim_batch(session, campaign)
+            if not recipients:
+                campaign.status = CAMPAIGN_COMPLETED
+                campaign.finished_at = datetime.utcnow()
+                session.commit()
+                print(f"Campaign {campaign_id} completed: sent {campaign.sent_count}, failed {campaign.failed_count}")
+                return
+
+            # 月間通数の残りを確認（リマインダー用の CAMPAIGN_QUOTA_RESERVE を残せなければ一時停止）
+            decision, _ = quota.admit(PRIORITY_LOW, len(recipients))
+            if decision != QUOTA_ALLOW:
+                campaign.status = CAMPAIGN_PAUSED
+                campaign.last_error = f"message quota exhausted (remaining {quota.remaining()})"
+                session.commit()
+                print(f"Campaign {campaign_id} paused: {campaign.last_error}")
+                return
+
+            # 宛先とキーを送信前にコミットする（送信後に落ちても再開後に同じバッチを送り直せる）
+            save_batch(campaign, recipients, retry_key)
+            session.commit()
+
+            result, info = send_batch(api, bot_id, retry_key, messages, recipients)
+            if result != "sent":
+                quota.release(len(recipients))
+            campaign.request_count += 1
+            if result in ("sent", "failed"):
+                clear_batch(campaign)
+            if result == "sent":
+                campaign.cursor_user_id = recipients[-1][0]
+                campaign.sent_count += len(recipients)
+                campaign.last_error = None
+                consecutive_errors = 0
+                metrics.inc("campaign_messages_total", len(recipients), bot_id=bot_id, result="sent")
+            elif result == "failed":
+                # 再送しても成功しないエラー（不正なメッセージなど）はバッチを飛ばして続ける
+                campaign.cursor_user_id = recipients[-1][0]
+                campaign.failed_count += len(recipients)
+                campaign.last_error = info[:255]
+                metrics.inc("campaign_messages_total", len(recipients), bot_id=bot_id, result="failed")
+            elif result == "quota":
+                quota.mark_exhausted()
+                campaign.status = CAMPAIGN_PAUSED
+                campaign.last_error = info
+                session.commit()
+                print(f"Campaign {campaign_id} paused: {info}")
+                return
+            elif result == "paused":
+                # 送り直せば届くかもしれないのでバッチは残し、原因を直してから再開する
+                campaign.status = CAMPAIGN_PAUSED
+                campaign.last_error = info[:255]
+                session.commit()
+                print(f"Campaign {campaign_id} paused: {info}")
+                return
+            elif result == "retry":
+                retry_after, error = info
+                consecutive_errors += 1
+                campaign.last_error = error[:255]
+                if consecutive_errors >= CAMPAIGN_MAX_CONSECUTIVE_ERRORS:
+                    campaign.status = CAMPAIGN_PAUSED
+                    session.commit()
+                    print(f"Campaign {campaign_id} paused after {consecutive_errors} consecutive errors: {error}")
+                    return
+            session.commit()
+
+            if result == "retry":
+                sleep(retry_after or min(2 ** consecutive_errors, 60))
+            elif result == "deferred":
+                sleep(info)
+            elif result == "sent" and campaign.rate_per_second:
+                # 1秒あたりの送信通数が rate_per_second を超えないように待つ
+                window_sent += len(recipients)
+                wait = window_sent / campaign.rate_per_second - (time.monotonic() - window_started)
+                if wait > 0:
+                    sleep(wait)
+
+def start_campaign_runner(campaign_id):
+    """キャンペーンをバックグラウンドスレッドで送信する（このプロセスで実行中なら何もしない）"""
+    with campaign_threads_lock:
+        thread = campaign_threads.get(campaign_id)
+        if thread and thread.is_alive():
+            return False
+        thread = threading.Thread(
+            target=_run_campaign_thread, args=(campaign_id,), name=f"campaign-{campaign_id}", daemon=True
+        )
+        campaign_threads[campaign_id] = thread
+        thread.start()
+        return True
+
+def _run_campaign_thread(campaign_id):
+    try:
+        run_campaign(campaign_id)
+    except Exception as e:
+        print(f"Campaign {campaign_id} runner failed: {e}")
+    finally:
+        with campaign_threads_lock:
+            campaign_threads.pop(campaign_id, None)
+
+def resume_running_campaigns():
+    """status が running のキャンペーンの送信を再開する（再起動後やワーカーが落ちた場合）"""
+    with get_db_session(DATABASE_URL) as session:
+        ids = session.execute(select(Campaign.id).where(Campaign.status == CAMPAIGN_RUNNING)).scalars().all()
+    for campaign_id in ids:
+        start_campaign_runner(campaign_id)
+    return ids
+
+def create_campaign(session, company, name, messages, audience=None, rate_per_second=None):
+    """キャンペーンを作成してコミットする（送信は start_campaign_runner で開始）"""
+    audience = normalize_audience(audience)
+    campaign = Campaign(
+        company_id=company.id,
+        name=name,
+        payload=[message.to_dict() for message in messages],
+        audience=audience,
+        status=CAMPAIGN_RUNNING,
+        rate_per_second=rate_per_second,
+        audience_size=count_audience(session, company.id, audience),
+        cursor_user_id=0,
+        sent_count=0,
+        failed_count=0,
+        request_count=0,
+        started_at=datetime.utcnow(),
+    )
+    session.add(campaign)
+    session.commit()
+    return campaign
+
+def set_campaign_status(session, campaign, status):
+    """一時停止・再開・キャンセル（再開の場合は呼び出し側でランナーを起動する）"""
+    allowed = {
+        CAMPAIGN_PAUSED: (CAMPAIGN_RUNNING,),
+        CAMPAIGN_RUNNING: (CAMPAIGN_PAUSED,),
+        CAMPAIGN_CANCELLED: (CAMPAIGN_RUNNING, CAMPAIGN_PAUSED),
+    }
+    if campaign.status not in allowed[status]:
+        raise ValueError(f"Cannot change campaign status from {campaign.status} to {status}")
+    campaign.status = status
+    if status == CAMPAIGN_RUNNING:
+        campaign.last_error = None
+    if status == CAMPAIGN_CANCELLED:
+        campaign.finished_at = datetime.utcnow()
+    session.commit()
+
+def campaign_progress(campaign):
+    """管理API用の進捗"""
+    processed = campaign.sent_count + campaign.failed_count
+    return {
+        "id": campaign.id,
+        "name": campaign.name,
+        "status": campaign.status,
+        "audience": campaign.audience,
+        "audience_size": campaign.audience_size,
+        "sent": campaign.sent_count,
+        "failed": campaign.failed_count,
+        "requests": campaign.request_count,
+        "progress": round(processed / campaign.audience_size, 4) if campaign.audience_size else None,
+        "rate_per_second": campaign.rate_per_second,
+        "last_error": campaign.last_error,
+        "running_here": campaign.id in campaign_threads,
+        "created_at": campaign.created_at.isoformat() if campaign.created_at else None,
+        "finished_at": campaign.finished_at.isoformat() if campaign.finished_at else None,
+    }
@@ -0,0 +1,167 @@
+# circuit_breaker.py
+"""
+bot_id×API操作ごとのサーキットブレーカー
+
+LINE側の障害やアクセストークンの失効時に、失敗が分かっている呼び出しを即座に打ち切り、
+ワーカーがリトライ待ちで詰まって他の企業の処理まで遅れるのを防ぐ。
+
+- closed: 通常状態。直近 CIRCUIT_WINDOW_SECONDS 秒の失敗率が閾値を超えると open
+- open: 呼び出しを即座に失敗させる。CIRCUIT_OPEN_SECONDS 秒後に half_open
+- half_open: 少数の試行（プローブ）だけ通し、成功すれば closed、失敗すれば再び open
+"""
+import time
+import threading
+from collections import deque
+from config import (
+    CIRCUIT_FAILURE_RATE, CIRCUIT_MIN_CALLS, CIRCUIT_WINDOW_SECONDS,
+    CIRCUIT_OPEN_SECONDS, CIRCUIT_HALF_OPEN_PROBES
+)
+from metrics import metrics
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}  # メトリクス用の数値
+
+metrics.describe("line_circuit_state", "gauge", "Circuit breaker state (0=closed, 1=half_open, 2=open)")
+metrics.describe("line_circuit_transitions_total", "counter", "Circuit breaker state transitions")
+metrics.describe("line_api_calls_total", "counter", "LINE API calls by outcome (success, failure, rejected)")
+
+class CircuitBreaker:
+    """1つのbot_id×操作に対するブレーカー"""
+
+    def __init__(self, bot_id, operation, failure_rate=CIRCUIT_FAILURE_RATE, min_calls=CIRCUIT_MIN_CALLS,
+                 window_seconds=CIRCUIT_WINDOW_SECONDS, open_seconds=CIRCUIT_OPEN_SECONDS,
+                 half_open_probes=CIRCUIT_HALF_OPEN_PROBES, clock=time.monotonic):
+        self.bot_id = bot_id
+        self.operation = operation
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.half_open_probes = half_open_probes
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.calls = deque()  # (時刻, 成功したか)
+        self.failures = 0
+        self.opened_at = None
+        self.probes_in_flight = 0
+        self.last_error = None
+        metrics.set_gauge("line_circuit_state", 0, bot_id=bot_id, operation=operation)
+
+    def _transition(self, state):
+        print(f"Circuit breaker {self.bot_id}/{self.operation}: {self.state} -> {state}")
+        self.state = state
+        if state == OPEN:
+            self.opened_at = self.clock()
+        if state != HALF_OPEN:
+            self.probes_in_flight = 0
+        if state == CLOSED:
+            self.calls.clear()
+            self.failures = 0
+        labels = {"bot_id": self.bot_id, "operation": self.operation}
+        metrics.set_gauge("line_circuit_state", STATE_VALUES[state], **labels)
+        metrics.inc("line_circuit_transitions_total", state=state, **labels)
+
+    def _prune(self, now):
+        while self.calls and now - self.calls[0][0] > self.window_seconds:
+            _, ok = self.calls.popleft()
+            if not ok:
+                self.failures -= 1
+
+    def allow(self):
+        """呼び出してよいか（half_openではプローブの枠を1つ確保する）"""
+        with self.lock:
+            if self.state == OPEN and self.clock() - self.opened_at >= self.open_seconds:
+                self._transition(HALF_OPEN)
+            if self.state == CLOSED:
+                allowed = True
+            elif self.state == HALF_OPEN:
+                allowed = self.probes_in_flight < self.half_open_probes
+                if allowed:
+                    self.probes_in_flight += 1
+            else:
+                allowed = False
+        if not allowed:
+            metrics.inc("line_api_calls_total", bot_id=self.bot_id, operation=self.operation, outcome="rejected")
+        return allowed
+
+    def record_success(self):
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self._transition(CLOSED)
+            elif self.state == CLOSED:
+                now = self.clock()
+                self._prune(now)
+                self.calls.append((now, True))
+        metrics.inc("line_api_calls_total", bot_id=self.bot_id, operation=self.operation, outcome="success")
+
+    def record_failure(self, error=None):
+        with self.lock:
+            self.last_error = _describe_error(error) if error is not None else None
+            if self.state == HALF_OPEN:
+                self._transition(OPEN)
+            elif self.state == CLOSED:
+                now = self.clock()
+                self._prune(now)
+                self.calls.append((now, False))
+                self.failures += 1
+                total = len(self.calls)
+                if total >= self.min_calls and self.failures / total >= self.failure_rate:
+                    self._transition(OPEN)
+        metrics.inc("line_api_calls_total", bot_id=self.bot_id, operation=self.operation, outcome="failure")
+
+    def snapshot(self):
+        with self.lock:
+            self._prune(self.clock())
+            result = {
+                "state": self.state,
+                "calls_in_window": len(self.calls),
+                "failures_in_window": self.failures,
+                "last_error": self.last_error,
+            }
+            if self.state == OPEN:
+                result["retry_in_seconds"] = max(round(self.open_seconds - (self.clock() - self.opened_at), 1), 0)
+            return result
+
+# (bot_id, 操作) -> CircuitBreaker
+breakers = {}
+breakers_lock = threading.Lock()
+
+def get_breaker(bot_id, operation):
+    """bot_id×操作のブレーカーを取得（なければ作成）"""
+    key = (bot_id, operation)
+    breaker = breakers.get(key)
+    if breaker is None:
+        with breakers_lock:
+            breaker = breakers.get(key)
+            if breaker is None:
+                breaker = CircuitBreaker(bot_id, operation)
+                breakers[key] = breaker
+    return breaker
+
+def is_breaker_failure(error):
+    """
+    APIエラー（HTTPステータスあり）をブレーカーの失敗として数えるか
+
+    5xx・429（LINE側の障害や混雑）と401/403（トークン失効）は失敗、
+    それ以外の4xx（無効なreply_tokenなど個別のリクエストの問題）はAPI自体は正常とみなす。
+    ネットワークエラーは呼び出し側で常に失敗として記録する。
+    """
+    status = getattr(error, "status", None)
+    if not isinstance(status, int):
+        return False
+    return status >= 500 or status in (401, 403, 429)
+
+def _describe_error(error):
+    """エラーの1行目だけを残す（ApiExceptionはヘッダーや本文まで含むため）"""
+    lines = str(error).strip().splitlines()
+    return f"{type(error).__name__}: {lines[0] if lines else ''}"[:200]
+
+def breaker_snapshot():
+    """/health 用：bot_idごと・操作ごとの状態"""
+    result = {}
+    for (bot_id, operation), breaker in sorted(breakers.items()):
+        result.setdefault(bot_id, {})[operation] = breaker.snapshot()
+    return result
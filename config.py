@@ -1,6 +1,9 @@
 # config.py
 import os
 import json
+import socket
+import threading
+from urllib3.connection import HTTPConnection
 from linebot.v3.messaging import Configuration, ApiClient, MessagingApi
 from linebot.v3 import WebhookHandler
 # 個別の環境変数からBOT_CONFIGSを構築
@@ -48,6 +51,116 @@ if os.getenv("BOT_CONFIGS"):
 # データベースURL
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+# 読み取り専用レプリカのURL（管理・履歴・分析APIとリマインダー対象の検索に使う。未設定ならプライマリ）
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL")
+READ_REPLICA_MAX_LAG_SECONDS = float(os.getenv("READ_REPLICA_MAX_LAG_SECONDS", "30"))  # これ以上遅れていたらプライマリを使う
+READ_REPLICA_LAG_CHECK_SECONDS = float(os.getenv("READ_REPLICA_LAG_CHECK_SECONDS", "5"))  # 遅延を確認し直す間隔
+
+# message_logsの保持期間（月数）とアーカイブ先
+MESSAGE_LOG_RETENTION_MONTHS = int(os.getenv("MESSAGE_LOG_RETENTION_MONTHS", "6"))
+MESSAGE_LOG_ARCHIVE_DIR = os.getenv("MESSAGE_LOG_ARCHIVE_DIR", "archive/message_logs")
+
+# 管理用・履歴APIのレスポンスキャッシュ（件数とバイト数の上限）
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "256"))
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# Webhook処理用のユーザー状態キャッシュ（ワーカーごとの件数上限と有効期限）
+USER_STATE_CACHE_MAX_ENTRIES = int(os.getenv("USER_STATE_CACHE_MAX_ENTRIES", "10000"))
+USER_STATE_CACHE_TTL_SECONDS = float(os.getenv("USER_STATE_CACHE_TTL_SECONDS", "300"))
+
+# LINE Messaging APIの接続先（負荷試験時は fake_line_api.py のURLを指定）
+LINE_API_BASE_URL = os.getenv("LINE_API_BASE_URL")
+
+# LINE APIのHTTP接続設定（クライアントはbot_idごとにプロセス内で1つだけ作って使い回す）
+LINE_HTTP_POOL_MAXSIZE = int(os.getenv("LINE_HTTP_POOL_MAXSIZE", "10"))  # bot_idごとの同時接続数（保持する接続数）
+LINE_HTTP_CONNECT_TIMEOUT = float(os.getenv("LINE_HTTP_CONNECT_TIMEOUT", "3"))
+LINE_HTTP_READ_TIMEOUT = float(os.getenv("LINE_HTTP_READ_TIMEOUT", "10"))
+LINE_HTTP_KEEPALIVE_IDLE = int(os.getenv("LINE_HTTP_KEEPALIVE_IDLE", "30"))  # TCPキープアライブを送り始めるまでの秒数
+# API呼び出しごとに _request_timeout として渡す (接続, 読み取り)
+LINE_HTTP_TIMEOUT = (LINE_HTTP_CONNECT_TIMEOUT, LINE_HTTP_READ_TIMEOUT)
+
+# reply tokenの期限（イベントのタイムスタンプからの秒数）と、期限切れの場合のpushへの切り替え
+REPLY_TOKEN_TTL_SECONDS = float(os.getenv("REPLY_TOKEN_TTL_SECONDS", "60"))
+REPLY_DEADLINE_MARGIN_SECONDS = float(os.getenv("REPLY_DEADLINE_MARGIN_SECONDS", "5"))  # 送信にかかる時間の余裕
+REPLY_FALLBACK_PUSH = os.getenv("REPLY_FALLBACK_PUSH", "true").lower() == "true"  # falseなら期限切れの返信は送らない
+
+# Webhook処理のバルクヘッド（bulkhead.py、ワーカープロセスごと）
+WEBHOOK_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_MAX_CONCURRENCY", "8"))  # 全企業で同時に処理するWebhook数
+WEBHOOK_TENANT_MAX_CONCURRENCY = int(os.getenv("WEBHOOK_TENANT_MAX_CONCURRENCY", "4"))  # 1社で同時に処理するWebhook数
+WEBHOOK_TENANT_QUEUE_MAX = int(os.getenv("WEBHOOK_TENANT_QUEUE_MAX", "50"))  # 1社の待ち行列の上限（超えたら503）
+WEBHOOK_QUEUE_TIMEOUT_SECONDS = float(os.getenv("WEBHOOK_QUEUE_TIMEOUT_SECONDS", "10"))  # 待ち時間の上限（超えたら503）
+
+def parse_tenant_weights(value):
+    """"company1=2,company3=1" 形式の重み（未指定の企業は1）"""
+    weights = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            bot_id, weight = item.split("=", 1)
+            try:
+                weights[bot_id.strip()] = max(int(weight), 1)
+            except ValueError:
+                print(f"WEBHOOK_TENANT_WEIGHTS の値が不正です: {item}")
+    return weights
+
+WEBHOOK_TENANT_WEIGHTS = parse_tenant_weights(os.getenv("WEBHOOK_TENANT_WEIGHTS"))
+
+# Webhookの記録（webhook_capture.py、性能問題の再現用。WEBHOOK_CAPTURE_BOTS が空なら記録しない）
+WEBHOOK_CAPTURE_BOTS = os.getenv("WEBHOOK_CAPTURE_BOTS", "")  # 記録する企業のbot_id（カンマ区切り、"*" なら全企業）
+WEBHOOK_CAPTURE_DIR = os.getenv("WEBHOOK_CAPTURE_DIR", "capture/webhooks")  # 企業ごとのサブディレクトリに保存
+WEBHOOK_CAPTURE_PSEUDONYMIZE = os.getenv("WEBHOOK_CAPTURE_PSEUDONYMIZE", "true").lower() == "true"  # ユーザーIDを仮名にする
+WEBHOOK_CAPTURE_SALT = os.getenv("WEBHOOK_CAPTURE_SALT", "")  # 仮名化の鍵（未設定なら起動ごとにランダム）
+WEBHOOK_CAPTURE_ROTATE_MB = float(os.getenv("WEBHOOK_CAPTURE_ROTATE_MB", "32"))  # 1ファイルの大きさの上限（圧縮前）
+WEBHOOK_CAPTURE_MAX_FILES = int(os.getenv("WEBHOOK_CAPTURE_MAX_FILES", "48"))  # 企業ごとに残すファイル数（古いものから削除）
+
+# プロファイラー（profiler.py、/admin/profile）
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN")  # /admin/profile・/admin/campaigns・/admin/scheduler・/admin/forecast・/admin/export の認証トークン（未設定ならこれらは使えない）
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))  # プロファイルするリクエスト・ジョブの割合（0なら X-Profile-Token 付きのみ）
+PROFILE_ENDPOINTS = os.getenv("PROFILE_ENDPOINTS", "")  # 対象のエンドポイント "callback,job:individual_reminder"（空なら全て）
+PROFILE_BOTS = os.getenv("PROFILE_BOTS", "")  # 対象の企業のbot_id（空なら全て）
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "10"))  # スタックを取る間隔
+PROFILE_MAX_STACKS = int(os.getenv("PROFILE_MAX_STACKS", "10000"))  # 集計するスタックの種類の上限（超えた分は [other]）
+PROFILE_TRACEMALLOC = os.getenv("PROFILE_TRACEMALLOC", "false").lower() == "true"  # 起動時からメモリの割り当てを記録
+PROFILE_TRACEMALLOC_FRAMES = int(os.getenv("PROFILE_TRACEMALLOC_FRAMES", "10"))  # 割り当てごとに記録するフレーム数
+PROFILE_MEMORY_SNAPSHOTS = int(os.getenv("PROFILE_MEMORY_SNAPSHOTS", "5"))  # 残すメモリのスナップショット数
+
+# LINE APIのサーキットブレーカー（bot_id×操作ごと、circuit_breaker.py）
+CIRCUIT_FAILURE_RATE = float(os.getenv("CIRCUIT_FAILURE_RATE", "0.5"))  # この失敗率以上でopen
+CIRCUIT_MIN_CALLS = int(os.getenv("CIRCUIT_MIN_CALLS", "10"))  # 判定に必要な最小呼び出し数
+CIRCUIT_WINDOW_SECONDS = float(os.getenv("CIRCUIT_WINDOW_SECONDS", "60"))  # 失敗率を数える期間
+CIRCUIT_OPEN_SECONDS = float(os.getenv("CIRCUIT_OPEN_SECONDS", "30"))  # openからhalf_openまでの秒数
+CIRCUIT_HALF_OPEN_PROBES = int(os.getenv("CIRCUIT_HALF_OPEN_PROBES", "1"))  # half_openで通す試行数
+
+# pushメッセージのアウトボックス（outbox.py）
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "100"))  # 1回に確保する行数
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "8"))  # 並列送信数（LINE_HTTP_POOL_MAXSIZE以下にする）
+OUTBOX_POLL_SECONDS = int(os.getenv("OUTBOX_POLL_SECONDS", "15"))  # ディスパッチャーの実行間隔
+OUTBOX_LEASE_SECONDS = int(os.getenv("OUTBOX_LEASE_SECONDS", "120"))  # 確保した行を他のワーカーに渡さない秒数
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "30"))
+OUTBOX_RETRY_MAX_SECONDS = float(os.getenv("OUTBOX_RETRY_MAX_SECONDS", "3600"))
+OUTBOX_RETENTION_DAYS = int(os.getenv("OUTBOX_RETENTION_DAYS", "30"))  # 送信済み・失敗の行を残す日数
+
+# リマインダーの検索間隔と送信時間帯（send_window.py）
+REMINDER_INTERVAL_HOURS = int(os.getenv("REMINDER_INTERVAL_HOURS", "6"))  # 対象者の検索間隔（次回までの送信時間帯に送信を分散）
+REMINDER_TIMEZONE = os.getenv("REMINDER_TIMEZONE", "Asia/Tokyo")  # 送信時間帯の時刻のタイムゾーン
+REMINDER_SEND_WINDOW = os.getenv("REMINDER_SEND_WINDOW", "09:00-21:00")  # 送信してよい時間帯（それ以外は送らない）
+REMINDER_SEND_WINDOWS = os.getenv("REMINDER_SEND_WINDOWS")  # 企業ごとの時間帯 "company1=10:00-19:00,company3=08:00-20:00@Asia/Bangkok"
+REMINDER_MAX_PUSH_PER_SECOND = float(os.getenv("REMINDER_MAX_PUSH_PER_SECOND", "5"))  # 1社あたりの送信速度の上限（0なら無制限）
+
+# スケジューラーの実行履歴（scheduler_runs）の保持日数
+SCHEDULER_RUN_RETENTION_DAYS = int(os.getenv("SCHEDULER_RUN_RETENTION_DAYS", "30"))
+
+# LINEの月間通数の追跡と残りに応じた送信の優先度（quota.py）
+QUOTA_REFRESH_SECONDS = int(os.getenv("QUOTA_REFRESH_SECONDS", "300"))  # 上限と使用数を問い合わせる間隔
+QUOTA_THROTTLE_BELOW = float(os.getenv("QUOTA_THROTTLE_BELOW", "0.2"))  # 残りが上限のこの割合を下回ったらリマインダーを月末まで日ごとに配分
+QUOTA_REMINDER_RESERVE = int(os.getenv("QUOTA_REMINDER_RESERVE", "100"))  # 返信の代わりのpush用に残す通数（これを下回るとリマインダーは来月に延期）
+
+# お知らせ配信（campaigns.py）
+CAMPAIGN_BATCH_SIZE = int(os.getenv("CAMPAIGN_BATCH_SIZE", "500"))  # 1回のmulticastの宛先数（最大500）
+CAMPAIGN_QUOTA_RESERVE = int(os.getenv("CAMPAIGN_QUOTA_RESERVE", "1000"))  # リマインダー用に残しておく月間通数
+CAMPAIGN_MAX_CONSECUTIVE_ERRORS = int(os.getenv("CAMPAIGN_MAX_CONSECUTIVE_ERRORS", "5"))  # 連続してこの回数失敗したら一時停止
+CAMPAIGN_RESUME_SECONDS = int(os.getenv("CAMPAIGN_RESUME_SECONDS", "60"))  # 実行中のキャンペーンを引き継ぐ間隔
+
 # 運動メニュー動画URL（YouTube）- 12週分×2セット
 # 環境変数から読み込み、なければダミーURLを使用
 # A/B評価用（同じ動画）
@@ -149,16 +262,66 @@ EXERCISE_IMAGE_URLS_CD = [
 ]
 
 # LINE APIクライアントとハンドラーを取得する関数
-def get_line_client(bot_id):
-    """指定されたBOT IDのLINE MessagingAPIクライアントを取得"""
-    if bot_id not in BOT_CONFIGS:
-        return None
-        
+# bot_idごとのLINE APIクライアント（プロセス内で共有し、接続プールとTLSセッションを使い回す）
+line_clients = {}
+line_clients_lock = threading.Lock()
+
+def _line_socket_options():
+    """TCPキープアライブを有効にしたソケットオプション"""
+    options = HTTPConnection.default_socket_options + [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        options += [
+            (socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, LINE_HTTP_KEEPALIVE_IDLE),
+            (socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(LINE_HTTP_KEEPALIVE_IDLE // 3, 1)),
+            (socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3),
+        ]
+    return options
+
+def _create_line_client(bot_id):
     config = BOT_CONFIGS[bot_id]
-    configuration = Configuration(access_token=config["access_token"])
+    if LINE_API_BASE_URL:
+        configuration = Configuration(access_token=config["access_token"], host=LINE_API_BASE_URL)
+    else:
+        configuration = Configuration(access_token=config["access_token"])
+    configuration.connection_pool_maxsize = LINE_HTTP_POOL_MAXSIZE
+    configuration.socket_options = _line_socket_options()
     api_client = ApiClient(configuration)
     return MessagingApi(api_client)
 
+def get_line_client(bot_id):
+    """指定されたBOT IDのLINE MessagingAPIクライアントを取得（プロセス内で共有）"""
+    if bot_id not in BOT_CONFIGS:
+        return None
+
+    client = line_clients.get(bot_id)
+    if client is None:
+        with line_clients_lock:
+            client = line_clients.get(bot_id)
+            if client is None:
+                client = _create_line_client(bot_id)
+                line_clients[bot_id] = client
+    return client
+
+def line_client_stats():
+    """/health 用：bot_idごとの接続数とリクエスト数（接続数が増え続けなければ接続は再利用されている）"""
+    stats = {}
+    for bot_id, client in list(line_clients.items()):
+        pool_manager = client.api_client.rest_client.pool_manager
+        pools = [pool_manager.pools[key] for key in pool_manager.pools.keys()]
+        stats[bot_id] = {
+            "connections_opened": sum(pool.num_connections for pool in pools),
+            "requests": sum(pool.num_requests for pool in pools),
+        }
+    return stats
+
+def _reset_line_clients():
+    """fork後の子プロセスでは親の接続を使わず、クライアントを作り直す"""
+    global line_clients_lock
+    line_clients.clear()
+    line_clients_lock = threading.Lock()
+
+os.register_at_fork(after_in_child=_reset_line_clients)
+
 def get_webhook_handler(bot_id):
     """指定されたBOT IDのWebhookハンドラーを取得"""
     if bot_id not in BOT_CONFIGS:
@@ -1,8 +1,16 @@
-from sqlalchemy import Column, Integer, String, DateTime, Text, ForeignKey, create_engine, Boolean, UniqueConstraint
+import enum
+import time
+import threading
+from sqlalchemy import (Column, Integer, BigInteger, SmallInteger, String, DateTime, Date, ForeignKey, create_engine,
+                        Boolean, UniqueConstraint, PrimaryKeyConstraint, Enum, Index, literal_column, text)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from sqlalchemy.dialects.postgresql import insert as pg_insert, JSONB
 from datetime import datetime
 from sqlalchemy import inspect
 from contextlib import contextmanager
+from metrics import metrics
 
 Base = declarative_base()
 
@@ -13,6 +21,8 @@ class Company(Base):
     bot_id = Column(String, unique=True, nullable=False)  # LINE Bot識別子
     name = Column(String, nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # ユーザー・運動履歴が変わるたびに加算（レスポンスキャッシュのETagに使用）
+    data_version = Column(BigInteger, nullable=False, default=0, server_default='0')
     
     users = relationship("User", back_populates="company")
 
@@ -31,24 +41,87 @@ class User(Base):
     question_sent = Column(Boolean, default=False)  # 質問送信状態を管理
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # 行を更新するたびに加算（ORMの楽観的ロック。user_state_cache.py の古い状態での更新を検知する）
+    state_version = Column(Integer, nullable=False, server_default='1')
+    # ブロック（友だち解除）やpushが届かないユーザーはFalse（リマインダー・お知らせ配信の対象外。再度の友だち追加でTrue）
+    active = Column(Boolean, nullable=False, default=True, server_default='true')
+    unfollowed_at = Column(DateTime)
 
     messages = relationship("MessageLog", back_populates="user")
     company = relationship("Company", back_populates="users")
     
     # line_user_idとcompany_idの組み合わせでユニーク制約
-    __table_args__ = (UniqueConstraint('line_user_id', 'company_id', name='_line_user_company_uc'),)
+    __table_args__ = (
+        UniqueConstraint('line_user_id', 'company_id', name='_line_user_company_uc'),
+        # 配信対象の検索（企業の有効なユーザーをID順に）
+        Index('ix_users_company_active', 'company_id', 'active', 'id'),
+    )
+    __mapper_args__ = {"version_id_col": state_version}
+
+class LogEvent(enum.IntEnum):
+    """メッセージログのイベントコード（message_logs.event_code）"""
+    OTHER = 0
+    # ユーザー登録
+    USER_REGISTERED = 1
+    USER_RETURNED = 2
+    USER_UNFOLLOWED = 3  # ブロック（友だち解除）
+    USER_UNREACHABLE = 4  # 友だちでないためpushが届かなかった
+    # 受信
+    FOOT_CHECK_RECEIVED = 10
+    EXERCISE_DAYS_RECEIVED = 11
+    FREE_TEXT_RECEIVED = 12
+    # 状態更新
+    FOOT_CHECK_UPDATED = 20
+    EXERCISE_DAYS_UPDATED = 21
+    # 送信
+    WELCOME_SENT = 30
+    RESUME_SENT = 31
+    FOOT_CHECK_ACK_SENT = 32
+    FOOT_CHECK_REQUEST_SENT = 33
+    EXERCISE_MENU_SENT = 34
+    UNSUPPORTED_NOTICE_SENT = 35
+    REPLY_SENT = 36
+    PUSH_SENT = 37
+    PUSH_QUEUED = 38
+    REMINDER_CANCELLED = 39  # 回答したため送信待ちのリマインダーを取り消した
+    # エラー
+    INVALID_EXERCISE_DAYS = 90
+    REPLY_TOKEN_REUSED = 91
+    SEND_NETWORK_ERROR = 92
+    SEND_API_ERROR = 93
+    REPLY_FAILED = 94
+    CIRCUIT_OPEN = 95
+    REPLY_EXPIRED = 96  # 返信の期限切れのため送信しなかった
+    HANDLER_ERROR = 99
+
+# message_logs.message_type の値
+MESSAGE_LOG_TYPES = ("received", "sent", "system", "error")
 
 class MessageLog(Base):
+    """
+    メッセージログ
+
+    created_at の月単位でレンジパーティション化している（message_logs_YYYY_MM）。
+    長い日本語の文言ではなく event_code と短い detail だけを保存する。
+    古いパーティションは log_retention.py で切り離してアーカイブする。
+    """
     __tablename__ = 'message_logs'
 
-    id = Column(Integer, primary_key=True)
+    id = Column(BigInteger, autoincrement=True)
     user_id = Column(Integer, ForeignKey('users.id'))
-    message_type = Column(String)  # "received" or "sent"
-    message_content = Column(Text)
-    created_at = Column(DateTime, default=datetime.utcnow)
+    message_type = Column(Enum(*MESSAGE_LOG_TYPES, name="message_log_type"), nullable=False)
+    event_code = Column(SmallInteger, nullable=False, default=LogEvent.OTHER)
+    detail = Column(String(255))
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
 
     user = relationship("User", back_populates="messages")
 
+    # パーティションキーは主キーに含める必要がある
+    __table_args__ = (
+        PrimaryKeyConstraint('id', 'created_at'),
+        {"postgresql_partition_by": "RANGE (created_at)"},
+    )
+
 class ExerciseHistory(Base):
     __tablename__ = 'exercise_history'
 
@@ -63,6 +136,168 @@ class ExerciseHistory(Base):
     
     user = relationship("User")
 
+class ExerciseDailyStat(Base):
+    """運動履歴の日次集計（/history/<bot_id> の統計用、rollups.pyで更新）"""
+    __tablename__ = 'exercise_daily_stats'
+
+    company_id = Column(Integer, ForeignKey('companies.id'), primary_key=True)
+    stat_date = Column(Date, primary_key=True)  # response_date（UTC）の日付
+    foot_check_result = Column(String(1), primary_key=True)  # A/B/C/D（未設定は"?"）
+    week_number = Column(Integer, primary_key=True)  # 1〜12（未設定は0）
+    response_count = Column(Integer, nullable=False, default=0)
+    response_days_sum = Column(Integer, nullable=False, default=0)
+
+class ExerciseWeeklyStat(Base):
+    """運動履歴の週次集計（週の開始日は月曜日）"""
+    __tablename__ = 'exercise_weekly_stats'
+
+    company_id = Column(Integer, ForeignKey('companies.id'), primary_key=True)
+    week_start = Column(Date, primary_key=True)
+    foot_check_result = Column(String(1), primary_key=True)
+    week_number = Column(Integer, primary_key=True)
+    response_count = Column(Integer, nullable=False, default=0)
+    response_days_sum = Column(Integer, nullable=False, default=0)
+
+# outbound_messages.status の値
+OUTBOX_PENDING = "pending"    # 送信待ち（next_attempt_at 以降に送信）
+OUTBOX_SENDING = "sending"    # ディスパッチャーが確保中（locked_until まで）
+OUTBOX_SENT = "sent"
+OUTBOX_FAILED = "failed"      # 再送しても成功しないエラー、または試行回数の上限
+
+class OutboundMessage(Base):
+    """
+    送信待ちのpushメッセージ（トランザクショナルアウトボックス）
+
+    ユーザーの状態更新と同じトランザクションで追加し、outbox.py のディスパッチャーが送信する。
+    retry_key を X-Line-Retry-Key として送るため、再送してもLINE側で重複配信されない。
+    """
+    __tablename__ = 'outbound_messages'
+
+    id = Column(BigInteger, primary_key=True)
+    company_id = Column(Integer, ForeignKey('companies.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'))
+    to = Column(String, nullable=False)  # 送信先のLINEユーザーID
+    kind = Column(String(32), nullable=False)  # "reminder" など送信の種類
+    payload = Column(JSONB, nullable=False)  # メッセージ（Message.to_dict()）のリスト
+    retry_key = Column(String(36), nullable=False, unique=True)
+    status = Column(String(16), nullable=False, default=OUTBOX_PENDING)
+    attempts = Column(SmallInteger, nullable=False, default=0)
+    next_attempt_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    locked_until = Column(DateTime)
+    last_error = Column(String(255))
+    line_request_id = Column(String(64))  # 送信を受け付けたリクエストID（x-line-request-id）
+    sent_event = Column(SmallInteger)  # 送信できたときに記録するログ（LogEvent。返信の代わりのpushの WELCOME_SENT など）
+    sent_detail = Column(String(255))
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    sent_at = Column(DateTime)
+
+    __table_args__ = (
+        Index('ix_outbound_messages_due', 'status', 'next_attempt_at'),
+        # ユーザーの送信待ちの取り消し（outbox.cancel_pending）
+        Index('ix_outbound_messages_user_status', 'user_id', 'status'),
+    )
+
+# campaigns.status の値
+CAMPAIGN_RUNNING = "running"
+CAMPAIGN_PAUSED = "paused"
+CAMPAIGN_COMPLETED = "completed"
+CAMPAIGN_CANCELLED = "cancelled"
+
+class Campaign(Base):
+    """
+    企業の任意のお知らせ配信（campaigns.py が送信する）
+
+    対象ユーザーはusers.idの昇順に送信し、送信済みの位置を cursor_user_id に記録するので、
+    一時停止・再起動後は続きから再開できる。
+    """
+    __tablename__ = 'campaigns'
+
+    id = Column(Integer, primary_key=True)
+    company_id = Column(Integer, ForeignKey('companies.id'), nullable=False)
+    name = Column(String, nullable=False)
+    payload = Column(JSONB, nullable=False)  # メッセージ（Message.to_dict()）のリスト
+    audience = Column(JSONB, nullable=False, default=dict)  # 対象の絞り込み条件
+    status = Column(String(16), nullable=False, default=CAMPAIGN_RUNNING)
+    rate_per_second = Column(Integer)  # 1秒あたりの最大送信通数（未設定は無制限）
+    audience_size = Column(Integer)  # 開始時点の対象人数
+    cursor_user_id = Column(Integer, nullable=False, default=0)  # 送信済みの最後のusers.id
+    # 送信中のバッチ（[[users.id, line_user_id], ...]）とretry_key。送信前にコミットし、結果を記録したら消す
+    # （結果を記録する前に落ちた場合、再開後は同じ宛先・同じキーで送り直す）
+    pending_batch = Column(JSONB(none_as_null=True))
+    pending_retry_key = Column(String(36))
+    sent_count = Column(Integer, nullable=False, default=0)
+    failed_count = Column(Integer, nullable=False, default=0)
+    request_count = Column(Integer, nullable=False, default=0)  # LINE APIの呼び出し回数
+    last_error = Column(String(255))
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    started_at = Column(DateTime)
+    finished_at = Column(DateTime)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+# scheduler_runs.status の値
+RUN_RUNNING = "running"
+RUN_SUCCEEDED = "succeeded"
+RUN_FAILED = "failed"
+RUN_SKIPPED = "skipped"  # 前回の実行が終わっていない（他のワーカーが実行中）ため実行しなかった
+
+class SchedulerRun(Base):
+    """スケジューラーのジョブの実行履歴（job_runs.py が記録する）"""
+    __tablename__ = 'scheduler_runs'
+
+    id = Column(BigInteger, primary_key=True)
+    job = Column(String(64), nullable=False)
+    status = Column(String(16), nullable=False, default=RUN_RUNNING)
+    worker = Column(String(128))  # ホスト名:PID
+    started_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = Column(DateTime)
+    duration_ms = Column(Integer)
+    stats = Column(JSONB, nullable=False, default=dict)  # 企業ごとの件数・所要時間など
+    error = Column(String(255))
+
+    __table_args__ = (Index('ix_scheduler_runs_job_started', 'job', 'started_at'),)
+
+def bump_company_versions(session, company_ids):
+    """企業のdata_versionを加算する（コミットは呼び出し側で行う）"""
+    # 同時実行時のデッドロックを避けるため、常にID順で更新する
+    for company_id in sorted(company_ids):
+        session.query(Company).filter_by(id=company_id).update(
+            {Company.data_version: Company.data_version + 1},
+            synchronize_session=False
+        )
+
+def upsert_users(session, company_id, usernames):
+    """
+    ユーザーを INSERT ... ON CONFLICT で一括登録し、({line_user_id: User}, このINSERTで作成したline_user_idの集合) を返す
+
+    :param usernames: {line_user_id: username}
+    別ワーカーが同時に同じユーザーを作成していても一意制約違反にはならず、
+    既存の行がそのまま返る（既存ユーザーのusernameは上書きしない）。
+    既存の行は作成した集合に含まれないので、登録の記録は作成したワーカーだけが行える。
+    """
+    if not usernames:
+        return {}, set()
+
+    # 同時実行時のデッドロックを避けるため、常に同じ順序で挿入する
+    stmt = pg_insert(User).values([
+        {"line_user_id": line_user_id, "company_id": company_id, "username": username}
+        for line_user_id, username in sorted(usernames.items())
+    ])
+    # DO NOTHINGでは既存行が返らないため、値を変えない更新で既存行もRETURNINGさせる
+    stmt = stmt.on_conflict_do_update(
+        constraint='_line_user_company_uc',
+        set_={"line_user_id": stmt.excluded.line_user_id}
+    ).returning(User, literal_column("(xmax = 0)").label("created"))
+
+    users = {}
+    created_ids = set()
+    for user, created in session.execute(stmt, execution_options={"populate_existing": True}):
+        users[user.line_user_id] = user
+        if created:
+            created_ids.add(user.line_user_id)
+        else:
+            print(f"User {user.line_user_id[:8]}... already existed (created concurrently)")
+    return users, created_ids
+
 # PostgreSQL接続用エンジン作成関数
 def get_engine(database_url):
     return create_engine(
@@ -75,6 +310,13 @@ def get_engine(database_url):
         pool_recycle=1800  # 30分でコネクションをリサイクル
     )
 
+# 実行したSQLの数（webhook_replay.py で1件のWebhookあたりのDB呼び出し数を数えるのに使う）
+metrics.describe("db_statements_total", "counter", "SQL statements executed by this process")
+
+@event.listens_for(Engine, "before_cursor_execute")
+def count_statement(conn, cursor, statement, parameters, context, executemany):
+    metrics.inc("db_statements_total")
+
 # Session作成
 def get_session(engine):
     Session = sessionmaker(bind=engine)
@@ -94,16 +336,199 @@ def get_db_session(database_url):
         session.close()
         engine.dispose()
 
+# レプリカの遅延（秒）。レプリカでない（リカバリ中でない）場合やWALを適用し終えている場合は0
+REPLICA_LAG_SQL = text(
+    "SELECT CASE WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+    "ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0) END"
+)
+
+# レプリカの遅延の確認結果（read_url -> (確認時刻, 遅延秒。接続できなければNone)）
+replica_lag_checks = {}
+replica_lag_lock = threading.Lock()
+# 読み取りの振り分け件数（/health 用）
+read_routing_stats = {"replica": 0, "primary": 0, "fallback_lag": 0, "fallback_error": 0}
+
+def _count_read(kind):
+    with replica_lag_lock:
+        read_routing_stats[kind] += 1
+
+def replica_lag(engine, read_url, check_seconds):
+    """レプリカの遅延秒数（check_seconds の間は前回の結果を使う。接続できなければNone）"""
+    now = time.monotonic()
+    with replica_lag_lock:
+        checked = replica_lag_checks.get(read_url)
+    if checked is not None and now - checked[0] < check_seconds:
+        return checked[1]
+    try:
+        with engine.connect() as conn:
+            lag = float(conn.execute(REPLICA_LAG_SQL).scalar())
+    except Exception as e:
+        print(f"Read replica check failed: {e}")
+        lag = None
+    with replica_lag_lock:
+        replica_lag_checks[read_url] = (now, lag)
+    return lag
+
+@contextmanager
+def get_read_session(database_url, read_url=None):
+    """
+    読み取り専用の処理用セッション（管理・履歴・分析APIとリマインダー対象の検索）
+
+    read_url（DATABASE_READ_URL）があればレプリカに接続する。レプリカの遅延が
+    READ_REPLICA_MAX_LAG_SECONDS を超えている場合や接続できない場合はプライマリを使う。
+    書き込みは必ず get_db_session（プライマリ）で行うこと。
+    session.info["replica"] でどちらに接続したか確認できる。
+    """
+    from config import READ_REPLICA_MAX_LAG_SECONDS, READ_REPLICA_LAG_CHECK_SECONDS
+
+    if read_url and read_url != database_url:
+        engine = get_engine(read_url)
+        lag = replica_lag(engine, read_url, READ_REPLICA_LAG_CHECK_SECONDS)
+        if lag is not None and lag <= READ_REPLICA_MAX_LAG_SECONDS:
+            _count_read("replica")
+            session = get_session(engine)
+            session.info["replica"] = True
+            session.info["replica_lag"] = lag
+            try:
+                yield session
+            except Exception:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+                engine.dispose()
+            return
+        engine.dispose()
+        if lag is None:
+            _count_read("fallback_error")
+        else:
+            _count_read("fallback_lag")
+            print(f"Read replica is {lag:.1f}s behind, using primary")
+    else:
+        _count_read("primary")
+
+    with get_db_session(database_url) as session:
+        session.info["replica"] = False
+        yield session
+
+def read_replica_snapshot():
+    """/health 用：振り分け件数と最後に確認したレプリカの遅延"""
+    with replica_lag_lock:
+        lags = {url.rsplit("@", 1)[-1]: lag for url, (_, lag) in replica_lag_checks.items()}
+        counts = dict(read_routing_stats)
+    return dict(counts, lag_seconds=lags)
+
+def month_start(value, offset=0):
+    """valueが属する月の初日（offsetヶ月ずらす）"""
+    month_index = value.year * 12 + (value.month - 1) + offset
+    return datetime(month_index // 12, month_index % 12 + 1, 1)
+
+def message_log_partition_name(month):
+    """月に対応するパーティションテーブル名"""
+    return f"message_logs_{month.year:04d}_{month.month:02d}"
+
+def ensure_message_log_partitions(engine, months_ahead=2, now=None):
+    """当月から months_ahead ヶ月先までの月次パーティションを作成する"""
+    now = now or datetime.utcnow()
+    created = []
+    with engine.begin() as conn:
+        for offset in range(months_ahead + 1):
+            start = month_start(now, offset)
+            end = month_start(now, offset + 1)
+            name = message_log_partition_name(start)
+            exists = conn.execute(text("SELECT to_regclass(:name)"), {"name": name}).scalar()
+            if exists:
+                continue
+            conn.execute(text(
+                f"CREATE TABLE {name} PARTITION OF message_logs "
+                f"FOR VALUES FROM ('{start:%Y-%m-%d}') TO ('{end:%Y-%m-%d}')"
+            ))
+            created.append(name)
+        # 作成漏れがあっても書き込みが失敗しないようにデフォルトパーティションを用意
+        conn.execute(text("CREATE TABLE IF NOT EXISTS message_logs_default PARTITION OF message_logs DEFAULT"))
+    if created:
+        print(f"Created message_logs partitions: {created}")
+    return created
+
+def migrate_legacy_message_logs(engine):
+    """パーティション化前のmessage_logsをmessage_logs_legacyに退避する（保持期間を過ぎたら log_retention がアーカイブして削除する）"""
+    with engine.begin() as conn:
+        row = conn.execute(text(
+            "SELECT c.relkind FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace "
+            "WHERE c.relname = 'message_logs' AND n.nspname = current_schema()"
+        )).first()
+        # 'p' はパーティションテーブル
+        if not row or row[0] == 'p':
+            return False
+        conn.execute(text("ALTER TABLE message_logs RENAME TO message_logs_legacy"))
+        conn.execute(text("ALTER INDEX IF EXISTS message_logs_pkey RENAME TO message_logs_legacy_pkey"))
+        conn.execute(text("ALTER SEQUENCE IF EXISTS message_logs_id_seq RENAME TO message_logs_legacy_id_seq"))
+    print("Renamed unpartitioned message_logs to message_logs_legacy")
+    return True
+
+# 既存テーブルに後から追加したカラム（create_allでは既存テーブルに追加されないため）
+ADDED_COLUMNS = [
+    ("companies", "data_version", "BIGINT NOT NULL DEFAULT 0"),
+    ("users", "state_version", "INTEGER NOT NULL DEFAULT 1"),
+    ("users", "active", "BOOLEAN NOT NULL DEFAULT TRUE"),
+    ("users", "unfollowed_at", "TIMESTAMP WITHOUT TIME ZONE"),
+    ("campaigns", "pending_batch", "JSONB"),
+    ("campaigns", "pending_retry_key", "VARCHAR(36)"),
+    ("outbound_messages", "sent_event", "SMALLINT"),
+    ("outbound_messages", "sent_detail", "VARCHAR(255)"),
+]
+
+# 既存テーブルに後から追加したインデックス（テーブル名, インデックス名）
+ADDED_INDEXES = [
+    ("users", "ix_users_company_active"),
+    ("outbound_messages", "ix_outbound_messages_user_status"),
+]
+
+def add_missing_columns(engine):
+    """ADDED_COLUMNS・ADDED_INDEXESのうち、既存テーブルにまだないものを追加する"""
+    with engine.begin() as conn:
+        for table, column, ddl in ADDED_COLUMNS:
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {ddl}"))
+
+    # インデックスは書き込みを止めないよう CONCURRENTLY で作成する（トランザクションの外で実行する必要がある）
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        for table, name in ADDED_INDEXES:
+            index = next(i for i in Base.metadata.tables[table].indexes if i.name == name)
+            columns = ", ".join(column.name for column in index.columns)
+            conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {table} ({columns})"))
+            # 作成が途中で失敗したインデックスは無効のまま残り、IF NOT EXISTS では作り直されない
+            # （別のワーカーが作成中の場合も無効に見えるので、ここでは削除せずに知らせるだけにする）
+            valid = conn.execute(text(
+                "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = :name AND c.relnamespace = current_schema()::regnamespace"
+            ), {"name": name}).scalar()
+            if valid is False:
+                print(f"Index {name} is invalid or still being built; "
+                      f"if it stays invalid, run DROP INDEX CONCURRENTLY {name} and restart")
+
 def run_migrations(database_url):
     """データベースのマイグレーションを実行する関数"""
     engine = get_engine(database_url)
     
+    # 旧形式のmessage_logsは退避してからパーティションテーブルを作り直す
+    migrate_legacy_message_logs(engine)
+    
     # テーブルが存在するか確認
     inspector = inspect(engine)
     existing_tables = inspector.get_table_names()
     
     # 必要なテーブルを作成
     Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    ensure_message_log_partitions(engine)
+    
+    # 集計テーブルが空の企業は既存の運動履歴から集計する（/history の統計が0にならないように）
+    from rollups import backfill_rollups
+    with get_db_session(database_url) as session:
+        backfilled = backfill_rollups(session)
+        session.commit()
+    if backfilled:
+        print(f"Backfilled exercise rollups for companies: {backfilled}")
     
     # 既存のテーブルと新しいテーブルの差分を確認
     new_tables = set(Base.metadata.tables.keys())
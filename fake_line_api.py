@@ -0,0 +1,304 @@
+# fake_line_api.py
+"""
+ローカル負荷試験用のLINE Messaging APIスタブサーバー
+
+実際のLINEへは一切通信せず、reply / push / multicast / get_profile と
+メッセージ通数の上限（quota / quota/consumption）を模倣する。
+LINE_API_BASE_URL をこのサーバーに向けると config.get_line_client の
+クライアントがすべてここに送信するようになる。
+
+    python fake_line_api.py --port 8081 --latency normal:0.08,0.02 --rate-429 0.01
+    LINE_API_BASE_URL=http://localhost:8081 python main.py
+
+レイテンシ分布の書式:
+    fixed:<秒> / uniform:<最小>,<最大> / normal:<平均>,<標準偏差> / lognormal:<mu>,<sigma>
+"""
+import os
+import json
+import time
+import random
+import uuid
+import threading
+import argparse
+from collections import deque
+from flask import Flask, request, jsonify
+
+app = Flask(__name__)
+
+# 模倣する操作
+OPERATIONS = ("reply", "push", "multicast", "profile")
+
+# 実行時設定（POST /__fake/config で変更可能）
+settings = {
+    "latency": {op: os.getenv(f"FAKE_LINE_LATENCY_{op.upper()}", os.getenv("FAKE_LINE_LATENCY", "fixed:0")) for op in OPERATIONS},
+    "rate_429": float(os.getenv("FAKE_LINE_RATE_429", "0")),
+    "rate_500": float(os.getenv("FAKE_LINE_RATE_500", "0")),
+    "retry_after": int(os.getenv("FAKE_LINE_RETRY_AFTER", "1")),
+    "max_recorded": int(os.getenv("FAKE_LINE_MAX_RECORDED", "10000")),
+    # 月間のメッセージ通数上限（未設定なら上限なし）
+    "quota": int(os.getenv("FAKE_LINE_QUOTA")) if os.getenv("FAKE_LINE_QUOTA") else None,
+    # 友だちでない（ブロックした）ユーザー。pushは400を返す（multicastでは本物と同様に黙って除く）
+    "unreachable_users": [u for u in os.getenv("FAKE_LINE_UNREACHABLE_USERS", "").split(",") if u],
+}
+
+# 受信したリクエストの記録
+recorded_requests = deque(maxlen=settings["max_recorded"])
+
+# 使用済みreply_tokenと X-Line-Retry-Key（本物と同様に再利用を拒否する）
+used_reply_tokens = set()
+used_retry_keys = {}
+
+# 操作ごとの呼び出し回数
+call_counts = {op: 0 for op in OPERATIONS}
+
+# 送信したメッセージ通数（push・multicastの宛先数の合計）
+quota_usage = {"total": 0}
+
+state_lock = threading.Lock()
+
+def parse_latency(spec):
+    """レイテンシ分布の文字列を (分布名, パラメータ) に変換"""
+    name, _, params = spec.partition(":")
+    values = [float(v) for v in params.split(",") if v.strip()] if params else [0.0]
+    if name not in ("fixed", "uniform", "normal", "lognormal"):
+        raise ValueError(f"Unknown latency distribution: {spec}")
+    return name, values
+
+def sample_latency(spec):
+    """分布からレイテンシ（秒）を1つ取り出す"""
+    name, values = parse_latency(spec)
+    if name == "fixed":
+        delay = values[0]
+    elif name == "uniform":
+        delay = random.uniform(values[0], values[1])
+    elif name == "normal":
+        delay = random.gauss(values[0], values[1])
+    else:
+        delay = random.lognormvariate(values[0], values[1])
+    return max(delay, 0.0)
+
+def record(operation, body=None, status=200):
+    """リクエスト内容を記録"""
+    with state_lock:
+        call_counts[operation] += 1
+        recorded_requests.append({
+            "operation": operation,
+            "path": request.path,
+            "status": status,
+            "received_at": time.time(),
+            "authorization": (request.headers.get("Authorization") or "")[:20],
+            "retry_key": request.headers.get("X-Line-Retry-Key"),
+            "body": body,
+        })
+
+def error_response(message, status, headers=None, details=None):
+    """LINE APIと同じ形式のエラーレスポンス"""
+    response = jsonify({"message": message, "details": details or []})
+    response.status_code = status
+    for key, value in (headers or {}).items():
+        response.headers[key] = value
+    return response
+
+def simulate(operation, body=None):
+    """レイテンシと障害を注入する。エラーを返す場合はレスポンスを返す"""
+    time.sleep(sample_latency(settings["latency"][operation]))
+
+    roll = random.random()
+    if roll < settings["rate_429"]:
+        record(operation, body, 429)
+        return error_response(
+            "The API rate limit has been exceeded. Try again later.", 429,
+            {"Retry-After": str(settings["retry_after"])}
+        )
+    if roll < settings["rate_429"] + settings["rate_500"]:
+        record(operation, body, 500)
+        return error_response("Internal server error", 500)
+    return None
+
+def check_retry_key(operation, body):
+    """X-Line-Retry-Keyの重複を検出（本物と同様に409を返す）"""
+    retry_key = request.headers.get("X-Line-Retry-Key")
+    if not retry_key:
+        return None
+    with state_lock:
+        accepted_id = used_retry_keys.get(retry_key)
+        if accepted_id is None:
+            used_retry_keys[retry_key] = str(uuid.uuid4())
+            return None
+    record(operation, body, 409)
+    return error_response(
+        "The retry key is already accepted", 409,
+        {"X-Line-Accepted-Request-Id": accepted_id}
+    )
+
+def sent_messages(body):
+    """送信成功時のレスポンスボディ"""
+    return {"sentMessages": [
+        {"id": str(random.randint(10**17, 10**18)), "quoteToken": uuid.uuid4().hex}
+        for _ in body.get("messages", [])
+    ]}
+
+@app.route("/v2/bot/message/reply", methods=["POST"])
+def reply():
+    body = request.get_json(silent=True) or {}
+    failure = simulate("reply", body)
+    if failure:
+        return failure
+
+    token = body.get("replyToken")
+    with state_lock:
+        reused = token in used_reply_tokens
+        used_reply_tokens.add(token)
+    if not token or reused:
+        record("reply", body, 400)
+        return error_response("Invalid reply token", 400)
+
+    record("reply", body)
+    return jsonify(sent_messages(body))
+
+def consume_quota(operation, body, count):
+    """通数の上限を超える場合は429を返す（本物と同様に送信全体を拒否する）"""
+    with state_lock:
+        if settings["quota"] is not None and quota_usage["total"] + count > settings["quota"]:
+            exceeded = True
+        else:
+            quota_usage["total"] += count
+            exceeded = False
+    if exceeded:
+        record(operation, body, 429)
+        return error_response("You have reached your monthly limit.", 429)
+    return None
+
+@app.route("/v2/bot/message/push", methods=["POST"])
+def push():
+    body = request.get_json(silent=True) or {}
+    failure = simulate("push", body) or check_retry_key("push", body)
+    if failure:
+        return failure
+    if body.get("to") in settings["unreachable_users"]:
+        record("push", body, 400)
+        return error_response("Failed to send messages", 400, details=[
+            {"message": "The user is not a friend of the LINE Official Account", "property": "to"}
+        ])
+    failure = consume_quota("push", body, 1)
+    if failure:
+        return failure
+    record("push", body)
+    return jsonify(sent_messages(body))
+
+@app.route("/v2/bot/message/multicast", methods=["POST"])
+def multicast():
+    body = request.get_json(silent=True) or {}
+    failure = simulate("multicast", body) or check_retry_key("multicast", body)
+    if failure:
+        return failure
+    if len(body.get("to", [])) > 500:
+        record("multicast", body, 400)
+        return error_response("Size must be between 0 and 500", 400)
+    failure = consume_quota("multicast", body, len(body.get("to", [])))
+    if failure:
+        return failure
+    record("multicast", body)
+    return jsonify({})
+
+@app.route("/v2/bot/message/quota", methods=["GET"])
+def get_quota():
+    if settings["quota"] is None:
+        return jsonify({"type": "none"})
+    return jsonify({"type": "limited", "value": settings["quota"]})
+
+@app.route("/v2/bot/message/quota/consumption", methods=["GET"])
+def get_quota_consumption():
+    with state_lock:
+        return jsonify({"totalUsage": quota_usage["total"]})
+
+@app.route("/v2/bot/profile/<user_id>", methods=["GET"])
+def get_profile(user_id):
+    failure = simulate("profile")
+    if failure:
+        return failure
+    record("profile", {"userId": user_id})
+    return jsonify({
+        "userId": user_id,
+        "displayName": f"テストユーザー{user_id[-4:]}",
+        "pictureUrl": "https://example.com/profile.jpg",
+        "language": "ja",
+    })
+
+# --- スタブ制御用エンドポイント ---
+
+@app.route("/__fake/requests", methods=["GET"])
+def list_recorded():
+    """記録したリクエストを取得（?operation=push で絞り込み）"""
+    operation = request.args.get("operation")
+    with state_lock:
+        items = [r for r in recorded_requests if not operation or r["operation"] == operation]
+        counts = dict(call_counts)
+    return jsonify({"counts": counts, "requests": items})
+
+@app.route("/__fake/requests", methods=["DELETE"])
+def clear_recorded():
+    """記録と使用済みトークンをリセット"""
+    with state_lock:
+        recorded_requests.clear()
+        used_reply_tokens.clear()
+        used_retry_keys.clear()
+        quota_usage["total"] = 0
+        for op in OPERATIONS:
+            call_counts[op] = 0
+    return jsonify({"status": "cleared"})
+
+@app.route("/__fake/config", methods=["GET", "POST"])
+def configure():
+    """レイテンシ・障害注入の設定を取得/変更"""
+    if request.method == "POST":
+        updates = request.get_json(silent=True) or {}
+        latency = updates.get("latency", {})
+        if isinstance(latency, str):
+            latency = {op: latency for op in OPERATIONS}
+        try:
+            for op, spec in latency.items():
+                parse_latency(spec)
+                settings["latency"][op] = spec
+        except ValueError as e:
+            return error_response(str(e), 400)
+        for key in ("rate_429", "rate_500"):
+            if key in updates:
+                settings[key] = float(updates[key])
+        if "retry_after" in updates:
+            settings["retry_after"] = int(updates["retry_after"])
+        if "unreachable_users" in updates:
+            settings["unreachable_users"] = list(updates["unreachable_users"] or [])
+        if "quota" in updates:
+            settings["quota"] = int(updates["quota"]) if updates["quota"] is not None else None
+    return jsonify(settings)
+
+def main():
+    parser = argparse.ArgumentParser(description="LINE Messaging APIのローカルスタブ")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", help="全操作共通のレイテンシ分布 (例: normal:0.08,0.02)")
+    parser.add_argument("--rate-429", type=float, help="429を返す確率")
+    parser.add_argument("--rate-500", type=float, help="500を返す確率")
+    parser.add_argument("--retry-after", type=int, help="429時のRetry-After秒数")
+    parser.add_argument("--quota", type=int, help="月間のメッセージ通数上限")
+    args = parser.parse_args()
+
+    if args.latency:
+        parse_latency(args.latency)
+        settings["latency"] = {op: args.latency for op in OPERATIONS}
+    if args.rate_429 is not None:
+        settings["rate_429"] = args.rate_429
+    if args.rate_500 is not None:
+        settings["rate_500"] = args.rate_500
+    if args.retry_after is not None:
+        settings["retry_after"] = args.retry_after
+    if args.quota is not None:
+        settings["quota"] = args.quota
+
+    print(f"Fake LINE Messaging API listening on http://{args.host}:{args.port}")
+    print(f"設定: {json.dumps(settings, ensure_ascii=False)}")
+    app.run(host=args.host, port=args.port, threaded=True)
+
+if __name__ == "__main__":
+    main()
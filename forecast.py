@@ -0,0 +1,327 @@
+# forecast.py
+"""
+リマインダーの送信数の予測（ワーカー数・送信速度の上限・料金プランの見積もり用）
+
+send_company_reminders と同じ条件（最後の回答から7日経過・question_sent=False・有効なユーザー）で、
+今後 N 日間の企業ごと・1時間ごとのリマインダー（push）と、回答への返信（reply）の件数を予測する。
+
+- ユーザーは1回の集計クエリで (企業, question_sent, program_sent_date の時刻) ごとの人数として読み込み、
+  np.bincount で予測期間の1時間ごとの配列にする（ユーザーごとのループは使わない）
+- 1時間ごとの配列を順に進め、スケジューラーの検索間隔（REMINDER_INTERVAL_HOURS）ごとにまとめて追加、
+  送信時間帯への分散と1社あたりの送信速度の上限（send_window.py）を当てはめる
+- 送ったリマインダーのうち回答率（response_rate）の分が response_lag_hours 時間後に回答し（返信1回）、
+  その7日後に次のリマインダーの対象になる
+- 質問を送信済みで回答待ちのユーザーは、回答予定時刻（送信＋response_lag_hours）が過ぎていなければ同じく回答するとみなし、
+  過ぎていれば回答しないものとする
+- 回答率は指定がなければ直近28日の送信済みリマインダー数と回答数から推定する
+
+    python forecast.py --days 14
+    python forecast.py --bot-id company3 --days 30 --granularity day
+    python forecast.py --benchmark --users 1000000
+"""
+import time
+import json
+import argparse
+from datetime import datetime, timedelta, timezone
+import numpy as np
+from sqlalchemy import text
+from send_window import get_send_window
+from config import REMINDER_INTERVAL_HOURS, REMINDER_MAX_PUSH_PER_SECOND
+
+REMINDER_CYCLE_HOURS = 7 * 24  # 最後の回答からリマインダーまで
+DEFAULT_RESPONSE_RATE = 0.5
+DEFAULT_RESPONSE_LAG_HOURS = 24
+RESPONSE_RATE_SAMPLE_DAYS = 28
+MIN_RESPONSE_RATE_SAMPLE = 20  # これより送信数が少なければ DEFAULT_RESPONSE_RATE を使う
+MAX_FORECAST_DAYS = 90
+
+# 有効なユーザーを (企業, question_sent, program_sent_date の時刻) ごとに数える
+USER_HOURS_QUERY = text(
+    "SELECT company_id, question_sent, floor(extract(epoch FROM program_sent_date) / 3600)::bigint, count(*) "
+    "FROM users "
+    "WHERE company_id = ANY(:company_ids) AND active AND program_sent_date IS NOT NULL "
+    "GROUP BY 1, 2, 3"
+)
+
+RESPONSE_RATE_QUERY = text(
+    "SELECT "
+    "(SELECT count(*) FROM outbound_messages "
+    " WHERE company_id = :company_id AND kind = 'reminder' AND status = 'sent' AND sent_at >= :since), "
+    "(SELECT count(*) FROM exercise_history WHERE company_id = :company_id AND response_date >= :since)"
+)
+
+def load_user_hours(session, company_ids):
+    """{company_id: (question_sent(bool配列), 時刻(int64配列、1970年からの時間数), 人数(int64配列))}"""
+    rows = session.execute(USER_HOURS_QUERY, {"company_ids": list(company_ids)}).all()
+    data = np.array([(c, q, h, n) for c, q, h, n in rows], dtype=np.int64).reshape(-1, 4)
+    result = {}
+    for company_id in company_ids:
+        part = data[data[:, 0] == company_id]
+        result[company_id] = (part[:, 1].astype(bool), part[:, 2], part[:, 3])
+    return result
+
+def estimate_response_rate(session, company_id, now):
+    """直近の送信済みリマインダーに対する回答の割合（件数が少なければ既定値）"""
+    sent, responses = session.execute(RESPONSE_RATE_QUERY, {
+        "company_id": company_id, "since": now - timedelta(days=RESPONSE_RATE_SAMPLE_DAYS)
+    }).one()
+    if sent < MIN_RESPONSE_RATE_SAMPLE:
+        return DEFAULT_RESPONSE_RATE, "default"
+    return min(responses / sent, 1.0), "observed"
+
+def bucket_users(question_sent, sent_hour, counts, start_hour, hours, response_lag_hours):
+    """
+    ユーザーの人数を予測期間の1時間ごとの配列にする
+    :return: (リマインダーの対象になる人数, 回答待ちのユーザーが回答する人数)（回答率を掛ける前）
+    """
+    due_offset = sent_hour + REMINDER_CYCLE_HOURS - start_hour
+    # 未送信：対象になる時刻（すでに過ぎていれば最初の時間）
+    waiting = ~question_sent & (due_offset < hours)
+    due = np.bincount(np.maximum(due_offset[waiting], 0), weights=counts[waiting], minlength=hours)[:hours]
+    # 回答待ち：質問を送った時刻（対象になった時刻とみなす）＋回答までの時間
+    reply_offset = due_offset + int(response_lag_hours)
+    awaiting = question_sent & (reply_offset >= 0) & (reply_offset < hours)
+    replies = np.bincount(reply_offset[awaiting], weights=counts[awaiting], minlength=hours)[:hours]
+    return due.astype(np.float64), replies.astype(np.float64)
+
+def open_fractions(window, start, hours):
+    """1時間ごとの送信時間帯の割合（0〜1）"""
+    return np.array([
+        window.open_seconds(start + timedelta(hours=h), start + timedelta(hours=h + 1)) / 3600
+        for h in range(hours)
+    ])
+
+def simulate(due, awaiting_replies, open_fraction, response_rate, response_lag_hours=DEFAULT_RESPONSE_LAG_HOURS,
+             interval_hours=REMINDER_INTERVAL_HOURS, max_per_second=REMINDER_MAX_PUSH_PER_SECOND, first_scan=0):
+    """
+    1時間ごとの送信数を予測する
+    :param due: リマインダーの対象になる人数（1時間ごと）
+    :param awaiting_replies: 回答待ちのユーザーが回答する人数（1時間ごと、回答率を掛ける前）
+    :param first_scan: 最初のスケジューラー実行の時間（予測期間の先頭からの時間数）
+    :return: {"reminders", "replies", "backlog"}（1時間ごとの配列）と期間内に送れなかった件数
+    """
+    hours = len(due)
+    due = due.copy()
+    lag = int(response_lag_hours)
+    replies = awaiting_replies * response_rate
+    # 回答待ちのユーザーも回答の7日後に再び対象になる
+    due[REMINDER_CYCLE_HOURS:] += replies[:max(hours - REMINDER_CYCLE_HOURS, 0)]
+    capacity = open_fraction * 3600 * max_per_second if max_per_second else np.where(open_fraction > 0, np.inf, 0)
+    planned = np.zeros(hours)
+    reminders = np.zeros(hours)
+    backlog = np.zeros(hours)
+    pending = 0.0
+    carry = 0.0
+    unscheduled = 0.0
+
+    for h in range(hours):
+        pending += due[h]
+        if pending and h >= first_scan and (h - first_scan) % interval_hours == 0:
+            # 次回の検索までの送信時間帯に均等に割り振る（なければ次の送信時間帯から同じ長さ）
+            opened = np.flatnonzero(open_fraction[h:] > 0)
+            if len(opened):
+                begin = h + (opened[0] if open_fraction[h:h + interval_hours].sum() == 0 else 0)
+                weights = open_fraction[begin:begin + interval_hours]
+                planned[begin:begin + len(weights)] += pending * weights / weights.sum()
+            else:
+                unscheduled += pending
+            pending = 0.0
+        available = planned[h] + carry
+        sent = min(available, capacity[h])
+        carry = available - sent
+        reminders[h] = sent
+        backlog[h] = carry
+        if sent:
+            answered = sent * response_rate
+            if h + lag < hours:
+                replies[h + lag] += answered
+            if h + lag + REMINDER_CYCLE_HOURS < hours:
+                due[h + lag + REMINDER_CYCLE_HOURS] += answered
+
+    return {"reminders": reminders, "replies": replies, "backlog": backlog}, carry + pending + unscheduled
+
+def monthly_totals(reminders, start, tz):
+    """予測したリマインダー数を企業のタイムゾーンの暦月ごとに合計する"""
+    months = {}
+    for h in np.flatnonzero(reminders):
+        local = (start + timedelta(hours=int(h))).replace(tzinfo=timezone.utc).astimezone(tz)
+        key = local.strftime("%Y-%m")
+        months[key] = months.get(key, 0.0) + float(reminders[h])
+    return months
+
+def quota_check(months, quota, now, tz):
+    """暦月ごとの予測を月間通数の上限と比べる（今月は使用済みの分を含める）"""
+    if quota is None:
+        return None
+    current = now.replace(tzinfo=timezone.utc).astimezone(tz).strftime("%Y-%m")
+    result = {"limit": quota["limit"], "used_this_month": quota["used"], "months": []}
+    for month, forecast in sorted(months.items()):
+        projected = forecast + (quota["used"] if month == current else 0)
+        entry = {"month": month, "forecast_reminders": int(round(forecast)), "projected_usage": int(round(projected))}
+        if quota["limit"] is not None:
+            entry["utilization"] = round(projected / quota["limit"], 4) if quota["limit"] else None
+            entry["exceeds_quota"] = projected > quota["limit"]
+        result["months"].append(entry)
+    return result
+
+def series(values, start, tz, granularity):
+    """1時間ごとの配列を出力用のリストにする（granularity="day" なら企業のタイムゾーンの日ごとに合計）"""
+    reminders, replies = values["reminders"], values["replies"]
+    if granularity == "hour":
+        return [
+            {"hour": (start + timedelta(hours=h)).replace(tzinfo=timezone.utc).astimezone(tz).isoformat(),
+             "reminders": round(float(reminders[h]), 1), "replies": round(float(replies[h]), 1)}
+            for h in range(len(reminders)) if reminders[h] >= 0.05 or replies[h] >= 0.05
+        ]
+    days = {}
+    for h in range(len(reminders)):
+        day = (start + timedelta(hours=h)).replace(tzinfo=timezone.utc).astimezone(tz).date().isoformat()
+        total = days.setdefault(day, [0.0, 0.0, 0.0])
+        total[0] += reminders[h]
+        total[1] += replies[h]
+        total[2] = max(total[2], reminders[h])
+    return [
+        {"date": day, "reminders": int(round(r)), "replies": int(round(p)), "peak_hour_reminders": int(round(peak))}
+        for day, (r, p, peak) in days.items()
+    ]
+
+def forecast_company(company, user_hours, start, hours, response_rate, response_lag_hours, first_scan, quota, now,
+                     granularity="hour"):
+    """1社分の予測を計算して出力用の辞書にする"""
+    window = get_send_window(company.bot_id)
+    question_sent, sent_hour, counts = user_hours
+    start_hour = int(start.replace(tzinfo=timezone.utc).timestamp() // 3600)
+    due, awaiting = bucket_users(question_sent, sent_hour, counts, start_hour, hours, response_lag_hours)
+    values, not_sent = simulate(due, awaiting, open_fractions(window, start, hours), response_rate[0],
+                                response_lag_hours, REMINDER_INTERVAL_HOURS, REMINDER_MAX_PUSH_PER_SECOND, first_scan)
+    reminders = values["reminders"]
+    peak_hour = int(np.argmax(reminders)) if len(reminders) else 0
+    hourly_limit = REMINDER_MAX_PUSH_PER_SECOND * 3600 if REMINDER_MAX_PUSH_PER_SECOND else None
+    peak_backlog = float(values["backlog"].max()) if len(reminders) else 0.0
+    return {
+        "company": company.name,
+        "send_window": str(window),
+        "assumptions": {
+            "response_rate": round(response_rate[0], 4),
+            "response_rate_source": response_rate[1],
+            "response_lag_hours": response_lag_hours,
+            "scan_interval_hours": REMINDER_INTERVAL_HOURS,
+        },
+        "totals": {
+            "reminders": int(round(reminders.sum())),
+            "replies": int(round(values["replies"].sum())),
+            "not_sent_in_period": int(round(not_sent)),
+        },
+        "rate_limit": {
+            "max_push_per_second": REMINDER_MAX_PUSH_PER_SECOND or None,
+            "peak_hour": (start + timedelta(hours=peak_hour)).replace(tzinfo=timezone.utc).astimezone(window.tz).isoformat(),
+            "peak_hour_reminders": int(round(reminders[peak_hour])) if len(reminders) else 0,
+            "peak_push_per_second": round(float(reminders[peak_hour]) / 3600, 3) if len(reminders) else 0.0,
+            "peak_utilization": round(float(reminders[peak_hour]) / hourly_limit, 4) if hourly_limit else None,
+            # 上限のため送信待ちが次の時間以降に持ち越された件数の最大値と、それを送り切る時間
+            "peak_backlog": int(round(peak_backlog)),
+            "peak_backlog_hours": round(peak_backlog / hourly_limit, 2) if hourly_limit else None,
+        },
+        "quota": quota_check(monthly_totals(reminders, start, window.tz), quota, now, window.tz),
+        "series": series(values, start, window.tz, granularity),
+    }
+
+def forecast_reminders(session, companies, days, now=None, response_rate=None,
+                       response_lag_hours=DEFAULT_RESPONSE_LAG_HOURS, next_scan=None, quotas=None, granularity="hour"):
+    """
+    企業ごとのリマインダーの予測（/admin/forecast/<bot_id> と CLI 用）
+    :param response_rate: 回答率（Noneなら直近の実績から推定）
+    :param next_scan: 次回のスケジューラー実行の時刻（UTC、Noneなら現在）
+    :param quotas: {bot_id: quota.message_quota() の結果}（月間通数と比べない企業は省略）
+    """
+    now = now or datetime.utcnow()
+    start = now.replace(minute=0, second=0, microsecond=0)
+    hours = days * 24
+    first_scan = max(int((next_scan - start).total_seconds() // 3600), 0) if next_scan else 0
+    user_hours = load_user_hours(session, [company.id for company in companies])
+    result = {"generated_at": now.isoformat(), "days": days, "tenants": {}}
+    for company in companies:
+        rate = (response_rate, "given") if response_rate is not None else estimate_response_rate(session, company.id, now)
+        result["tenants"][company.bot_id] = forecast_company(
+            company, user_hours[company.id], start, hours, rate, response_lag_hours, first_scan,
+            (quotas or {}).get(company.bot_id), now, granularity
+        )
+    return result
+
+def next_reminder_scan():
+    """このプロセスのスケジューラーの次回のリマインダー検索の時刻（UTC、分からなければNone）"""
+    from scheduler import scheduled_jobs
+
+    for job in scheduled_jobs():
+        if job["id"] == "individual_reminder" and job["next_run_time"]:
+            return datetime.fromisoformat(job["next_run_time"]).astimezone(timezone.utc).replace(tzinfo=None)
+    return None
+
+def run_benchmark(users, days=30, repeat=5):
+    """合成データでバケット化と予測の計算時間を測る"""
+    rng = np.random.default_rng(0)
+    start = datetime(2026, 1, 5)
+    start_hour = int(start.replace(tzinfo=timezone.utc).timestamp() // 3600)
+    # 1時間ごとの人数に集計済みの形（クエリの結果と同じ）にする
+    sent_hour = start_hour - rng.integers(0, 14 * 24, users)
+    question_sent = rng.random(users) < 0.3
+    keys, counts = np.unique(np.stack([question_sent, sent_hour]), axis=1, return_counts=True)
+    print(f"Synthetic users: {users:,} -> {keys.shape[1]:,} aggregated rows")
+    window = get_send_window(None)
+    fractions = open_fractions(window, start, days * 24)
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        due, awaiting = bucket_users(keys[0].astype(bool), keys[1], counts, start_hour, days * 24,
+                                     DEFAULT_RESPONSE_LAG_HOURS)
+        values, _ = simulate(due, awaiting, fractions, DEFAULT_RESPONSE_RATE)
+        timings.append(time.perf_counter() - started)
+    print(f"forecast ({days} days): best {min(timings) * 1000:.1f} ms, "
+          f"{values['reminders'].sum():,.0f} reminders, peak {values['reminders'].max():,.0f}/hour")
+
+def main():
+    parser = argparse.ArgumentParser(description="リマインダーの送信数の予測")
+    parser.add_argument("--bot-id", help="対象企業のbot_id（省略時は全企業）")
+    parser.add_argument("--days", type=int, default=14)
+    parser.add_argument("--response-rate", type=float, help="回答率（省略時は直近の実績から推定）")
+    parser.add_argument("--response-lag-hours", type=int, default=DEFAULT_RESPONSE_LAG_HOURS)
+    parser.add_argument("--granularity", choices=("hour", "day"), default="day")
+    parser.add_argument("--no-quota", action="store_true", help="LINEの月間通数を問い合わせない")
+    parser.add_argument("--benchmark", action="store_true", help="合成データで計算時間を測る")
+    parser.add_argument("--users", type=int, default=1000000, help="ベンチマークのユーザー数")
+    args = parser.parse_args()
+
+    if args.benchmark:
+        run_benchmark(args.users, args.days)
+        return
+
+    from config import DATABASE_URL, DATABASE_READ_URL, BOT_CONFIGS, get_line_client
+    from db_models import get_read_session, Company
+    from quota import message_quota
+
+    with get_read_session(DATABASE_URL, DATABASE_READ_URL) as session:
+        query = session.query(Company).order_by(Company.id)
+        if args.bot_id:
+            query = query.filter_by(bot_id=args.bot_id)
+        companies = query.all()
+        if not companies:
+            print(f"Company not found for bot_id: {args.bot_id}")
+            return
+        quotas = {}
+        for company in companies:
+            if args.no_quota or company.bot_id not in BOT_CONFIGS:
+                continue
+            try:
+                quotas[company.bot_id] = message_quota(get_line_client(company.bot_id))
+            except Exception as e:
+                print(f"Failed to get message quota for {company.bot_id}: {e}")
+        started = time.perf_counter()
+        result = forecast_reminders(session, companies, min(args.days, MAX_FORECAST_DAYS),
+                                    response_rate=args.response_rate, response_lag_hours=args.response_lag_hours,
+                                    quotas=quotas, granularity=args.granularity)
+        elapsed = time.perf_counter() - started
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    print(f"Forecast for {len(companies)} tenant(s) computed in {elapsed * 1000:.0f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+# history_export.py
+"""
+運動履歴（exercise_history + users）の分析用一括エクスポート
+
+サーバーサイドカーソルでチャンクごとに読み出し、企業×月ごとのパーティションに
+列指向形式で書き出す。メモリ使用量はチャンクサイズ分で一定。
+
+    python history_export.py --out ./export                   # Parquet（pyarrowがなければCSV.gz）
+    python history_export.py --out ./export --format arrow --bot-id company3
+    python history_export.py --out ./export --format csv --since 2025-10-01
+
+出力先: <out>/bot_id=<bot_id>/month=<YYYY-MM>/history.<parquet|arrows|csv.gz>
+Arrowはバッチごとに辞書を置き換えられるIPCストリーム形式（.arrows）で出力する。
+Parquet/Arrowの出力には pyarrow が必要（pip install pyarrow）。
+"""
+import os
+import csv
+import gzip
+import zlib
+import io
+import argparse
+from datetime import datetime
+from sqlalchemy import select
+from db_models import ExerciseHistory, User, Company
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# 出力する列（名前, SQLAlchemyの列）
+EXPORT_COLUMNS = [
+    ("id", ExerciseHistory.id),
+    ("bot_id", Company.bot_id),
+    ("line_user_id", User.line_user_id),
+    ("response_date", ExerciseHistory.response_date),
+    ("response_days", ExerciseHistory.response_days),
+    ("response_text", ExerciseHistory.response_text),
+    ("week_number", ExerciseHistory.week_number),
+    ("foot_check_result", ExerciseHistory.foot_check_result),
+]
+COLUMN_NAMES = [name for name, _ in EXPORT_COLUMNS]
+
+DEFAULT_CHUNK_SIZE = 50000
+
+def arrow_schema():
+    """列指向形式のスキーマ（値の種類が少ない文字列は辞書エンコード）"""
+    return pa.schema([
+        ("id", pa.int64()),
+        ("bot_id", pa.dictionary(pa.int32(), pa.string())),
+        ("line_user_id", pa.string()),
+        ("response_date", pa.timestamp("us")),
+        ("response_days", pa.int8()),
+        ("response_text", pa.dictionary(pa.int32(), pa.string())),
+        ("week_number", pa.int16()),
+        ("foot_check_result", pa.dictionary(pa.int32(), pa.string())),
+    ])
+
+def default_format():
+    return "parquet" if pa is not None else "csv"
+
+def history_query(bot_id=None, since=None, until=None):
+    """エクスポート対象のSELECT（企業・日時順に並べ、パーティションを順番に書けるようにする）"""
+    stmt = select(*[column for _, column in EXPORT_COLUMNS]) \
+        .join(User, ExerciseHistory.user_id == User.id) \
+        .join(Company, ExerciseHistory.company_id == Company.id) \
+        .order_by(Company.bot_id, ExerciseHistory.response_date, ExerciseHistory.id)
+    if bot_id:
+        stmt = stmt.where(Company.bot_id == bot_id)
+    if since:
+        stmt = stmt.where(ExerciseHistory.response_date >= since)
+    if until:
+        stmt = stmt.where(ExerciseHistory.response_date < until)
+    return stmt
+
+def iter_history_chunks(session, bot_id=None, since=None, until=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """サーバーサイドカーソルから行をチャンク（行のリスト）単位で返す"""
+    # ORMを通さずCoreの結果をそのまま読む（行ごとのオーバーヘッドを減らす）
+    connection = session.connection().execution_options(stream_results=True, max_row_buffer=chunk_size)
+    result = connection.execute(history_query(bot_id, since, until))
+    for rows in result.partitions(chunk_size):
+        yield rows
+
+def rows_to_columns(rows):
+    """行のリストを列ごとのリストに変換"""
+    return {name: [row[i] for row in rows] for i, name in enumerate(COLUMN_NAMES)}
+
+def rows_to_record_batch(rows):
+    """行のリストをArrowのRecordBatchに変換"""
+    schema = arrow_schema()
+    columns = rows_to_columns(rows)
+    arrays = []
+    for field in schema:
+        values = columns[field.name]
+        if pa.types.is_dictionary(field.type):
+            arrays.append(pa.array(values, type=pa.string()).dictionary_encode().cast(field.type))
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+def split_by_partition(rows):
+    """チャンクを (bot_id, YYYY-MM) ごとに分ける（入力は企業・日時順）"""
+    bot_index = COLUMN_NAMES.index("bot_id")
+    date_index = COLUMN_NAMES.index("response_date")
+    current_key = None
+    current_rows = []
+    for row in rows:
+        response_date = row[date_index]
+        key = (row[bot_index], response_date.year, response_date.month)
+        if key != current_key and current_rows:
+            yield _partition_key(current_key), current_rows
+            current_rows = []
+        current_key = key
+        current_rows.append(row)
+    if current_rows:
+        yield _partition_key(current_key), current_rows
+
+def _partition_key(key):
+    bot_id, year, month = key
+    return bot_id, f"{year:04d}-{month:02d}"
+
+class PartitionedWriter:
+    """企業×月のパーティションごとにファイルを書き出す"""
+
+    extensions = {"parquet": "parquet", "arrow": "arrows", "csv": "csv.gz"}
+
+    def __init__(self, out_dir, fmt):
+        if fmt in ("parquet", "arrow") and pa is None:
+            raise RuntimeError("pyarrow is required for parquet/arrow export (pip install pyarrow)")
+        self.out_dir = out_dir
+        self.fmt = fmt
+        self.writers = {}  # (bot_id, month) -> (writer, file)
+        self.row_counts = {}
+
+    def path_for(self, bot_id, month):
+        directory = os.path.join(self.out_dir, f"bot_id={bot_id}", f"month={month}")
+        os.makedirs(directory, exist_ok=True)
+        return os.path.join(directory, f"history.{self.extensions[self.fmt]}")
+
+    def _open(self, key):
+        path = self.path_for(*key)
+        if self.fmt == "parquet":
+            return pq.ParquetWriter(path, arrow_schema(), compression="zstd"), None
+        if self.fmt == "arrow":
+            sink = pa.OSFile(path, "wb")
+            return pa.ipc.new_stream(sink, arrow_schema()), sink
+        f = gzip.open(path, "wt", newline="", encoding="utf-8")
+        writer = csv.writer(f)
+        writer.writerow(COLUMN_NAMES)
+        return writer, f
+
+    def write(self, key, rows):
+        if key not in self.writers:
+            # 入力は企業・日時順なので、新しいパーティションが来たら前のものは閉じてよい
+            self.close()
+            self.writers[key] = self._open(key)
+        writer, _ = self.writers[key]
+        if self.fmt == "csv":
+            writer.writerows(_csv_row(row) for row in rows)
+        else:
+            writer.write_batch(rows_to_record_batch(rows))
+        self.row_counts[key] = self.row_counts.get(key, 0) + len(rows)
+
+    def close(self):
+        for writer, f in self.writers.values():
+            if self.fmt in ("parquet", "arrow"):
+                writer.close()
+            if f is not None:
+                f.close()
+        self.writers = {}
+
+def _csv_row(row):
+    return [value.isoformat() if isinstance(value, datetime) else value for value in row]
+
+def export_history(session, out_dir, fmt=None, bot_id=None, since=None, until=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    運動履歴をパーティション分割してファイルに書き出す
+    :return: {(bot_id, YYYY-MM): 行数}
+    """
+    writer = PartitionedWriter(out_dir, fmt or default_format())
+    try:
+        for rows in iter_history_chunks(session, bot_id, since, until, chunk_size):
+            for key, partition_rows in split_by_partition(rows):
+                writer.write(key, partition_rows)
+    finally:
+        writer.close()
+    return writer.row_counts
+
+class _ChunkSink(io.RawIOBase):
+    """Arrow IPCの書き出し先。書かれたバイト列をためておき、まとめて取り出す"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def stream_history(session_factory, fmt, bot_id=None, since=None, until=None, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    HTTPレスポンス用に、1つのストリーム（Arrow IPC または gzip CSV）としてバイト列を順に返す
+    :param session_factory: DBセッションのコンテキストマネージャーを返す関数
+    """
+    with session_factory() as session:
+        chunks = iter_history_chunks(session, bot_id, since, until, chunk_size)
+        if fmt == "arrow":
+            sink = _ChunkSink()
+            writer = pa.ipc.new_stream(sink, arrow_schema())
+            for rows in chunks:
+                writer.write_batch(rows_to_record_batch(rows))
+                yield sink.drain()
+            writer.close()
+            yield sink.drain()
+        else:
+            compressor = zlib.compressobj(wbits=31)  # gzip形式
+            buffer = io.StringIO()
+            writer = csv.writer(buffer)
+            writer.writerow(COLUMN_NAMES)
+            for rows in chunks:
+                writer.writerows(_csv_row(row) for row in rows)
+                yield compressor.compress(buffer.getvalue().encode("utf-8"))
+                buffer.seek(0)
+                buffer.truncate()
+            yield compressor.compress(buffer.getvalue().encode("utf-8")) + compressor.flush()
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%d") if value else None
+
+def main():
+    from config import DATABASE_URL, DATABASE_READ_URL
+    from db_models import get_read_session
+
+    parser = argparse.ArgumentParser(description="運動履歴を列指向形式でエクスポートする")
+    parser.add_argument("--out", required=True, help="出力ディレクトリ")
+    parser.add_argument("--format", choices=["parquet", "arrow", "csv"], default=default_format())
+    parser.add_argument("--bot-id", help="対象企業のbot_id（省略時は全企業）")
+    parser.add_argument("--since", help="開始日 YYYY-MM-DD（含む）")
+    parser.add_argument("--until", help="終了日 YYYY-MM-DD（含まない）")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    started = datetime.utcnow()
+    with get_read_session(DATABASE_URL, DATABASE_READ_URL) as session:
+        counts = export_history(
+            session, args.out, args.format, args.bot_id,
+            parse_date(args.since), parse_date(args.until), args.chunk_size
+        )
+    elapsed = (datetime.utcnow() - started).total_seconds()
+    for (bot_id, month), count in sorted(counts.items()):
+        print(f"  {bot_id} {month}: {count} rows")
+    print(f"Exported {sum(counts.values())} rows in {len(counts)} partition(s) to {args.out} ({elapsed:.1f}s)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+# job_runs.py
+"""
+スケジューラーのジョブの実行履歴（scheduler_runs）
+
+    with job_run("individual_reminder") as run:
+        if run is None:
+            return  # 他のワーカーが実行中
+        run.start_tenant("company3", due=120)
+        ...
+        run.finish_tenant("company3", queued=118, failed=2)
+
+- 同じジョブはPostgreSQLのadvisory lockで1つのワーカーだけが実行する。
+  ロックを取れなかった実行は status=skipped として記録する
+- 企業ごとの件数と所要時間は処理が終わるたびに stats に書き込むので、
+  実行中の進捗も /admin/scheduler で確認できる
+- 履歴の記録に失敗してもジョブ自体は止めない
+"""
+import os
+import time
+import socket
+import threading
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from sqlalchemy import text, select, update, delete
+from db_models import (SchedulerRun, get_engine, get_db_session,
+                       RUN_RUNNING, RUN_SUCCEEDED, RUN_FAILED, RUN_SKIPPED)
+from metrics import metrics
+from config import DATABASE_URL
+
+metrics.describe("scheduler_runs_total", "counter", "Scheduler job runs by status (succeeded, failed, skipped)")
+metrics.describe("scheduler_run_duration_seconds", "gauge", "Duration of the last finished scheduler job run")
+
+JOB_LOCK_CLASS = 7302  # pg_advisory_lock(クラス, hashtext(ジョブ名))
+
+# このプロセスで実行中のジョブ（id(JobRun) -> JobRun）
+current_runs = {}
+current_runs_lock = threading.Lock()
+
+def worker_name():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class JobRun:
+    """1回の実行の進捗（企業ごとの件数と合計）"""
+
+    def __init__(self, engine, job):
+        self.engine = engine
+        self.job = job
+        self.id = None
+        self.started_at = datetime.utcnow()
+        self.started = time.monotonic()
+        self.tenants = {}
+        self.extra = {}
+        self.current_tenant = None
+        self.tenant_started = None
+        self.lock = threading.Lock()
+
+    def start_tenant(self, bot_id, **counts):
+        """企業の処理を開始（due など処理前に分かる件数を渡す）"""
+        with self.lock:
+            self.current_tenant = bot_id
+            self.tenant_started = time.monotonic()
+            self.tenants[bot_id] = dict(counts)
+        self.save()
+
+    def finish_tenant(self, bot_id, error=None, **counts):
+        """企業の処理を終了（queued / failed などの件数を渡す）"""
+        with self.lock:
+            seconds = time.monotonic() - self.tenant_started if self.tenant_started else None
+            tenant = self.tenants.setdefault(bot_id, {})
+            tenant.update(counts)
+            if seconds is not None:
+                tenant["seconds"] = round(seconds, 3)
+                done = tenant.get("queued", 0) + tenant.get("failed", 0)
+                tenant["users_per_second"] = round(done / seconds, 1) if seconds > 0 else None
+            if error is not None:
+                tenant["error"] = str(error)[:200]
+            self.current_tenant = None
+            self.tenant_started = None
+        self.save()
+
+    def set(self, key, value):
+        """企業以外の集計（アウトボックスの送信結果など）"""
+        with self.lock:
+            self.extra[key] = value
+
+    def stats(self):
+        with self.lock:
+            totals = {}
+            for tenant in self.tenants.values():
+                for key in ("due", "queued", "failed"):
+                    if key in tenant:
+                        totals[key] = totals.get(key, 0) + tenant[key]
+            if self.tenants:
+                elapsed = time.monotonic() - self.started
+                done = totals.get("queued", 0) + totals.get("failed", 0)
+                totals["users_per_second"] = round(done / elapsed, 1) if elapsed > 0 else None
+            return {
+                "tenants": {bot_id: dict(tenant) for bot_id, tenant in self.tenants.items()},
+                "totals": totals,
+                "current_tenant": self.current_tenant,
+                **self.extra,
+            }
+
+    def elapsed_ms(self):
+        return int((time.monotonic() - self.started) * 1000)
+
+    def save(self, **values):
+        """stats（と渡された列）を scheduler_runs に書き込む"""
+        if self.id is None:
+            return
+        try:
+            with self.engine.begin() as conn:
+                conn.execute(update(SchedulerRun).where(SchedulerRun.id == self.id).values(stats=self.stats(), **values))
+        except Exception as e:
+            print(f"Failed to save scheduler run {self.job}#{self.id}: {e}")
+
+    def snapshot(self):
+        """/admin/scheduler 用：実行中の進捗"""
+        return {
+            "id": self.id,
+            "job": self.job,
+            "started_at": self.started_at.isoformat(),
+            "elapsed_ms": self.elapsed_ms(),
+            "stats": self.stats(),
+        }
+
+def _insert_run(engine, job, status, started_at, **values):
+    with engine.begin() as conn:
+        return conn.execute(
+            SchedulerRun.__table__.insert().values(
+                job=job, status=status, worker=worker_name(), started_at=started_at, stats={}, **values
+            ).returning(SchedulerRun.id)
+        ).scalar()
+
+def record_skipped(job, reason):
+    """実行しなかったジョブを記録する"""
+    print(f"Scheduler job {job} skipped: {reason}")
+    metrics.inc("scheduler_runs_total", job=job, status=RUN_SKIPPED)
+    engine = get_engine(DATABASE_URL)
+    try:
+        now = datetime.utcnow()
+        _insert_run(engine, job, RUN_SKIPPED, now, finished_at=now, duration_ms=0, error=reason)
+    except Exception as e:
+        print(f"Failed to record skipped run {job}: {e}")
+    finally:
+        engine.dispose()
+
+@contextmanager
+def job_run(job, exclusive=True):
+    """
+    ジョブの実行を記録する
+    exclusive=True の場合、他のワーカーで実行中なら記録だけして None を渡す
+    """
+    engine = get_engine(DATABASE_URL)
+    lock_conn = None
+    try:
+        if exclusive:
+            lock_conn = engine.connect()
+            locked = lock_conn.execute(
+                text("SELECT pg_try_advisory_lock(:cls, hashtext(:job))"), {"cls": JOB_LOCK_CLASS, "job": job}
+            ).scalar()
+            lock_conn.commit()
+            if not locked:
+                record_skipped(job, "locked by another worker")
+                yield None
+                return
+
+        run = JobRun(engine, job)
+        try:
+            run.id = _insert_run(engine, job, RUN_RUNNING, run.started_at)
+        except Exception as e:
+            print(f"Failed to record scheduler run {job}: {e}")
+        with current_runs_lock:
+            current_runs[id(run)] = run
+        try:
+            yield run
+        except Exception as e:
+            run.save(status=RUN_FAILED, finished_at=datetime.utcnow(), duration_ms=run.elapsed_ms(),
+                     error=f"{type(e).__name__}: {e}"[:255])
+            metrics.inc("scheduler_runs_total", job=job, status=RUN_FAILED)
+            raise
+        else:
+            run.save(status=RUN_SUCCEEDED, finished_at=datetime.utcnow(), duration_ms=run.elapsed_ms())
+            metrics.inc("scheduler_runs_total", job=job, status=RUN_SUCCEEDED)
+        finally:
+            with current_runs_lock:
+                current_runs.pop(id(run), None)
+            metrics.set_gauge("scheduler_run_duration_seconds", round(run.elapsed_ms() / 1000, 3), job=job)
+            print(f"Scheduler job {job} finished in {run.elapsed_ms()} ms: {run.stats()['totals']}")
+    finally:
+        if lock_conn is not None:
+            lock_conn.close()  # 接続を閉じるとadvisory lockも解放される
+        engine.dispose()
+
+def recent_runs(session, job=None, limit=20):
+    """最近の実行履歴（新しい順）"""
+    stmt = select(SchedulerRun).order_by(SchedulerRun.started_at.desc(), SchedulerRun.id.desc()).limit(limit)
+    if job:
+        stmt = stmt.where(SchedulerRun.job == job)
+    return session.execute(stmt).scalars().all()
+
+def run_to_dict(run):
+    return {
+        "id": run.id,
+        "job": run.job,
+        "status": run.status,
+        "worker": run.worker,
+        "started_at": run.started_at.isoformat() if run.started_at else None,
+        "finished_at": run.finished_at.isoformat() if run.finished_at else None,
+        "duration_ms": run.duration_ms,
+        "stats": run.stats,
+        "error": run.error,
+    }
+
+def job_summary(session, since):
+    """ジョブごとの件数と所要時間（since 以降）"""
+    rows = session.execute(text(
+        "SELECT job, status, count(*), avg(duration_ms), max(duration_ms) "
+        "FROM scheduler_runs WHERE started_at >= :since GROUP BY job, status"
+    ), {"since": since}).all()
+    summary = {}
+    for job, status, count, avg_ms, max_ms in rows:
+        entry = summary.setdefault(job, {"runs": {}})
+        entry["runs"][status] = count
+        if status == RUN_SUCCEEDED:
+            entry["avg_duration_ms"] = int(avg_ms) if avg_ms is not None else None
+            entry["max_duration_ms"] = max_ms
+    return summary
+
+def running_snapshot():
+    """このプロセスで実行中のジョブの進捗"""
+    with current_runs_lock:
+        runs = list(current_runs.values())
+    return [run.snapshot() for run in runs]
+
+def prune_runs(retention_days, now=None):
+    """保持期間を過ぎた実行履歴を削除する"""
+    cutoff = (now or datetime.utcnow()) - timedelta(days=retention_days)
+    with get_db_session(DATABASE_URL) as session:
+        deleted = session.execute(delete(SchedulerRun).where(SchedulerRun.started_at < cutoff)).rowcount
+        session.commit()
+        return deleted
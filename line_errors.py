@@ -0,0 +1,132 @@
+# line_errors.py
+"""
+LINE Messaging APIの送信エラーの分類と送信結果
+
+送信の失敗を次の3つに分け、リトライするかどうかを決める。
+
+- RETRYABLE: ネットワークエラー・タイムアウト・5xx（時間をおけば成功する可能性がある）
+- RETRY_AFTER: 429のレート制限（Retry-Afterの秒数以上待ってから送り直す）
+- PERMANENT: 無効なreply token・認証エラー・友だちでない・月間通数の上限・その他の4xx
+  （何度送っても成功しないので、すぐにあきらめる）
+
+理由（reason）はステータスとレスポンス本文のメッセージから判定する。
+
+    result = send_line_message(api, "reply", reply_token, messages, bot_id=bot_id)
+    if not result and result.reply_token_unusable:
+        ...  # pushで送り直す
+"""
+import re
+import socket
+from requests.exceptions import RequestException, Timeout
+from urllib3.exceptions import ProtocolError, HTTPError, TimeoutError as Urllib3Timeout
+
+# 分類
+RETRYABLE = "retryable"
+RETRY_AFTER = "retry_after"
+PERMANENT = "permanent"
+
+# 理由
+REASON_NETWORK = "network"
+REASON_TIMEOUT = "timeout"
+REASON_SERVER_ERROR = "server_error"
+REASON_RATE_LIMITED = "rate_limited"
+REASON_QUOTA_EXCEEDED = "quota_exceeded"          # 429 月間通数の上限
+REASON_INVALID_REPLY_TOKEN = "invalid_reply_token"  # 400 使用済み・期限切れのreply token
+REASON_UNREACHABLE = "unreachable"                # 友だちでない（ブロックされた・友だち追加されていない）
+REASON_AUTH = "auth"                              # 401/403 アクセストークンの失効など
+REASON_CONFLICT = "conflict"                      # 409 同じretry keyで受付済み
+REASON_BAD_REQUEST = "bad_request"                # その他の4xx
+REASON_UNEXPECTED = "unexpected"                  # HTTPステータスのない想定外の例外
+# 送信しなかった場合（send_line_message の結果のみ）
+REASON_TOKEN_REUSED = "token_reused"
+REASON_CIRCUIT_OPEN = "circuit_open"
+REASON_DEADLINE_EXCEEDED = "deadline_exceeded"
+
+NETWORK_ERRORS = (RequestException, ConnectionError, ProtocolError, HTTPError, socket.error)
+TIMEOUT_ERRORS = (Timeout, socket.timeout, Urllib3Timeout)
+
+UNREACHABLE_PATTERN = re.compile(r"not a friend|hasn't added|has not added|blocked|unfollow", re.IGNORECASE)
+
+class ErrorClass:
+    """1回の送信エラーの分類"""
+    __slots__ = ("kind", "reason", "status", "retry_after")
+
+    def __init__(self, kind, reason, status=None, retry_after=None):
+        self.kind = kind
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.kind != PERMANENT
+
+def _retry_after_seconds(error):
+    headers = getattr(error, "headers", None) or {}
+    value = headers.get("Retry-After") or headers.get("retry-after")
+    return int(value) if str(value).isdigit() else None
+
+def classify_error(error):
+    """例外（ApiException・ネットワークエラー）を ErrorClass にする"""
+    status = getattr(error, "status", None)
+    if not isinstance(status, int):
+        if isinstance(error, TIMEOUT_ERRORS) or "timed out" in str(error).lower():
+            return ErrorClass(RETRYABLE, REASON_TIMEOUT)
+        if isinstance(error, NETWORK_ERRORS):
+            return ErrorClass(RETRYABLE, REASON_NETWORK)
+        return ErrorClass(PERMANENT, REASON_UNEXPECTED)
+
+    body = str(getattr(error, "body", "") or "")
+    if status >= 500:
+        return ErrorClass(RETRYABLE, REASON_SERVER_ERROR, status)
+    if status == 429:
+        if "monthly limit" in body.lower():
+            return ErrorClass(PERMANENT, REASON_QUOTA_EXCEEDED, status)
+        return ErrorClass(RETRY_AFTER, REASON_RATE_LIMITED, status, _retry_after_seconds(error))
+    if status == 400 and "reply token" in body.lower():
+        return ErrorClass(PERMANENT, REASON_INVALID_REPLY_TOKEN, status)
+    if status in (400, 403) and UNREACHABLE_PATTERN.search(body):
+        return ErrorClass(PERMANENT, REASON_UNREACHABLE, status)
+    if status in (401, 403):
+        return ErrorClass(PERMANENT, REASON_AUTH, status)
+    if status == 409:
+        return ErrorClass(PERMANENT, REASON_CONFLICT, status)
+    return ErrorClass(PERMANENT, REASON_BAD_REQUEST, status)
+
+class SendResult:
+    """send_line_message の結果（真偽値としては送信に成功したかどうか）"""
+    __slots__ = ("ok", "kind", "reason", "status", "attempts", "error")
+
+    def __init__(self, ok, kind=None, reason=None, status=None, attempts=0, error=None):
+        self.ok = ok
+        self.kind = kind
+        self.reason = reason
+        self.status = status
+        self.attempts = attempts
+        self.error = error
+
+    def __bool__(self):
+        return self.ok
+
+    def __repr__(self):
+        if self.ok:
+            return f"SendResult(ok, attempts={self.attempts})"
+        return f"SendResult({self.kind}, {self.reason}, status={self.status}, attempts={self.attempts})"
+
+    @property
+    def reply_token_unusable(self):
+        """reply tokenが使えなくなった（無効・期限切れ）ための失敗か"""
+        return self.reason in (REASON_INVALID_REPLY_TOKEN, REASON_DEADLINE_EXCEEDED)
+
+    @classmethod
+    def sent(cls, attempts):
+        return cls(True, attempts=attempts)
+
+    @classmethod
+    def skipped(cls, reason, attempts=0):
+        """送信しなかった（reply tokenの再利用・ブレーカーがopen・期限切れ）"""
+        return cls(False, PERMANENT, reason, attempts=attempts)
+
+    @classmethod
+    def failed(cls, error_class, attempts, error):
+        return cls(False, error_class.kind, error_class.reason, error_class.status, attempts, error)
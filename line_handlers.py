@@ -1,21 +1,23 @@
 import re
 from datetime import datetime
 from sqlalchemy.exc import SQLAlchemyError
-from linebot.v3.webhooks import FollowEvent, MessageEvent, TextMessageContent
+from sqlalchemy.orm.exc import StaleDataError
+from linebot.v3.webhooks import FollowEvent, UnfollowEvent, MessageEvent, TextMessageContent
 from linebot.v3.messaging import TextMessage, ImageMessage
-from db_models import User, get_db_session, Company
-from utils import send_line_message, log_message, log_error
-from config import get_line_client, get_webhook_handler, BOT_CONFIGS, DATABASE_URL
+from db_models import User, get_db_session, Company, LogEvent, upsert_users
+from utils import log_error
+from unit_of_work import EventUnitOfWork
+from user_state_cache import user_state_cache, user_from_state
+from bulkhead import webhook_bulkhead
+from circuit_breaker import get_breaker, is_breaker_failure
+from config import get_line_client, get_webhook_handler, BOT_CONFIGS, DATABASE_URL, LINE_HTTP_TIMEOUT
 
 # 各bot_idに対応するハンドラを保持する辞書
 handlers = {}
 
-# 各bot_idに対応するLINE APIクライアントを保持する辞書
-line_clients = {}
-
 def setup_handlers():
     """全てのBot用のハンドラーをセットアップする"""
-    global handlers, line_clients
+    global handlers
     
     for bot_id in BOT_CONFIGS:
         # ハンドラーとクライアントを取得
@@ -31,6 +33,10 @@ def setup_handlers():
             @handler.add(FollowEvent)
             def handle_follow(event):
                 handle_follow_event(event, current_bot_id)
+
+            @handler.add(UnfollowEvent)
+            def handle_unfollow(event):
+                handle_unfollow_event(event, current_bot_id)
                 
             @handler.add(MessageEvent)
             def handle_message(event):
@@ -42,7 +48,6 @@ def setup_handlers():
         
         # 辞書に保存
         handlers[bot_id] = handler
-        line_clients[bot_id] = line_client
         
         print(f"Set up handler for bot_id: {bot_id}")
     
@@ -55,179 +60,282 @@ def get_handler(bot_id):
     return handlers[bot_id]
 
 def get_api(bot_id):
-    """指定されたbot_idのLINE APIクライアントを取得"""
-    if bot_id not in line_clients:
-        line_clients[bot_id] = get_line_client(bot_id)
-    return line_clients[bot_id]
+    """指定されたbot_idのLINE APIクライアントを取得（config側でプロセス内共有）"""
+    return get_line_client(bot_id)
+
+def fetch_display_name(api, line_user_id, bot_id=None):
+    """LINEプロフィールから表示名を取得（失敗時・ブレーカーがopenの間はNone）"""
+    breaker = get_breaker(bot_id, "profile") if bot_id else None
+    if breaker and not breaker.allow():
+        return None
+    try:
+        profile = api.get_profile(user_id=line_user_id, _request_timeout=LINE_HTTP_TIMEOUT)
+        if breaker:
+            breaker.record_success()
+        return profile.display_name
+    except Exception as e:
+        print(f"プロフィール取得エラー: {e}")
+        if breaker:
+            if getattr(e, "status", None) is None or is_breaker_failure(e):
+                breaker.record_failure(e)
+            else:
+                breaker.record_success()
+        return None
+
+def refresh_username(uow, user):
+    """プロフィールの表示名でユーザー名を更新（コミットはしない）"""
+    username = fetch_display_name(uow.api, user.line_user_id, uow.bot_id)
+    if username and username != user.username:
+        user.username = username
+        uow.touch_company(user.company_id)
+        print(f"ユーザー名を更新しました: {username}")
+    return username or user.username  # 取得失敗時はデータベースの既存値を使用
+
+def handle_webhook(bot_id, body, signature):
+    """Webhookペイロード全体を1回でパースし、含まれるイベントをまとめて処理する"""
+    handler = get_handler(bot_id)
+    if not handler:
+        raise ValueError(f"Handler not found for bot_id: {bot_id}")
+    events = handler.parser.parse(body, signature)  # 署名不正の場合はInvalidSignatureError
+    # 企業ごとの同時実行数の枠を確保してから処理（確保できなければBulkheadRejected）
+    with webhook_bulkhead.slot(bot_id):
+        handle_events(events, bot_id)
+
+def is_supported_event(event):
+    """このBotが処理するイベントかどうか"""
+    if isinstance(event, (FollowEvent, UnfollowEvent)):
+        return True
+    return isinstance(event, MessageEvent) and isinstance(event.message, TextMessageContent)
+
+def handle_events(events, bot_id, use_cache=True):
+    """
+    複数イベントを1つのセッションで処理する
+
+    関係するユーザーはユーザー状態キャッシュにあればそれを使い、残りをIN句1回でまとめて取得する。
+    ログ・履歴は1回のコミットで書き込む。
+    イベントはペイロード内の順序どおりに処理するため、ユーザーごとの順序は保たれる。
+    キャッシュの状態が古かった場合（StaleDataError）はキャッシュを使わずに処理し直す。
+    途中でエラーになった場合はバッチ全体をロールバックし、1件ずつ処理し直す。
+    """
+    events = [e for e in events if is_supported_event(e)]
+    if not events:
+        return
+    print(f"Processing {len(events)} event(s) for bot_id: {bot_id}")
+    retry_without_cache = False
 
-def handle_follow_event(event, bot_id):
-    """友だち追加イベントの処理"""
-    print(f"Processing follow event for bot_id: {bot_id}, user: {event.source.user_id}")
     with get_db_session(DATABASE_URL) as session:
         try:
-            user_id = event.source.user_id
             api = get_api(bot_id)  # 重要：該当botのAPIクライアントを使用
-            
+            uow = EventUnitOfWork(session, api, bot_id)
+            uow.register_events(events)  # 返信の期限
+
             # 企業情報を取得
             company = session.query(Company).filter_by(bot_id=bot_id).first()
             if not company:
                 print(f"Company not found for bot_id: {bot_id}")
                 return
-            
-            # ユーザープロフィールの取得
-            try:
-                profile = api.get_profile(user_id=user_id)
-                username = profile.display_name
-            except Exception as e:
-                print(f"Failed to get user profile: {e}")
-                username = "Unknown User"
-
-            # この企業とLINE IDの組み合わせでユーザーを検索
-            user = session.query(User).filter_by(
-                line_user_id=user_id,
-                company_id=company.id
-            ).first()
-            
-            if not user:
-                # 新規ユーザー登録
-                user = User(
-                    line_user_id=user_id,
-                    username=username,
-                    company_id=company.id
-                )
-                session.add(user)
-                session.commit()
-                log_message(session, user, "system", f"新規ユーザー登録: {username}")
-
-                # ユーザー名と企業名を含むメッセージを送信
-                message = f"{username}さん、{company.name}の足健康プログラムへようこそ！\n足の健康チェックを始めましょう。"
-                send_line_message(api, "reply", event.reply_token, [TextMessage(text=message)], user, session, bot_id)
-                log_message(session, user, "sent", "ウェルカムメッセージ送信")
-            else:
-                log_message(session, user, "system", f"既存ユーザー: {username}")
-                # 既存ユーザーの場合もウェルカムメッセージを送信
-                message = f"{username}さん、またお会いできて嬉しいです！\n{company.name}の足健康プログラムを再開しましょう。"
-                send_line_message(api, "reply", event.reply_token, [TextMessage(text=message)], user, session, bot_id)
+            uow.company = company
 
+            # キャッシュにないユーザーだけ、この企業とLINE IDの組み合わせでまとめて検索
+            # 友だち追加・ブロックのユーザーは、pushの失敗で無効にされた状態（active）を確実に読むためDBから読み込む
+            line_user_ids = {e.source.user_id for e in events}
+            follow_ids = {e.source.user_id for e in events if isinstance(e, (FollowEvent, UnfollowEvent))}
+            cached = user_state_cache.get_many(company.id, line_user_ids - follow_ids) if use_cache else {}
+            users = {line_user_id: user_from_state(session, state) for line_user_id, state in cached.items()}
+            missing_ids = line_user_ids - users.keys()
+            if missing_ids:
+                users.update({
+                    u.line_user_id: u
+                    for u in session.query(User).filter(
+                        User.company_id == company.id,
+                        User.line_user_id.in_(missing_ids)
+                    )
+                })
+
+            # 未登録のユーザーは1回のupsertでまとめて作成（同時配信でも一意制約違反にならない）
+            # ブロックだけのユーザーは作成しない
+            new_user_ids = {e.source.user_id for e in events if not isinstance(e, UnfollowEvent)} - users.keys()
+            if new_user_ids:
+                usernames = {
+                    line_user_id: fetch_display_name(api, line_user_id, bot_id) or "Unknown User"
+                    for line_user_id in new_user_ids
+                }
+                upserted, created_ids = upsert_users(session, company.id, usernames)
+                users.update(upserted)
+                # 同時に別のワーカーが作成したユーザーは、そちらで新規登録として扱う
+                new_user_ids &= created_ids
+                uow.touch_company(company.id)
+            uow.track_users(users.values())
+
+            for event in events:
+                if isinstance(event, FollowEvent):
+                    process_follow(event, users, new_user_ids, company, uow)
+                elif isinstance(event, UnfollowEvent):
+                    process_unfollow(event, users, uow)
+                else:
+                    process_message(event, users, new_user_ids, company, uow)
+
+            # バッチ内の更新をまとめてコミットし、その後に返信を送信
+            uow.commit()
+            return
+
+        except StaleDataError as e:
+            # 他のワーカーがユーザーを更新していた（キャッシュの状態が古い）
+            log_error("handle_events", e, None, session)
+            user_state_cache.invalidate(company.id, line_user_ids, stale=True)
+            if not use_cache:
+                return
+            print(f"Retrying {len(events)} event(s) without user state cache for bot_id: {bot_id}")
+            retry_without_cache = True
         except Exception as e:
-            log_error("handle_follow", e, None, session)
+            log_error("handle_events", e, None, session)
+            if len(events) == 1:
+                return
+            print(f"Retrying {len(events)} events one by one for bot_id: {bot_id}")
+
+    if retry_without_cache:
+        handle_events(events, bot_id, use_cache=False)
+        return
+    for event in events:
+        handle_events([event], bot_id)
+
+def handle_follow_event(event, bot_id):
+    """友だち追加イベントの処理"""
+    with webhook_bulkhead.slot(bot_id):
+        handle_events([event], bot_id)
+
+def handle_unfollow_event(event, bot_id):
+    """ブロック（友だち解除）イベントの処理"""
+    with webhook_bulkhead.slot(bot_id):
+        handle_events([event], bot_id)
 
 def handle_message_event(event, bot_id):
     """メッセージイベントの処理"""
-    print(f"Processing message event for bot_id: {bot_id}, event: {event.type}, user: {event.source.user_id}")
-    with get_db_session(DATABASE_URL) as session:
-        try:
-            user_id = event.source.user_id
-            text = event.message.text.strip()
-            api = get_api(bot_id)  # 重要：該当botのAPIクライアントを使用
+    with webhook_bulkhead.slot(bot_id):
+        handle_events([event], bot_id)
 
-            # 企業情報を取得
-            company = session.query(Company).filter_by(bot_id=bot_id).first()
-            if not company:
-                print(f"Company not found for bot_id: {bot_id}")
-                return
+def take_new_user(line_user_id, new_user_ids):
+    """このバッチで新規登録したユーザーの最初のイベントならTrueを返す"""
+    if line_user_id in new_user_ids:
+        new_user_ids.discard(line_user_id)
+        return True
+    return False
 
-            # この企業とLINE IDの組み合わせでユーザーを検索
-            user = session.query(User).filter_by(
-                line_user_id=user_id,
-                company_id=company.id
-            ).first()
-            
-            if not user:
-                # 新規ユーザー作成
-                try:
-                    profile = api.get_profile(user_id=user_id)
-                    username = profile.display_name
-                except Exception as e:
-                    print(f"Failed to get user profile: {e}")
-                    username = "Unknown User"
-                    
-                user = User(
-                    line_user_id=user_id,
-                    username=username,
-                    company_id=company.id
-                )
-                session.add(user)
-                session.commit()
-                log_message(session, user, "system", "新規ユーザー登録（メッセージ受信時）")
-
-            # A〜Dのパターンマッチング（大文字小文字、全角半角に対応）
-            foot_check_pattern = re.compile(r'^[aAａＡbBｂＢcCｃＣdDｄＤ]$')
-            if foot_check_pattern.match(text):
-                # 足健診結果の処理
-                process_foot_check_result(event, text, user, company, api, session, bot_id)
-            elif "回" in text or (text.isdigit() and 0 <= int(text) <= 7):
-                # 運動日数の処理（クイックリプライの「0回」「1~3回」「4~7回」または数値）
-                process_exercise_days(event, text, user, company, api, session, bot_id)
-            else:
-                # その他のメッセージ処理
-                process_other_message(event, text, user, company, api, session, bot_id)
+def process_follow(event, users, new_user_ids, company, uow):
+    """友だち追加イベントの処理"""
+    print(f"Processing follow event for bot_id: {uow.bot_id}, user: {event.source.user_id}")
+    user = users[event.source.user_id]
 
-        except Exception as e:
-            log_error("handle_message", e, None, session)
+    if take_new_user(user.line_user_id, new_user_ids):
+        uow.log(user, "system", LogEvent.USER_REGISTERED, "follow")
+        # ユーザー名と企業名を含むメッセージを送信
+        message = f"{user.username}さん、{company.name}の足健康プログラムへようこそ！\n足の健康チェックを始めましょう。"
+        uow.reply(event.reply_token, [TextMessage(text=message)], user, LogEvent.WELCOME_SENT, fallback_push=True)
+    else:
+        uow.log(user, "system", LogEvent.USER_RETURNED)
+        if not user.active:
+            # ブロック解除・再度の友だち追加で配信対象に戻す
+            user.active = True
+            user.unfollowed_at = None
+            uow.touch_company(user.company_id)
+        if uow.reply_expired(event.reply_token):
+            # 再開のあいさつは期限を過ぎたら送らない（プロフィール取得も省く）
+            uow.skip_expired(event.reply_token, user)
+            return
+        username = fetch_display_name(uow.api, user.line_user_id, uow.bot_id) or "Unknown User"
+        # 既存ユーザーの場合もウェルカムメッセージを送信
+        message = f"{username}さん、またお会いできて嬉しいです！\n{company.name}の足健康プログラムを再開しましょう。"
+        uow.reply(event.reply_token, [TextMessage(text=message)], user, LogEvent.RESUME_SENT)
 
-def process_foot_check_result(event, text, user, company, api, session, bot_id):
+def process_unfollow(event, users, uow):
+    """ブロック（友だち解除）イベントの処理：配信対象から外し、送信待ちのpushを取り消す"""
+    from outbox import cancel_pending
+
+    print(f"Processing unfollow event for bot_id: {uow.bot_id}, user: {event.source.user_id}")
+    user = users.get(event.source.user_id)
+    if user is None:
+        return  # 未登録のユーザー
+    user.active = False
+    user.unfollowed_at = datetime.utcfromtimestamp(event.timestamp / 1000)
+    # 取り消したリマインダーは、再度の友だち追加後のスケジューラー実行で作り直される
+    user.question_sent = False
+    cancelled = cancel_pending(uow.session, user.id, "unfollowed")
+    uow.touch_company(user.company_id)
+    uow.log(user, "system", LogEvent.USER_UNFOLLOWED, f"cancelled={cancelled}" if cancelled else None)
+
+def process_message(event, users, new_user_ids, company, uow):
+    """メッセージイベントの処理"""
+    print(f"Processing message event for bot_id: {uow.bot_id}, event: {event.type}, user: {event.source.user_id}")
+    text = event.message.text.strip()
+    user = users[event.source.user_id]
+    if take_new_user(user.line_user_id, new_user_ids):
+        uow.log(user, "system", LogEvent.USER_REGISTERED, "message")
+    dispatch_text_message(event, text, user, company, uow)
+
+def dispatch_text_message(event, text, user, company, uow):
+    """テキストの内容に応じて処理を振り分ける"""
+    # A〜Dのパターンマッチング（大文字小文字、全角半角に対応）
+    foot_check_pattern = re.compile(r'^[aAａＡbBｂＢcCｃＣdDｄＤ]$')
+    if foot_check_pattern.match(text):
+        # 足健診結果の処理
+        process_foot_check_result(event, text, user, company, uow)
+    elif "回" in text or (text.isdigit() and 0 <= int(text) <= 7):
+        # 運動日数の処理（クイックリプライの「0回」「1~3回」「4~7回」または数値）
+        process_exercise_days(event, text, user, company, uow)
+    else:
+        # その他のメッセージ処理
+        process_other_message(event, text, user, company, uow)
+
+def cancel_queued_reminder(user, uow):
+    """
+    回答したユーザーの送信待ちのリマインダーを取り消す
+    （送信時間帯を待っている間に回答すると、古い質問が後から届くため。次のリマインダーは次回の検索で作り直す）
+    """
+    from outbox import cancel_pending
+    if user.id is None or not user.question_sent:
+        return
+    cancelled = cancel_pending(uow.session, user.id, "answered", kind="reminder")
+    if cancelled:
+        uow.log(user, "system", LogEvent.REMINDER_CANCELLED, f"cancelled={cancelled}")
+
+def process_foot_check_result(event, text, user, company, uow):
     """足健診結果の処理"""
     # 入力された文字を大文字の半角に正規化
     normalized_result = text.upper()
     if normalized_result in ['Ａ', 'Ｂ', 'Ｃ', 'Ｄ']:
         normalized_result = normalized_result.translate(str.maketrans('ＡＢＣＤ', 'ABCD'))
     
-    # プロフィール情報を直接取得 - ここを追加
-    try:
-        profile = api.get_profile(user_id=user.line_user_id)
-        username = profile.display_name
-        # ユーザー名を更新
-        if username and username != user.username:
-            user.username = username
-            session.commit()
-            print(f"ユーザー名を更新しました: {username}")
-    except Exception as e:
-        print(f"プロフィール取得エラー: {e}")
-        username = user.username  # データベースの既存値を使用
+    # プロフィール情報を直接取得してユーザー名を更新
+    username = refresh_username(uow, user)
     
     # ユーザー名のフォールバック
     display_name = username if username else "ゲスト"
     
     user.foot_check_result = normalized_result
+    uow.touch_company(user.company_id)
     user.last_program_type = "initial"
     user.current_week = 0  # 初回登録は0週目
+    cancel_queued_reminder(user, uow)
     user.question_sent = False
     user.program_sent_date = datetime.utcnow()  # 日付を更新
-    session.commit()
 
-    log_message(session, user, "received", f"足健診結果: {normalized_result}")
-    log_message(session, user, "system", f"足健診結果を{normalized_result}に更新、0週目に設定")
+    uow.log(user, "received", LogEvent.FOOT_CHECK_RECEIVED, normalized_result)
+    uow.log(user, "system", LogEvent.FOOT_CHECK_UPDATED, f"result={normalized_result} week=0")
 
     # A/B/C/D共通のメッセージ（初回登録時は動画を送らない）
     message = f"{display_name}さん、足健診結果の入力ありがとうございます！1週間後に新しい運動メニューを配信しますので、今日教わった内容を継続しましょう！"
-    success = send_line_message(
-        api, "reply", event.reply_token,
-        [TextMessage(text=message)],
-        user, session, bot_id
-    )
-    if success:
-        log_message(session, user, "sent", "足健診結果受付メッセージ送信")
+    uow.reply(event.reply_token, [TextMessage(text=message)], user, LogEvent.FOOT_CHECK_ACK_SENT, fallback_push=True)
 
-def process_exercise_days(event, text, user, company, api, session, bot_id):
+def process_exercise_days(event, text, user, company, uow):
     """運動日数の処理（クイックリプライからの回答）"""
     from config import (EXERCISE_VIDEO_URLS_AB, EXERCISE_VIDEO_URLS_CD, 
                         EXERCISE_THUMBNAIL_URLS_AB, EXERCISE_THUMBNAIL_URLS_CD,
                         EXERCISE_IMAGE_URLS_AB, EXERCISE_IMAGE_URLS_CD)
     from utils import create_exercise_video_flex_message
+    from db_models import ExerciseHistory
     
-    # プロフィール情報を直接取得
-    try:
-        profile = api.get_profile(user_id=user.line_user_id)
-        username = profile.display_name
-        # ユーザー名を更新
-        if username and username != user.username:
-            user.username = username
-            session.commit()
-            print(f"ユーザー名を更新しました: {username}")
-    except Exception as e:
-        print(f"プロフィール取得エラー: {e}")
-        username = user.username  # データベースの既存値を使用
+    # プロフィール情報を直接取得してユーザー名を更新
+    username = refresh_username(uow, user)
     
     # ユーザー名のフォールバック
     display_name = username if username else "ゲスト"
@@ -235,13 +343,7 @@ def process_exercise_days(event, text, user, company, api, session, bot_id):
     # 足健診結果が未設定の場合は先に入力を促す
     if not user.foot_check_result:
         message = f"{display_name}さん、先に足の健康チェック結果を教えてください。A、B、C、Dのいずれかで回答してください。"
-        success = send_line_message(
-            api, "reply", event.reply_token,
-            [TextMessage(text=message)],
-            user, session, bot_id
-        )
-        if success:
-            log_message(session, user, "sent", "足健診結果入力リクエスト")
+        uow.reply(event.reply_token, [TextMessage(text=message)], user, LogEvent.FOOT_CHECK_REQUEST_SENT)
         return  # ここで処理を終了
     
     # クイックリプライの選択肢を判定
@@ -257,7 +359,7 @@ def process_exercise_days(event, text, user, company, api, session, bot_id):
         response_message = f"{display_name}さん、素晴らしいですね！その調子で継続しましょう。"
     else:
         # 想定外のテキスト（念のため）
-        log_message(session, user, "error", f"想定外の運動回数: {text}")
+        uow.log(user, "error", LogEvent.INVALID_EXERCISE_DAYS, text)
         return
     
     # 週番号の取得と更新
@@ -269,12 +371,13 @@ def process_exercise_days(event, text, user, company, api, session, bot_id):
     
     # データベースを更新
     user.last_response_days = days
+    cancel_queued_reminder(user, uow)
     user.question_sent = False  # 質問に回答したのでフラグをリセット
     user.program_sent_date = datetime.utcnow()  # 日付を更新
     user.last_program_type = "continued"
     
-    log_message(session, user, "received", f"運動回数: {text}")
-    log_message(session, user, "system", f"運動日数を{days}に更新、{current_week}週目の動画を送信")
+    uow.log(user, "received", LogEvent.EXERCISE_DAYS_RECEIVED, text)
+    uow.log(user, "system", LogEvent.EXERCISE_DAYS_UPDATED, f"days={days} week={current_week}")
 
     # 評価結果に応じて動画セットを選択（A/BとC/Dは同じ動画）
     if user.foot_check_result in ['A', 'B']:
@@ -300,63 +403,54 @@ def process_exercise_days(event, text, user, company, api, session, bot_id):
     # Flex Messageを生成
     flex_message = create_exercise_video_flex_message(video_url, thumbnail_url)
     
-    # メッセージ、動画、静止画を送信
-    success = send_line_message(
-        api, "reply", event.reply_token,
+    # 運動履歴を保存（ユーザー更新と同じトランザクション）
+    history = ExerciseHistory(
+        user=user,
+        response_date=datetime.utcnow(),
+        response_days=days,
+        response_text=text,
+        week_number=current_week,
+        foot_check_result=user.foot_check_result,
+        company_id=company.id
+    )
+    uow.session.add(history)
+    uow.record_exercise(history)  # 日次・週次の集計にも加算
+    
+    # 次回の週番号を更新（12週目の次は1週目に戻る）
+    next_week = (current_week % 12) + 1
+    user.current_week = next_week
+    print(f"週番号を{current_week}から{next_week}に更新します")
+    print(f"運動履歴を保存します: {days}回（{text}）")
+    
+    # メッセージ、動画、静止画はコミット後に送信
+    uow.reply(
+        event.reply_token,
         [
             TextMessage(text=response_message), 
             flex_message,
             ImageMessage(original_content_url=image_url, preview_image_url=image_url)
         ],
-        user, session, bot_id
+        user,
+        LogEvent.EXERCISE_MENU_SENT,
+        f"week={current_week}",
+        fallback_push=True  # 今週の運動メニューは期限を過ぎてもpushで届ける
     )
-    if success:
-        log_message(session, user, "sent", f"運動メニュー動画送信（{current_week}週目、{text}）")
-        
-        # 運動履歴を保存
-        from db_models import ExerciseHistory
-        history = ExerciseHistory(
-            user_id=user.id,
-            response_days=days,
-            response_text=text,
-            week_number=current_week,
-            foot_check_result=user.foot_check_result,
-            company_id=user.company_id
-        )
-        session.add(history)
-        
-        # 次回の週番号を更新（12週目の次は1週目に戻る）
-        next_week = (current_week % 12) + 1
-        user.current_week = next_week
-        session.commit()
-        print(f"週番号を{current_week}から{next_week}に更新しました")
-        print(f"運動履歴を保存しました: {days}回（{text}）")
-
-def process_other_message(event, text, user, company, api, session, bot_id):
+
+def process_other_message(event, text, user, company, uow):
     """その他のメッセージ処理"""
     # 一方的なメッセージのログ記録
-    log_message(session, user, "received", f"一方的なメッセージ: {text}")
+    uow.log(user, "received", LogEvent.FREE_TEXT_RECEIVED, text)
+    if uow.reply_expired(event.reply_token):
+        # 案内文は期限を過ぎたら送らない（プロフィール取得も省く）
+        uow.skip_expired(event.reply_token, user)
+        return
     
     # プロフィール情報を取得してユーザー名を更新
-    try:
-        profile = api.get_profile(user_id=user.line_user_id)
-        display_name = profile.display_name
-        if display_name and display_name != user.username:
-            user.username = display_name
-            session.commit()
-    except Exception as e:
-        print(f"プロフィール取得エラー: {e}")
-        display_name = user.username  # データベースの既存値を使用
+    display_name = refresh_username(uow, user)
     
     # 汎用応答メッセージ
     message = f"{display_name}さん、申し訳ありませんが、{company.name}の足健康プログラムは足健診結果に基づいた運動プログラムの提供と、運動の継続状況の確認のみに対応しています。\n\n個別のご質問やご相談には対応できませんので、ご了承ください。\n\n足健診結果はA〜D（大文字小文字、全角半角どちらでも可）、または運動日数は1〜7の数字で入力してください。\n\n運動プログラムの継続状況については、1週間ごとにご連絡いたします。"
-    success = send_line_message(
-        api, "reply", event.reply_token,
-        [TextMessage(text=message)],
-        user, session, bot_id
-    )
-    if success:
-        log_message(session, user, "sent", "個別対応不可の案内メッセージ送信")
+    uow.reply(event.reply_token, [TextMessage(text=message)], user, LogEvent.UNSUPPORTED_NOTICE_SENT)
 
 # 初期化時にハンドラーをセットアップ
 setup_handlers()
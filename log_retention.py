@@ -0,0 +1,181 @@
+# log_retention.py
+"""
+message_logs の月次パーティションの保守
+
+- 先の月のパーティションを事前に作成する
+- 保持期間を過ぎたパーティションをgzip圧縮したCSVとして書き出し、
+  書き出したファイルを読み直して件数を確認してから親テーブルから切り離して削除する
+  （書き出しに失敗したパーティションは親テーブルに付いたまま残り、次回やり直す）
+- 前回の途中で切り離されたまま残った message_logs_YYYY_MM テーブルも同じようにアーカイブする
+- パーティション化前のログ（message_logs_legacy）は、最新の行が保持期間を過ぎたら同じようにアーカイブして削除する
+  （--include-legacy を付けると保持期間に関係なくアーカイブする）
+
+    python log_retention.py --retention-months 6 --archive-dir ./archive/message_logs
+    python log_retention.py --archive-dir ./archive/message_logs --include-legacy
+"""
+import os
+import re
+import csv
+import gzip
+import argparse
+from datetime import datetime
+from sqlalchemy import text
+from db_models import get_engine, ensure_message_log_partitions, month_start
+
+PARTITION_PATTERN = re.compile(r"^message_logs_(\d{4})_(\d{2})$")
+LEGACY_TABLE = "message_logs_legacy"  # db_models.migrate_legacy_message_logs で退避したテーブル
+
+def list_message_log_partitions(conn):
+    """月次パーティションを (テーブル名, 月の初日) のリストで返す（古い順）"""
+    rows = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = 'message_logs'"
+    )).scalars()
+    partitions = []
+    for name in rows:
+        match = PARTITION_PATTERN.match(name)
+        if match:
+            partitions.append((name, datetime(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(partitions, key=lambda p: p[1])
+
+def list_detached_partitions(conn):
+    """切り離されたまま残っている月次パーティションのテーブルを (テーブル名, 月の初日) のリストで返す（古い順）"""
+    rows = conn.execute(text(
+        "SELECT c.relname FROM pg_class c "
+        "JOIN pg_namespace n ON n.oid = c.relnamespace "
+        "WHERE c.relkind = 'r' AND n.nspname = current_schema() "
+        "AND c.relname LIKE 'message\\_logs\\_%' "
+        "AND NOT EXISTS (SELECT 1 FROM pg_inherits i WHERE i.inhrelid = c.oid)"
+    )).scalars()
+    tables = []
+    for name in rows:
+        match = PARTITION_PATTERN.match(name)
+        if match:
+            tables.append((name, datetime(int(match.group(1)), int(match.group(2)), 1)))
+    return sorted(tables, key=lambda p: p[1])
+
+def legacy_table_expired(conn, cutoff=None):
+    """
+    message_logs_legacy があり、最新の行が cutoff より前（または空）ならTrue（cutoff がNoneなら存在すればTrue）
+    新しい行は書き込まれないので、idが最大の行（主キーで1行だけ読む）の created_at を最新とみなす
+    """
+    exists = conn.execute(text("SELECT to_regclass(:name) IS NOT NULL"), {"name": LEGACY_TABLE}).scalar()
+    if not exists or cutoff is None:
+        return exists
+    newest = conn.execute(text(f"SELECT created_at FROM {LEGACY_TABLE} ORDER BY id DESC LIMIT 1")).first()
+    return newest is None or newest[0] is None or newest[0] < cutoff
+
+def detach_partition(engine, name):
+    """
+    パーティションを親テーブルから切り離す
+
+    デフォルトパーティションがあるとCONCURRENTLYは使えないため通常のDETACHを使う。
+    親テーブルのロックは一瞬で済む。
+    """
+    with engine.begin() as conn:
+        conn.execute(text(f"ALTER TABLE message_logs DETACH PARTITION {name}"))
+
+def count_archived_rows(path):
+    """書き出したファイルを読み直して行数（ヘッダーを除く）を数える"""
+    with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+        return max(sum(1 for _ in csv.reader(f)) - 1, 0)
+
+def export_partition(engine, name, archive_dir):
+    """
+    パーティション（親テーブルに付いたままでよい）をgzip圧縮CSVに書き出し、ファイルパスを返す
+
+    ファイルとディレクトリをfsyncし、読み直した行数がテーブルの行数と一致しなければ例外にする
+    （保持期間を過ぎた月のパーティションには新しい行は書き込まれない）
+    """
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.csv.gz")
+    tmp_path = path + ".tmp"
+
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        # 件数と書き出しを同じスナップショットで行う
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cursor.execute(f"SELECT count(*) FROM {name}")
+        expected = cursor.fetchone()[0]
+        with open(tmp_path, "wb") as raw_file:
+            with gzip.GzipFile(fileobj=raw_file, mode="wb") as f:
+                cursor.copy_expert(f"COPY {name} TO STDOUT WITH (FORMAT csv, HEADER)", f)
+            raw_file.flush()
+            os.fsync(raw_file.fileno())
+        cursor.close()
+        raw.commit()
+    finally:
+        raw.close()
+
+    written = count_archived_rows(tmp_path)
+    if written != expected:
+        raise RuntimeError(f"Archive of {name} has {written} rows, expected {expected}")
+
+    # 書き出しが完了してから正式なファイル名にし、リネームもディスクに書き込む
+    os.replace(tmp_path, path)
+    dir_fd = os.open(archive_dir, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+    return path
+
+def archive_message_logs(database_url, retention_months, archive_dir, dry_run=False, now=None,
+                         include_legacy=False):
+    """
+    保持期間を過ぎたmessage_logsパーティションをアーカイブして削除する
+
+    :param retention_months: 当月を含めて保持する月数
+    :param include_legacy: message_logs_legacy を保持期間に関係なくアーカイブする
+    :return: アーカイブしたファイルパスのリスト
+    """
+    engine = get_engine(database_url)
+    cutoff = month_start(now or datetime.utcnow(), -(retention_months - 1))
+    archived = []
+    try:
+        ensure_message_log_partitions(engine, now=now)
+
+        with engine.connect() as conn:
+            expired = [(name, True) for name, month in list_message_log_partitions(conn) if month < cutoff]
+            # 前回の途中（切り離した後）で終わったテーブル
+            expired += [(name, False) for name, _ in list_detached_partitions(conn)]
+            # パーティション化前のログ（親テーブルに付いていないので切り離しは不要）
+            if legacy_table_expired(conn, None if include_legacy else cutoff):
+                expired.append((LEGACY_TABLE, False))
+
+        for name, attached in expired:
+            if dry_run:
+                note = "" if attached else " (legacy)" if name == LEGACY_TABLE else " (detached)"
+                print(f"[dry-run] Would archive {name}{note}")
+                continue
+            # 書き出しに失敗した場合は親テーブルに付いたまま残る
+            path = export_partition(engine, name, archive_dir)
+            if attached:
+                detach_partition(engine, name)
+            with engine.begin() as conn:
+                conn.execute(text(f"DROP TABLE {name}"))
+            print(f"Archived {name} to {path}")
+            archived.append(path)
+    finally:
+        engine.dispose()
+    return archived
+
+def main():
+    from config import DATABASE_URL, MESSAGE_LOG_RETENTION_MONTHS, MESSAGE_LOG_ARCHIVE_DIR
+
+    parser = argparse.ArgumentParser(description="message_logsの古いパーティションをアーカイブする")
+    parser.add_argument("--retention-months", type=int, default=MESSAGE_LOG_RETENTION_MONTHS)
+    parser.add_argument("--archive-dir", default=MESSAGE_LOG_ARCHIVE_DIR)
+    parser.add_argument("--dry-run", action="store_true")
+    parser.add_argument("--include-legacy", action="store_true",
+                        help="パーティション化前のmessage_logs_legacyを保持期間に関係なくアーカイブして削除する")
+    args = parser.parse_args()
+
+    archive_message_logs(DATABASE_URL, args.retention_months, args.archive_dir, args.dry_run,
+                         include_legacy=args.include_legacy)
+
+if __name__ == "__main__":
+    main()
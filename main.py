@@ -1,9 +1,14 @@
 import os
-from flask import Flask, request, abort
-from line_handlers import get_handler
+import hmac
+import time
+from flask import Flask, request, abort, g
+from line_handlers import get_handler, handle_webhook
+from bulkhead import BulkheadRejected
+from webhook_capture import capture_webhook
+from profiler import profiler
 from scheduler import start_scheduler
 from db_models import run_migrations, ensure_companies_exist
-from config import DATABASE_URL, BOT_CONFIGS
+from config import DATABASE_URL, DATABASE_READ_URL, BOT_CONFIGS
 
 # Flask アプリ作成
 app = Flask(__name__)
@@ -31,6 +36,36 @@ import flask
 print(f"✅ Flask Version: {flask.__version__}")
 print(f"✅ 設定済み企業数: {len(BOT_CONFIGS)}")
 
+def admin_auth_error():
+    """
+    ADMIN_TOKEN による認証（Authorization: Bearer <トークン> または X-Admin-Token ヘッダー）
+    認証できればNone、できなければエラーのレスポンスを返す（ADMIN_TOKEN が未設定なら404）
+    """
+    from flask import jsonify
+    from config import ADMIN_TOKEN
+    if not ADMIN_TOKEN:
+        return jsonify({"error": "Not found"}), 404
+    token = request.headers.get("X-Admin-Token", "")
+    authorization = request.headers.get("Authorization", "")
+    if authorization.startswith("Bearer "):
+        token = authorization[len("Bearer "):]
+    if not hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        return jsonify({"error": "Unauthorized"}), 401
+    return None
+
+# サンプリングプロファイラー（対象に選ばれたリクエストの処理中だけスタックを取る）
+@app.before_request
+def start_profiling():
+    from config import ADMIN_TOKEN
+    header = request.headers.get("X-Profile-Token")
+    forced = bool(ADMIN_TOKEN and header) and hmac.compare_digest(header.encode(), ADMIN_TOKEN.encode())
+    bot_id = (request.view_args or {}).get("bot_id")
+    g.profile_token = profiler.begin(request.endpoint, bot_id, forced)
+
+@app.teardown_request
+def stop_profiling(exc):
+    profiler.end(g.pop("profile_token", None))
+
 @app.route("/callback/<bot_id>", methods=['POST'])
 def callback(bot_id):
     """各企業のLINE Bot用Webhookエンドポイント"""
@@ -38,6 +73,7 @@ def callback(bot_id):
         print(f"Unknown bot_id: {bot_id}")
         abort(404)
     
+    received_at = time.time()
     signature = request.headers.get('X-Line-Signature')
     body = request.get_data(as_text=True)
     print(f"Received webhook for bot_id: {bot_id}, signature: {signature[:10]}...")
@@ -47,13 +83,23 @@ def callback(bot_id):
         print(f"Failed to get handler for bot_id: {bot_id}")
         abort(500)
 
+    status = 200
     try:
-        # ハンドラーでWebhookを処理
-        handler.handle(body, signature)
+        # ペイロード内の全イベントをまとめて処理
+        handle_webhook(bot_id, body, signature)
         return 'OK'
+    except BulkheadRejected as e:
+        # この企業の処理が詰まっている（他の企業の処理は続ける）。LINEの再送に任せる
+        print(f"Webhook rejected for {bot_id}: {e.reason}")
+        status = 503
+        return 'Busy', 503
     except Exception as e:
         print(f"Webhook error for {bot_id}: {e}")
+        status = 400
         abort(400)
+    finally:
+        # 再現用の記録（WEBHOOK_CAPTURE_BOTS の企業のみ）
+        capture_webhook(bot_id, body, request.headers, received_at, status, time.time() - received_at)
 
 # 後方互換性のための従来のエンドポイント（開発時のみ使用推奨）
 @app.route("/callback", methods=['POST'])
@@ -92,17 +138,14 @@ def test_scheduler():
 def test_send_to_user(bot_id, user_id):
     """特定のユーザーにリマインダーを送信（テスト専用）"""
     from flask import jsonify
-    from db_models import get_db_session, User, Company
-    from config import get_line_client
-    from linebot.v3.messaging import TextMessage, QuickReply, QuickReplyItem, MessageAction
-    from utils import send_line_message
+    from db_models import get_db_session, User, Company, OUTBOX_SENT
+    from utils import build_reminder_message
+    from outbox import enqueue_push, dispatch_outbox
     
     if bot_id not in BOT_CONFIGS:
         return jsonify({"error": "Invalid bot_id"}), 404
     
     try:
-        api = get_line_client(bot_id)
-        
         with get_db_session(DATABASE_URL) as session:
             company = session.query(Company).filter_by(bot_id=bot_id).first()
             if not company:
@@ -117,22 +160,14 @@ def test_send_to_user(bot_id, user_id):
             if not user:
                 return jsonify({"error": "User not found"}), 404
             
-            quick_reply = QuickReply(
-                items=[
-                    QuickReplyItem(action=MessageAction(label="0回", text="0回")),
-                    QuickReplyItem(action=MessageAction(label="1~3回", text="1~3回")),
-                    QuickReplyItem(action=MessageAction(label="4~7回", text="4~7回"))
-                ]
-            )
-            
-            message_text = f"{user.username}さん、{company.name}の足健康プログラムからお知らせです。この1週間で運動は何回できましたか？0〜7回でご回答ください。"
-            message = TextMessage(text=message_text, quick_reply=quick_reply)
-            
-            success = send_line_message(api, "push", user.line_user_id, [message], user, session, bot_id)
+            # アウトボックスに追加してフラグと一緒にコミットし、すぐに送信する
+            outbound = enqueue_push(session, company, user, [build_reminder_message(user, company)], "reminder")
+            user.question_sent = True
+            session.commit()
+            dispatch_outbox()
+            session.refresh(outbound)
             
-            if success:
-                user.question_sent = True
-                session.commit()
+            if outbound.status == OUTBOX_SENT:
                 return jsonify({
                     "status": "success",
                     "message": f"送信成功: {user.line_user_id}",
@@ -141,7 +176,7 @@ def test_send_to_user(bot_id, user_id):
             else:
                 return jsonify({
                     "status": "error",
-                    "message": f"送信失敗: {user.line_user_id}"
+                    "message": f"送信失敗: {user.line_user_id} ({outbound.status}: {outbound.last_error})"
                 }), 500
     
     except Exception as e:
@@ -154,49 +189,42 @@ def test_send_to_user(bot_id, user_id):
 def test_send_now():
     """条件なしで全ユーザーにリマインダーを送信（テスト専用）"""
     from flask import jsonify
-    from db_models import get_db_session, User, Company
-    from config import get_line_client
-    from linebot.v3.messaging import TextMessage, QuickReply, QuickReplyItem, MessageAction
-    from utils import send_line_message
+    from db_models import get_db_session, User, Company, OUTBOX_SENT
+    from utils import build_reminder_message
+    from outbox import enqueue_push, dispatch_outbox
     
     try:
         results = []
+        queued = []
         
-        for bot_id in BOT_CONFIGS:
-            api = get_line_client(bot_id)
-            
-            with get_db_session(DATABASE_URL) as session:
+        with get_db_session(DATABASE_URL) as session:
+            for bot_id in BOT_CONFIGS:
                 company = session.query(Company).filter_by(bot_id=bot_id).first()
                 if not company:
                     continue
                 
-                # 条件なし：この企業の全ユーザーに送信
+                # 条件なし：この企業の全ユーザーに送信（ブロックしたユーザー・pushが届かないユーザーは除く）
                 users = session.query(User).filter(
                     User.company_id == company.id,
+                    User.active == True,
                     User.program_sent_date != None,
                     User.question_sent == False
                 ).all()
                 
                 for user in users:
-                    quick_reply = QuickReply(
-                        items=[
-                            QuickReplyItem(action=MessageAction(label="0回", text="0回")),
-                            QuickReplyItem(action=MessageAction(label="1~3回", text="1~3回")),
-                            QuickReplyItem(action=MessageAction(label="4~7回", text="4~7回"))
-                        ]
-                    )
-                    
-                    message_text = f"{user.username}さん、{company.name}の足健康プログラムからお知らせです。この1週間で運動は何回できましたか？0〜7回でご回答ください。"
-                    message = TextMessage(text=message_text, quick_reply=quick_reply)
-                    
-                    success = send_line_message(api, "push", user.line_user_id, [message], user, session, bot_id)
-                    
-                    if success:
-                        user.question_sent = True
-                        session.commit()
-                        results.append(f"送信成功: {user.line_user_id}")
-                    else:
-                        results.append(f"送信失敗: {user.line_user_id}")
+                    outbound = enqueue_push(session, company, user, [build_reminder_message(user, company)], "reminder")
+                    user.question_sent = True
+                    queued.append((user.line_user_id, outbound))
+                session.commit()
+            
+            # まとめて並列送信し、結果を確認する
+            dispatch_outbox()
+            for line_user_id, outbound in queued:
+                session.refresh(outbound)
+                if outbound.status == OUTBOX_SENT:
+                    results.append(f"送信成功: {line_user_id}")
+                else:
+                    results.append(f"送信失敗: {line_user_id} ({outbound.status})")
         
         return jsonify({
             "status": "success",
@@ -215,24 +243,57 @@ def test_send_now():
 def health_check():
     """ヘルスチェック"""
     from flask import jsonify
+    from response_cache import response_cache
+    from config import line_client_stats
+    from circuit_breaker import breaker_snapshot, OPEN
+    from db_models import get_db_session, read_replica_snapshot
+    from outbox import outbox_stats
+    from quota import quota_snapshot
+    from webhook_capture import capture_snapshot
+    from user_state_cache import user_state_cache
+    from bulkhead import webhook_bulkhead
+    breakers = breaker_snapshot()
+    try:
+        with get_db_session(DATABASE_URL) as session:
+            outbox = outbox_stats(session)
+    except Exception as e:
+        outbox = {"error": str(e)}
+    degraded = any(b["state"] == OPEN for ops in breakers.values() for b in ops.values())
     return jsonify({
-        "status": "ok",
-        "companies": len(BOT_CONFIGS)
+        "status": "degraded" if degraded else "ok",
+        "companies": len(BOT_CONFIGS),
+        "response_cache": response_cache.snapshot(),
+        "user_state_cache": user_state_cache.snapshot(),
+        "read_replica": read_replica_snapshot(),
+        "webhook_bulkhead": webhook_bulkhead.snapshot(),
+        "line_clients": line_client_stats(),
+        "circuit_breakers": breakers,
+        "outbox": outbox,
+        "message_quota": quota_snapshot(),
+        "webhook_capture": capture_snapshot()
     })
 
+# Prometheus形式のメトリクス
+@app.route("/metrics", methods=['GET'])
+def get_metrics():
+    """プロセス内のメトリクスをPrometheusのテキスト形式で返す"""
+    from flask import Response
+    from metrics import metrics
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
 # 運動履歴確認用エンドポイント
 @app.route("/history/<bot_id>", methods=['GET'])
 def get_exercise_history(bot_id):
     """企業の運動履歴を取得"""
     from flask import jsonify, request
-    from db_models import get_db_session, User, Company, ExerciseHistory
-    from sqlalchemy import func
+    from db_models import get_read_session, User, Company, ExerciseHistory
+    from response_cache import cached_json_response
     
     if bot_id not in BOT_CONFIGS:
         return jsonify({"error": "Invalid bot_id"}), 404
     
     try:
-        with get_db_session(DATABASE_URL) as session:
+        with get_read_session(DATABASE_URL, DATABASE_READ_URL) as session:
             company = session.query(Company).filter_by(bot_id=bot_id).first()
             if not company:
                 return jsonify({"error": "Company not found"}), 404
@@ -250,47 +311,80 @@ def get_exercise_history(bot_id):
                 if not user:
                     return jsonify({"error": "User not found"}), 404
                 
-                histories = session.query(ExerciseHistory).filter_by(
-                    user_id=user.id
-                ).order_by(ExerciseHistory.response_date.desc()).all()
+                def build_user_history():
+                    histories = session.query(ExerciseHistory).filter_by(
+                        user_id=user.id
+                    ).order_by(ExerciseHistory.response_date.desc()).all()
+                    
+                    return {
+                        "user_id": user.line_user_id,
+                        "username": user.username,
+                        "foot_check_result": user.foot_check_result,
+                        "current_week": user.current_week,
+                        "history": [
+                            {
+                                "date": h.response_date.isoformat(),
+                                "response_text": h.response_text,
+                                "response_days": h.response_days,
+                                "week_number": h.week_number
+                            }
+                            for h in histories
+                        ]
+                    }
                 
-                result = {
-                    "user_id": user.line_user_id,
-                    "username": user.username,
-                    "foot_check_result": user.foot_check_result,
-                    "current_week": user.current_week,
-                    "history": [
-                        {
-                            "date": h.response_date.isoformat(),
-                            "response_text": h.response_text,
-                            "response_days": h.response_days,
-                            "week_number": h.week_number
-                        }
-                        for h in histories
-                    ]
-                }
+                return cached_json_response(f"history:{bot_id}", company.data_version, build_user_history)
             else:
-                # 企業全体の統計
-                total_users = session.query(func.count(User.id)).filter_by(
-                    company_id=company.id
-                ).scalar()
+                # 企業全体の統計（集計テーブルから取得、?from=YYYY-MM-DD&to=YYYY-MM-DD で期間指定）
+                from rollups import company_stats
+                from datetime import date
                 
-                total_responses = session.query(func.count(ExerciseHistory.id)).filter_by(
-                    company_id=company.id
-                ).scalar()
+                try:
+                    start = date.fromisoformat(request.args['from']) if request.args.get('from') else None
+                    end = date.fromisoformat(request.args['to']) if request.args.get('to') else None
+                except ValueError:
+                    return jsonify({"error": "from/to must be YYYY-MM-DD"}), 400
                 
-                avg_response_days = session.query(func.avg(ExerciseHistory.response_days)).filter_by(
-                    company_id=company.id
-                ).scalar()
+                granularity = request.args.get('granularity')
+                if granularity not in (None, "daily", "weekly"):
+                    return jsonify({"error": "granularity must be daily or weekly"}), 400
                 
-                result = {
-                    "company": company.name,
-                    "total_users": total_users,
-                    "total_responses": total_responses,
-                    "average_exercise_days": float(avg_response_days) if avg_response_days else 0
-                }
+                return cached_json_response(
+                    f"history:{bot_id}", company.data_version,
+                    lambda: company_stats(session, company, start, end, granularity)
+                )
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# プログラム全体の分析用エンドポイント（継続率・実施率・離脱）
+@app.route("/analytics/<bot_id>", methods=['GET'])
+def get_analytics(bot_id):
+    """企業の12週間プログラムのコホート分析"""
+    from flask import jsonify, request
+    from datetime import date
+    from db_models import get_read_session, Company
+    from response_cache import cached_json_response
+    from analytics import company_analytics, DEFAULT_INACTIVE_DAYS
+    
+    if bot_id not in BOT_CONFIGS:
+        return jsonify({"error": "Invalid bot_id"}), 404
+    
+    inactive_days = request.args.get('inactive_days', DEFAULT_INACTIVE_DAYS, type=int)
+    if inactive_days < 1:
+        return jsonify({"error": "inactive_days must be a positive integer"}), 400
+    
+    try:
+        with get_read_session(DATABASE_URL, DATABASE_READ_URL) as session:
+            company = session.query(Company).filter_by(bot_id=bot_id).first()
+            if not company:
+                return jsonify({"error": "Company not found"}), 404
             
-            return jsonify(result)
+            # 離脱の判定は日付に依存するため、バージョンに当日の日付を含める
+            today = date.today()
+            return cached_json_response(
+                f"analytics:{bot_id}", f"{company.data_version}-{today.isoformat()}",
+                lambda: company_analytics(session, company, today, inactive_days)
+            )
     
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -300,97 +394,427 @@ def get_exercise_history(bot_id):
 def get_all_history():
     """全ての運動履歴を取得（管理用）"""
     from flask import jsonify, request
-    from db_models import get_db_session, User, ExerciseHistory
+    from db_models import get_read_session, User, Company, ExerciseHistory
+    from sqlalchemy import func
+    from response_cache import cached_json_response
     
     try:
         # クエリパラメータで制限数を指定可能
         limit = request.args.get('limit', 100, type=int)
         
-        with get_db_session(DATABASE_URL) as session:
-            # JOINしてユーザー名も取得
-            results = session.query(
-                ExerciseHistory,
-                User.username,
-                User.line_user_id,
-                User.foot_check_result
-            ).join(User).order_by(
-                ExerciseHistory.response_date.desc()
-            ).limit(limit).all()
+        with get_read_session(DATABASE_URL, DATABASE_READ_URL) as session:
+            # data_versionは増える一方なので、合計と企業数で全企業のバージョンを表せる
+            company_count, version_sum = session.query(
+                func.count(Company.id), func.coalesce(func.sum(Company.data_version), 0)
+            ).one()
             
-            histories = [
-                {
-                    "id": h.id,
-                    "username": username,
-                    "user_id": line_user_id,
-                    "date": h.response_date.isoformat(),
-                    "response_text": h.response_text,
-                    "response_days": h.response_days,
-                    "week_number": h.week_number,
-                    "foot_check_result": foot_check_result
+            def build_all_history():
+                # JOINしてユーザー名も取得
+                results = session.query(
+                    ExerciseHistory,
+                    User.username,
+                    User.line_user_id,
+                    User.foot_check_result
+                ).join(User).order_by(
+                    ExerciseHistory.response_date.desc()
+                ).limit(limit).all()
+                
+                histories = [
+                    {
+                        "id": h.id,
+                        "username": username,
+                        "user_id": line_user_id,
+                        "date": h.response_date.isoformat(),
+                        "response_text": h.response_text,
+                        "response_days": h.response_days,
+                        "week_number": h.week_number,
+                        "foot_check_result": foot_check_result
+                    }
+                    for h, username, line_user_id, foot_check_result in results
+                ]
+                
+                return {
+                    "total": len(histories),
+                    "limit": limit,
+                    "histories": histories
                 }
-                for h, username, line_user_id, foot_check_result in results
-            ]
             
-            return jsonify({
-                "total": len(histories),
-                "limit": limit,
-                "histories": histories
-            })
+            return cached_json_response("admin-history-all", f"{company_count}-{version_sum}", build_all_history)
     
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# 管理用エンドポイント：運動履歴の一括エクスポート（分析用、ADMIN_TOKEN で認証）
+@app.route("/admin/export/history/<bot_id>", methods=['GET'])
+def export_history(bot_id):
+    """運動履歴をArrow IPCストリームまたはgzip CSVでストリーミング返却（管理用）"""
+    from flask import jsonify, request, Response, stream_with_context
+    from datetime import datetime
+    from functools import partial
+    from db_models import get_read_session, month_start
+    import history_export
+
+    error = admin_auth_error()
+    if error:
+        return error
+    if bot_id not in BOT_CONFIGS:
+        return jsonify({"error": "Invalid bot_id"}), 404
+
+    fmt = request.args.get('format', 'arrow' if history_export.pa is not None else 'csv')
+    if fmt not in ('arrow', 'csv'):
+        return jsonify({"error": "format must be 'arrow' or 'csv'"}), 400
+    if fmt == 'arrow' and history_export.pa is None:
+        return jsonify({"error": "pyarrow is not installed"}), 400
+
+    # month=YYYY-MM でその月だけに絞る
+    since = until = None
+    month = request.args.get('month')
+    if month:
+        try:
+            since = datetime.strptime(month, "%Y-%m")
+        except ValueError:
+            return jsonify({"error": "month must be YYYY-MM"}), 400
+        until = month_start(since, 1)
+
+    chunks = history_export.stream_history(
+        partial(get_read_session, DATABASE_URL, DATABASE_READ_URL), fmt, bot_id, since, until
+    )
+    suffix = f"-{month}" if month else ""
+    if fmt == 'arrow':
+        mimetype = "application/vnd.apache.arrow.stream"
+        filename = f"history-{bot_id}{suffix}.arrows"
+    else:
+        mimetype = "application/gzip"
+        filename = f"history-{bot_id}{suffix}.csv.gz"
+    return Response(
+        stream_with_context(chunks),
+        mimetype=mimetype,
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
+
 # 管理用エンドポイント：全ユーザー一覧
 @app.route("/admin/users/<bot_id>", methods=['GET'])
 def get_all_users(bot_id):
     """企業の全ユーザー一覧を取得（管理用）"""
     from flask import jsonify
-    from db_models import get_db_session, User, Company
+    from db_models import get_read_session, User, Company
     from sqlalchemy import func
+    from response_cache import cached_json_response
     
     if bot_id not in BOT_CONFIGS:
         return jsonify({"error": "Invalid bot_id"}), 404
     
     try:
-        with get_db_session(DATABASE_URL) as session:
+        with get_read_session(DATABASE_URL, DATABASE_READ_URL) as session:
             company = session.query(Company).filter_by(bot_id=bot_id).first()
             if not company:
                 return jsonify({"error": "Company not found"}), 404
             
-            # ユーザー一覧と各ユーザーの統計を取得
-            users = session.query(User).filter_by(company_id=company.id).all()
-            
-            user_list = []
-            for user in users:
-                # 各ユーザーの履歴件数を取得
-                from db_models import ExerciseHistory
-                history_count = session.query(func.count(ExerciseHistory.id)).filter_by(
-                    user_id=user.id
-                ).scalar()
+            def build_user_list():
+                # ユーザー一覧と各ユーザーの統計を取得
+                users = session.query(User).filter_by(company_id=company.id).all()
                 
-                avg_days = session.query(func.avg(ExerciseHistory.response_days)).filter_by(
-                    user_id=user.id
-                ).scalar()
+                user_list = []
+                for user in users:
+                    # 各ユーザーの履歴件数を取得
+                    from db_models import ExerciseHistory
+                    history_count = session.query(func.count(ExerciseHistory.id)).filter_by(
+                        user_id=user.id
+                    ).scalar()
+                    
+                    avg_days = session.query(func.avg(ExerciseHistory.response_days)).filter_by(
+                        user_id=user.id
+                    ).scalar()
+                    
+                    user_list.append({
+                        "user_id": user.line_user_id,
+                        "username": user.username,
+                        "foot_check_result": user.foot_check_result,
+                        "current_week": user.current_week,
+                        "active": user.active,
+                        "unfollowed_at": user.unfollowed_at.isoformat() if user.unfollowed_at else None,
+                        "created_at": user.created_at.isoformat() if user.created_at else None,
+                        "total_responses": history_count,
+                        "average_exercise_days": float(avg_days) if avg_days else 0
+                    })
                 
-                user_list.append({
-                    "user_id": user.line_user_id,
-                    "username": user.username,
-                    "foot_check_result": user.foot_check_result,
-                    "current_week": user.current_week,
-                    "created_at": user.created_at.isoformat() if user.created_at else None,
-                    "total_responses": history_count,
-                    "average_exercise_days": float(avg_days) if avg_days else 0
-                })
+                return {
+                    "company": company.name,
+                    "total_users": len(user_list),
+                    "users": user_list
+                }
             
+            return cached_json_response(f"admin-users:{bot_id}", company.data_version, build_user_list)
+    
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# 管理用エンドポイント：スケジューラーの実行履歴と進捗（ADMIN_TOKEN で認証）
+@app.route("/admin/scheduler", methods=['GET'])
+def get_scheduler_runs():
+    """スケジューラーのジョブの実行履歴・実行中の進捗・次回実行時刻（管理用）"""
+    from flask import jsonify, request
+    from datetime import datetime, timedelta
+    from db_models import get_db_session
+    from scheduler import scheduled_jobs
+    from job_runs import recent_runs, run_to_dict, job_summary, running_snapshot
+
+    error = admin_auth_error()
+    if error:
+        return error
+    limit = min(request.args.get('limit', 20, type=int), 200)
+    job = request.args.get('job')
+    days = request.args.get('days', 7, type=int)
+
+    try:
+        with get_db_session(DATABASE_URL) as session:
             return jsonify({
-                "company": company.name,
-                "total_users": len(user_list),
-                "users": user_list
+                "jobs": scheduled_jobs(),
+                "running_here": running_snapshot(),
+                "summary": job_summary(session, datetime.utcnow() - timedelta(days=days)),
+                "summary_days": days,
+                "runs": [run_to_dict(run) for run in recent_runs(session, job, limit)],
             })
-    
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# 管理用エンドポイント：リマインダーの送信数の予測（ADMIN_TOKEN で認証）
+@app.route("/admin/forecast/<bot_id>", methods=['GET'])
+def get_reminder_forecast(bot_id):
+    """今後N日間のリマインダー・返信の件数の予測と、送信速度の上限・月間通数との比較（管理用）"""
+    from flask import jsonify, request
+    from db_models import get_read_session, Company
+    from quota import get_quota_tracker
+    from forecast import (forecast_reminders, next_reminder_scan, DEFAULT_RESPONSE_LAG_HOURS,
+                          MAX_FORECAST_DAYS)
+
+    error = admin_auth_error()
+    if error:
+        return error
+    if bot_id not in BOT_CONFIGS:
+        return jsonify({"error": "Invalid bot_id"}), 404
+
+    days = min(max(request.args.get('days', 14, type=int), 1), MAX_FORECAST_DAYS)
+    response_rate = request.args.get('response_rate', type=float)
+    if response_rate is not None and not 0 <= response_rate <= 1:
+        return jsonify({"error": "response_rate must be between 0 and 1"}), 400
+    response_lag_hours = max(request.args.get('response_lag_hours', DEFAULT_RESPONSE_LAG_HOURS, type=int), 0)
+    granularity = request.args.get('granularity', 'hour')
+    if granularity not in ('hour', 'day'):
+        return jsonify({"error": "granularity must be hour or day"}), 400
+
+    # 月間通数は送信の判定に使っているキャッシュ（QUOTA_REFRESH_SECONDS ごとに問い合わせ）を使う
+    tracker = get_quota_tracker(bot_id)
+    tracker.refresh()
+    quota = tracker.snapshot()
+    quotas = {bot_id: quota} if quota["fetched_at"] else {}
+
+    try:
+        with get_read_session(DATABASE_URL, DATABASE_READ_URL) as session:
+            company = session.query(Company).filter_by(bot_id=bot_id).first()
+            if not company:
+                return jsonify({"error": "Company not found"}), 404
+            result = forecast_reminders(
+                session, [company], days, response_rate=response_rate, response_lag_hours=response_lag_hours,
+                next_scan=next_reminder_scan(), quotas=quotas, granularity=granularity
+            )
+        forecast = result["tenants"][bot_id]
+        if quota["last_error"]:
+            forecast["quota_error"] = quota["last_error"]
+        return jsonify({"generated_at": result["generated_at"], "days": days, **forecast})
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# 管理用エンドポイント：お知らせ配信（キャンペーン、ADMIN_TOKEN で認証）
+@app.route("/admin/campaigns/<bot_id>", methods=['GET', 'POST'])
+def campaigns_endpoint(bot_id):
+    """GET: キャンペーン一覧 / POST: キャンペーンを作成して送信を開始"""
+    from flask import jsonify, request
+    from db_models import get_db_session, Company, Campaign
+    from linebot.v3.messaging import Message, TextMessage
+    from campaigns import create_campaign, start_campaign_runner, campaign_progress
+
+    error = admin_auth_error()
+    if error:
+        return error
+    if bot_id not in BOT_CONFIGS:
+        return jsonify({"error": "Invalid bot_id"}), 404
+
+    try:
+        with get_db_session(DATABASE_URL) as session:
+            company = session.query(Company).filter_by(bot_id=bot_id).first()
+            if not company:
+                return jsonify({"error": "Company not found"}), 404
+
+            if request.method == 'GET':
+                campaigns = session.query(Campaign).filter_by(company_id=company.id).order_by(Campaign.id.desc()).all()
+                return jsonify({"company": company.name, "campaigns": [campaign_progress(c) for c in campaigns]})
+
+            data = request.get_json(silent=True) or {}
+            if data.get("text"):
+                messages = [TextMessage(text=data["text"])]
+            elif data.get("messages"):
+                try:
+                    messages = [Message.from_dict(m) for m in data["messages"]]
+                except Exception as e:
+                    return jsonify({"error": f"Invalid messages: {e}"}), 400
+            else:
+                return jsonify({"error": "text or messages is required"}), 400
+            if not 1 <= len(messages) <= 5:
+                return jsonify({"error": "messages must contain 1 to 5 messages"}), 400
+            rate = data.get("rate_per_second")
+            try:
+                campaign = create_campaign(
+                    session, company, data.get("name") or "campaign", messages,
+                    audience=data.get("audience"), rate_per_second=int(rate) if rate else None
+                )
+            except (ValueError, TypeError) as e:
+                return jsonify({"error": str(e)}), 400
+            start_campaign_runner(campaign.id)
+            return jsonify(campaign_progress(campaign)), 202
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+@app.route("/admin/campaigns/<bot_id>/<int:campaign_id>", methods=['GET'])
+@app.route("/admin/campaigns/<bot_id>/<int:campaign_id>/<action>", methods=['POST'])
+def campaign_endpoint(bot_id, campaign_id, action=None):
+    """GET: 進捗 / POST pause・resume・cancel: 一時停止・再開・キャンセル"""
+    from flask import jsonify
+    from db_models import get_db_session, Company, Campaign, CAMPAIGN_PAUSED, CAMPAIGN_RUNNING, CAMPAIGN_CANCELLED
+    from campaigns import set_campaign_status, start_campaign_runner, campaign_progress
+
+    error = admin_auth_error()
+    if error:
+        return error
+    if bot_id not in BOT_CONFIGS:
+        return jsonify({"error": "Invalid bot_id"}), 404
+    statuses = {"pause": CAMPAIGN_PAUSED, "resume": CAMPAIGN_RUNNING, "cancel": CAMPAIGN_CANCELLED}
+    if action is not None and action not in statuses:
+        return jsonify({"error": "action must be pause, resume or cancel"}), 404
+
+    try:
+        with get_db_session(DATABASE_URL) as session:
+            campaign = session.query(Campaign).join(Company, Company.id == Campaign.company_id).filter(
+                Company.bot_id == bot_id, Campaign.id == campaign_id
+            ).first()
+            if not campaign:
+                return jsonify({"error": "Campaign not found"}), 404
+
+            if action is not None:
+                try:
+                    set_campaign_status(session, campaign, statuses[action])
+                except ValueError as e:
+                    return jsonify({"error": str(e)}), 409
+                if action == "resume":
+                    start_campaign_runner(campaign.id)
+            return jsonify(campaign_progress(campaign))
+
+    except Exception as e:
+        return jsonify({"error": str(e)}), 500
+
+# 管理用エンドポイント：サンプリングプロファイラー（ADMIN_TOKEN で認証）
+@app.route("/admin/profile", methods=['GET', 'POST', 'DELETE'])
+def profile_endpoint():
+    """
+    GET: 集計（?format=collapsed で flamegraph 用の collapsed 形式、name・bot_id で絞り込み）
+    POST: 対象の変更（sample_rate, endpoints, bots） / DELETE: 集計を消す
+    """
+    from flask import jsonify, Response
+
+    error = admin_auth_error()
+    if error:
+        return error
+
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            sample_rate = data.get("sample_rate")
+            endpoints, bots = data.get("endpoints"), data.get("bots")
+            profiler.configure(
+                sample_rate=float(sample_rate) if sample_rate is not None else None,
+                endpoints=[str(name) for name in endpoints] if endpoints is not None else None,
+                bots=[str(bot_id) for bot_id in bots] if bots is not None else None,
+            )
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        print(f"Profiler settings changed: {data}")
+    elif request.method == 'DELETE':
+        profiler.reset()
+
+    if request.method == 'GET' and request.args.get('format') == 'collapsed':
+        return Response(
+            profiler.collapsed(request.args.get('name'), request.args.get('bot_id')),
+            mimetype="text/plain",
+            headers={"Content-Disposition": "attachment; filename=profile.collapsed.txt"}
+        )
+    return jsonify(profiler.summary(min(request.args.get('top', 20, type=int), 200)))
+
+# 管理用エンドポイント：メモリのスナップショット（tracemalloc）
+@app.route("/admin/profile/memory", methods=['GET', 'POST'])
+def memory_snapshots_endpoint():
+    """GET: tracemalloc の状態とスナップショット一覧 / POST: {"action": "start" | "stop" | "snapshot"}"""
+    from flask import jsonify
+    from profiler import memory_snapshots
+
+    error = admin_auth_error()
+    if error:
+        return error
+
+    if request.method == 'POST':
+        action = (request.get_json(silent=True) or {}).get("action")
+        if action == "start":
+            memory_snapshots.start()
+        elif action == "stop":
+            memory_snapshots.stop()
+        elif action == "snapshot":
+            info = memory_snapshots.take(request.args.get('label', 'manual'))
+            if info is None:
+                return jsonify({"error": "tracemalloc is not tracing"}), 409
+            return jsonify(info)
+        else:
+            return jsonify({"error": "action must be start, stop or snapshot"}), 400
+    return jsonify({"tracing": memory_snapshots.tracing(), "snapshots": memory_snapshots.list()})
+
+@app.route("/admin/profile/memory/<int:snapshot_id>", methods=['GET'])
+def memory_snapshot_endpoint(snapshot_id):
+    """割り当ての多い場所（?compare=<ID> でそのスナップショットからの増加、key=lineno|filename|traceback）"""
+    from flask import jsonify
+    from profiler import memory_snapshots
+
+    error = admin_auth_error()
+    if error:
+        return error
+
+    key = request.args.get('key', 'lineno')
+    if key not in ('lineno', 'filename', 'traceback'):
+        return jsonify({"error": "key must be lineno, filename or traceback"}), 400
+    compare = request.args.get('compare', type=int)
+    limit = min(request.args.get('limit', 30, type=int), 500)
+    try:
+        stats = memory_snapshots.top(snapshot_id, compare, key, limit)
+    except KeyError as e:
+        return jsonify({"error": f"Snapshot {e} not found"}), 404
+    info, _ = memory_snapshots.get(snapshot_id)
+    return jsonify({"snapshot": info, "compare": compare, "key": key, "stats": stats})
+
+@app.route("/admin/profile/memory/<int:snapshot_id>/dump", methods=['GET'])
+def memory_snapshot_dump(snapshot_id):
+    """スナップショットのファイル（tracemalloc.Snapshot.load で読める）"""
+    from flask import jsonify, Response
+    from profiler import memory_snapshots
+
+    error = admin_auth_error()
+    if error:
+        return error
+
+    try:
+        data = memory_snapshots.dump(snapshot_id)
+    except KeyError:
+        return jsonify({"error": f"Snapshot {snapshot_id} not found"}), 404
+    return Response(data, mimetype="application/octet-stream",
+                    headers={"Content-Disposition": f"attachment; filename=snapshot-{snapshot_id}.tracemalloc"})
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 10000))
     app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,64 @@
+# metrics.py
+"""
+プロセス内のメトリクス（カウンターとゲージ）
+
+/metrics でPrometheusのテキスト形式として公開する。
+gunicornで複数ワーカーを動かす場合、値はワーカーごとに集計される。
+
+    from metrics import metrics
+    metrics.inc("line_api_calls_total", bot_id="company3", operation="push", outcome="success")
+    metrics.set_gauge("line_circuit_state", 1, bot_id="company3", operation="push")
+"""
+import threading
+
+class Metrics:
+    """ラベル付きのカウンターとゲージ"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}  # (name, labels) -> 値
+        self.gauges = {}
+        self.help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def describe(self, name, kind, text):
+        """HELP/TYPE行の内容を登録する"""
+        self.help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self._key(name, labels)] = value
+
+    def get(self, name, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            return self.counters.get(key, self.gauges.get(key, 0))
+
+    def render(self):
+        """Prometheusのテキスト形式で出力"""
+        with self.lock:
+            samples = sorted(list(self.counters.items()) + list(self.gauges.items()))
+        lines = []
+        described = set()
+        for (name, labels), value in samples:
+            if name not in described and name in self.help:
+                kind, text = self.help[name]
+                lines.append(f"# HELP {name} {text}")
+                lines.append(f"# TYPE {name} {kind}")
+                described.add(name)
+            label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels)
+            lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metrics = Metrics()
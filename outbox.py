@@ -0,0 +1,363 @@
+# outbox.py
+"""
+pushメッセージのトランザクショナルアウトボックス
+
+送信したい処理は enqueue_push で outbound_messages に行を追加し、状態の更新（question_sent など）と
+同じトランザクションでコミットする。送信は dispatch_outbox が行う。
+
+- 送信待ちの行は FOR UPDATE SKIP LOCKED で確保するので、複数のワーカー・プロセスで同時に動かしてもよい
+- 確保した行はスレッドプールで並列に送信し、結果はバッチごとに1回のコミットで記録する
+- retry_key を X-Line-Retry-Key として送るため、送信後に記録できずに再送しても重複配信されない
+  （受付済みのキーには409が返るので、送信済みとして扱う）
+- 確保したまま落ちたディスパッチャーの行は locked_until を過ぎると再び送信対象になる
+- 送信前に月間通数の残りを確認し（quota.py）、残りが少なければ優先度の低い送信を
+  翌日・来月の送信時間帯に延期する（リマインダーは取り消して question_sent を戻し、次回のスケジューラー実行で作り直す）
+"""
+import uuid
+import random
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text, update, delete, select, func
+from linebot.v3.messaging import Message, PushMessageRequest
+from db_models import (OutboundMessage, User, LogEvent, get_db_session,
+                       OUTBOX_PENDING, OUTBOX_SENDING, OUTBOX_SENT, OUTBOX_FAILED)
+from utils import add_message_log
+from line_errors import (classify_error, REASON_UNREACHABLE, REASON_QUOTA_EXCEEDED, REASON_CONFLICT,
+                         REASON_NETWORK, REASON_TIMEOUT)
+from quota import get_quota_tracker, kind_priority, ALLOW as QUOTA_ALLOW, REJECT as QUOTA_REJECT
+from send_window import get_send_window
+from circuit_breaker import get_breaker, is_breaker_failure
+from metrics import metrics
+from config import (
+    get_line_client, DATABASE_URL, LINE_HTTP_TIMEOUT, CIRCUIT_OPEN_SECONDS,
+    OUTBOX_BATCH_SIZE, OUTBOX_CONCURRENCY, OUTBOX_LEASE_SECONDS,
+    OUTBOX_MAX_ATTEMPTS, OUTBOX_RETRY_BASE_SECONDS, OUTBOX_RETRY_MAX_SECONDS
+)
+
+metrics.describe("outbox_messages_total", "counter", "Outbox deliveries by result (sent, duplicate, retry, failed, unconfirmed, unreachable, deferred, quota_deferred)")
+metrics.describe("line_push_messages_total", "counter", "Push messages counted against the monthly LINE quota, by kind")
+
+# 送信結果
+RESULT_SENT = "sent"
+RESULT_DUPLICATE = "duplicate"  # 409: 同じretry_keyで送信済み
+RESULT_RETRY = "retry"
+RESULT_FAILED = "failed"
+RESULT_UNREACHABLE = "unreachable"  # 友だちでないため届かない（ユーザーを無効にする）
+RESULT_UNCONFIRMED = "unconfirmed"  # 再送をあきらめたが、途中のタイムアウトなどで届いている可能性がある
+RESULT_DEFERRED = "deferred"    # ブレーカーがopenのため送信しなかった
+RESULT_QUOTA_DEFERRED = "quota_deferred"  # 月間通数の残りが少ないため延期した
+RESULT_QUOTA_EXCEEDED = "quota_exceeded"  # LINEが月間通数の上限を返した（deliver の中でだけ使う）
+
+def enqueue_push(session, company, user, messages, kind, send_at=None, sent_event=None, sent_detail=None):
+    """
+    pushメッセージをアウトボックスに追加する（コミットは呼び出し側で行う）
+    :param messages: linebot.v3.messaging のMessageのリスト
+    :param kind: 送信の種類（"reminder" など）
+    :param send_at: 送信予定時刻（UTC。省略時はすぐに送信）
+    :param sent_event: 送信できたときに PUSH_SENT に加えて記録するログ（LogEvent）と sent_detail
+    """
+    row = OutboundMessage(
+        company_id=company.id,
+        user_id=user.id,
+        to=user.line_user_id,
+        kind=kind,
+        payload=[message.to_dict() for message in messages],
+        retry_key=str(uuid.uuid4()),
+        status=OUTBOX_PENDING,
+        attempts=0,
+        next_attempt_at=send_at or datetime.utcnow(),
+        sent_event=int(sent_event) if sent_event is not None else None,
+        sent_detail=str(sent_detail)[:255] if sent_detail is not None else None,
+    )
+    session.add(row)
+    add_message_log(session, user, "system", LogEvent.PUSH_QUEUED, kind)
+    return row
+
+# 送信待ちの行（と確保期限切れの行）を確保する
+CLAIM_SQL = text(
+    "UPDATE outbound_messages o "
+    "SET status = :sending, attempts = o.attempts + 1, locked_until = :locked_until "
+    "FROM companies c "
+    "WHERE c.id = o.company_id AND o.id IN ("
+    "  SELECT id FROM outbound_messages "
+    "  WHERE (status = :pending AND next_attempt_at <= :now) "
+    "     OR (status = :sending AND locked_until < :now) "
+    "  ORDER BY next_attempt_at, id "
+    "  LIMIT :limit FOR UPDATE SKIP LOCKED"
+    ") "
+    "RETURNING o.id, c.bot_id, o.user_id, o.to, o.kind, o.payload, o.retry_key, o.attempts, "
+    "o.sent_event, o.sent_detail"
+)
+
+# 指定した行だけを確保する（Webhook処理中に追加した行をすぐに送る場合）
+CLAIM_IDS_SQL = text(
+    "UPDATE outbound_messages o "
+    "SET status = :sending, attempts = o.attempts + 1, locked_until = :locked_until "
+    "FROM companies c "
+    "WHERE c.id = o.company_id AND o.id IN ("
+    "  SELECT id FROM outbound_messages "
+    "  WHERE id = ANY(:ids) AND status = :pending "
+    "  FOR UPDATE SKIP LOCKED"
+    ") "
+    "RETURNING o.id, c.bot_id, o.user_id, o.to, o.kind, o.payload, o.retry_key, o.attempts, "
+    "o.sent_event, o.sent_detail"
+)
+
+def claim_batch(session, limit=OUTBOX_BATCH_SIZE, now=None):
+    """送信する行を確保してコミットし、行のリストを返す"""
+    now = now or datetime.utcnow()
+    rows = session.execute(CLAIM_SQL, {
+        "sending": OUTBOX_SENDING, "pending": OUTBOX_PENDING, "now": now, "limit": limit,
+        "locked_until": now + timedelta(seconds=OUTBOX_LEASE_SECONDS),
+    }).mappings().all()
+    session.commit()
+    return rows
+
+def retry_delay(attempts, retry_after=None):
+    """再送までの秒数（指数バックオフ＋ジッター、Retry-Afterがあればそれ以上）"""
+    delay = min(OUTBOX_RETRY_BASE_SECONDS * (2 ** max(attempts - 1, 0)), OUTBOX_RETRY_MAX_SECONDS)
+    delay = delay * random.uniform(0.8, 1.2)
+    if retry_after:
+        delay = max(delay, retry_after)
+    return delay
+
+def quota_hold(row, priority, decision, until):
+    """月間通数の判定で送らない行の (結果, 補足情報)（延期先は企業の送信時間帯の始まり）"""
+    if decision == QUOTA_REJECT:
+        return RESULT_FAILED, f"message quota exhausted ({priority} priority)"
+    opens, _ = next(get_send_window(row["bot_id"]).iter_open_periods(until))
+    return RESULT_QUOTA_DEFERRED, opens
+
+def deliver(row):
+    """
+    1件送信し、(結果, 補足情報) を返す（DBには触れない）
+    補足情報は送信成功時はリクエストID、再送時は待ち秒数、失敗時はエラー内容、月間通数による延期は延期先の時刻
+    """
+    tracker = get_quota_tracker(row["bot_id"])
+    priority = kind_priority(row["kind"])
+    decision, until = tracker.admit(priority)
+    if decision != QUOTA_ALLOW:
+        return quota_hold(row, priority, decision, until)
+    result, info = push(row)
+    if result not in (RESULT_SENT, RESULT_DUPLICATE):
+        # 409は同じretry_keyの送信をLINEが受け付けて数え済みなので戻さない
+        tracker.release()
+    if result == RESULT_QUOTA_EXCEEDED:
+        # 待っても回復しないので再送せず、残りに応じて延期する
+        tracker.mark_exhausted()
+        decision, until = tracker.admit(priority)
+        if decision == QUOTA_ALLOW:
+            # 上限が分からない（問い合わせに失敗している）場合は通常の再送に任せる
+            tracker.release()
+            return RESULT_RETRY, (retry_delay(row["attempts"]), info)
+        return quota_hold(row, priority, decision, until)
+    return result, info
+
+def push(row):
+    """1件pushし、(結果, 補足情報) を返す"""
+    breaker = get_breaker(row["bot_id"], "push")
+    if not breaker.allow():
+        return RESULT_DEFERRED, CIRCUIT_OPEN_SECONDS
+
+    api = get_line_client(row["bot_id"])
+    if api is None:
+        return RESULT_FAILED, f"unknown bot_id {row['bot_id']}"
+    try:
+        response = api.push_message_with_http_info(
+            PushMessageRequest(to=row["to"], messages=[Message.from_dict(m) for m in row["payload"]]),
+            x_line_retry_key=row["retry_key"],
+            _request_timeout=LINE_HTTP_TIMEOUT
+        )
+        breaker.record_success()
+        return RESULT_SENT, (response.headers or {}).get("x-line-request-id")
+    except Exception as e:
+        # 判定は utils.send_line_message と同じ line_errors.classify_error に従う
+        error_class = classify_error(e)
+        error = f"{type(e).__name__}: {(str(e).strip().splitlines() or [''])[0]}"
+        if error_class.reason == REASON_CONFLICT:
+            # 同じretry_keyの送信は受付済み（前回の結果を記録できなかった場合など）
+            breaker.record_success()
+            headers = getattr(e, "headers", None) or {}
+            return RESULT_DUPLICATE, headers.get("X-Line-Accepted-Request-Id") or headers.get("x-line-accepted-request-id")
+        if error_class.reason == REASON_QUOTA_EXCEEDED:
+            # LINE APIの障害ではないのでブレーカーの失敗には数えない
+            breaker.record_success()
+            return RESULT_QUOTA_EXCEEDED, error
+        if error_class.reason in (REASON_NETWORK, REASON_TIMEOUT) or is_breaker_failure(e):
+            breaker.record_failure(e)
+        else:
+            breaker.record_success()
+        if error_class.reason == REASON_UNREACHABLE:
+            return RESULT_UNREACHABLE, error
+        if not error_class.retryable:
+            return RESULT_FAILED, error
+        if row["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            # タイムアウトなど結果が分からない試行のうちにLINEが受け付けている可能性がある
+            return RESULT_UNCONFIRMED, f"unconfirmed: {error}"
+        return RESULT_RETRY, (retry_delay(row["attempts"], error_class.retry_after), error)
+
+def record_results(session, results, now=None):
+    """送信結果をまとめて記録する（1回のコミット）"""
+    now = now or datetime.utcnow()
+    updates = []
+    reset_question_ids = []
+    unreachable_ids = []
+    for row, (result, info) in results:
+        metrics.inc("outbox_messages_total", bot_id=row["bot_id"], result=result)
+        if result == RESULT_SENT:
+            # pushは月間の通数に数えられる（409の重複は数えない）
+            metrics.inc("line_push_messages_total", bot_id=row["bot_id"], kind=row["kind"])
+        if result in (RESULT_SENT, RESULT_DUPLICATE):
+            updates.append({"id": row["id"], "status": OUTBOX_SENT, "sent_at": now, "locked_until": None,
+                            "line_request_id": info, "last_error": None, "next_attempt_at": now})
+            if row["user_id"]:
+                add_message_log(session, None, "sent", LogEvent.PUSH_SENT, row["kind"], user_id=row["user_id"])
+                if row.get("sent_event") is not None:
+                    # 返信の代わりのpushは、届いてから元の返信の送信ログ（WELCOME_SENT など）を記録する
+                    add_message_log(session, None, "sent", row["sent_event"], row.get("sent_detail"),
+                                    user_id=row["user_id"])
+        elif result == RESULT_DEFERRED:
+            # 送信していないので試行回数には数えない
+            updates.append({"id": row["id"], "status": OUTBOX_PENDING, "sent_at": None, "locked_until": None,
+                            "line_request_id": None, "last_error": "circuit open",
+                            "next_attempt_at": now + timedelta(seconds=info), "attempts": row["attempts"] - 1})
+        elif result == RESULT_QUOTA_DEFERRED and row["kind"] == "reminder":
+            # 延期すると内容が古くなるので取り消し、送れるようになってからのスケジューラー実行で作り直す
+            updates.append({"id": row["id"], "status": OUTBOX_FAILED, "sent_at": None, "locked_until": None,
+                            "line_request_id": None, "last_error": "message quota: deferred",
+                            "next_attempt_at": now, "attempts": row["attempts"] - 1})
+            if row["user_id"]:
+                reset_question_ids.append(row["user_id"])
+        elif result == RESULT_QUOTA_DEFERRED:
+            updates.append({"id": row["id"], "status": OUTBOX_PENDING, "sent_at": None, "locked_until": None,
+                            "line_request_id": None, "last_error": "message quota: deferred",
+                            "next_attempt_at": info, "attempts": row["attempts"] - 1})
+        elif result == RESULT_RETRY:
+            delay, error = info
+            updates.append({"id": row["id"], "status": OUTBOX_PENDING, "sent_at": None, "locked_until": None,
+                            "line_request_id": None, "last_error": error[:255],
+                            "next_attempt_at": now + timedelta(seconds=delay)})
+        else:
+            updates.append({"id": row["id"], "status": OUTBOX_FAILED, "sent_at": None, "locked_until": None,
+                            "line_request_id": None, "last_error": str(info)[:255], "next_attempt_at": now})
+            if row["user_id"]:
+                add_message_log(session, None, "error", LogEvent.SEND_API_ERROR, f"{row['kind']}: {info}",
+                                user_id=row["user_id"])
+                # 届いたか分からないリマインダーは作り直さない（新しいretry_keyで送ると重複配信になりうる）
+                if row["kind"] == "reminder" and result != RESULT_UNCONFIRMED:
+                    reset_question_ids.append(row["user_id"])
+                if result == RESULT_UNREACHABLE:
+                    add_message_log(session, None, "system", LogEvent.USER_UNREACHABLE, row["kind"],
+                                    user_id=row["user_id"])
+                    unreachable_ids.append(row["user_id"])
+
+    # 列の組み合わせごとにまとめて主キーで一括更新する
+    for keys in {tuple(sorted(u)) for u in updates}:
+        session.execute(update(OutboundMessage), [u for u in updates if tuple(sorted(u)) == keys])
+    if reset_question_ids:
+        # 送れなかったリマインダーは次回のスケジューラー実行で作り直す
+        # ORMを通さない更新なので state_version も自分で加算する（キャッシュ済みの状態を古くする）
+        session.execute(update(User).where(User.id.in_(reset_question_ids)).values(
+            question_sent=False, state_version=User.state_version + 1
+        ))
+    if unreachable_ids:
+        # 友だちでないユーザーは再度友だち追加されるまで配信対象から外す
+        session.execute(update(User).where(User.id.in_(unreachable_ids)).values(
+            active=False, unfollowed_at=func.coalesce(User.unfollowed_at, now),
+            state_version=User.state_version + 1
+        ))
+    session.commit()
+
+def dispatch_outbox(max_batches=None, concurrency=OUTBOX_CONCURRENCY, batch_size=OUTBOX_BATCH_SIZE):
+    """
+    送信待ちがなくなるまで（または max_batches まで）アウトボックスを送信する
+    :return: 結果ごとの件数
+    """
+    totals = {}
+    batches = 0
+    with get_db_session(DATABASE_URL) as session, ThreadPoolExecutor(max_workers=concurrency) as executor:
+        while max_batches is None or batches < max_batches:
+            rows = claim_batch(session, batch_size)
+            if not rows:
+                break
+            batches += 1
+            outcomes = list(executor.map(deliver, rows))
+            record_results(session, list(zip(rows, outcomes)))
+            for result, _ in outcomes:
+                totals[result] = totals.get(result, 0) + 1
+            # ブレーカーで送れなかった行しかない場合は、しばらく待ってから次の実行で送る
+            if all(result == RESULT_DEFERRED for result, _ in outcomes):
+                break
+    if totals:
+        print(f"Outbox dispatched: {totals}")
+    return totals
+
+def dispatch_now(ids):
+    """
+    指定した送信待ちの行をこのスレッドで送信する（確保済み・送信済みの行は飛ばす）
+    送れなかった行は通常どおり定期実行のディスパッチャーが再送する
+    """
+    if not ids:
+        return {}
+    totals = {}
+    with get_db_session(DATABASE_URL) as session:
+        now = datetime.utcnow()
+        rows = session.execute(CLAIM_IDS_SQL, {
+            "sending": OUTBOX_SENDING, "pending": OUTBOX_PENDING, "ids": list(ids),
+            "locked_until": now + timedelta(seconds=OUTBOX_LEASE_SECONDS),
+        }).mappings().all()
+        session.commit()
+        if not rows:
+            return totals
+        outcomes = [deliver(row) for row in rows]
+        record_results(session, list(zip(rows, outcomes)))
+    for result, _ in outcomes:
+        totals[result] = totals.get(result, 0) + 1
+    return totals
+
+def cancel_pending(session, user_id, reason, kind=None):
+    """
+    ユーザー宛ての送信待ちの行を failed にする（コミットは呼び出し側で行う）
+    :param kind: 指定すればその種類の行だけ（"reminder" など）
+    """
+    conditions = [OutboundMessage.user_id == user_id, OutboundMessage.status == OUTBOX_PENDING]
+    if kind is not None:
+        conditions.append(OutboundMessage.kind == kind)
+    return session.execute(
+        update(OutboundMessage)
+        .where(*conditions)
+        .values(status=OUTBOX_FAILED, last_error=reason)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+
+def prune_outbox(retention_days, now=None, batch_size=10000):
+    """
+    保持期間を過ぎた送信済み・失敗の行を削除する（行ロックを短くするため batch_size 件ずつコミット）
+    送信済み・失敗の行の next_attempt_at は結果を記録した時刻（ix_outbound_messages_due で検索できる）
+    """
+    cutoff = (now or datetime.utcnow()) - timedelta(days=retention_days)
+    deleted = 0
+    with get_db_session(DATABASE_URL) as session:
+        while True:
+            ids = select(OutboundMessage.id).where(
+                OutboundMessage.status.in_((OUTBOX_SENT, OUTBOX_FAILED)),
+                OutboundMessage.next_attempt_at < cutoff
+            ).limit(batch_size).scalar_subquery()
+            count = session.execute(delete(OutboundMessage).where(OutboundMessage.id.in_(ids))).rowcount
+            session.commit()
+            deleted += count
+            if count < batch_size:
+                return deleted
+
+def outbox_stats(session):
+    """/health 用：状態ごとの件数（pending の scheduled は送信予定時刻前の件数）"""
+    rows = session.execute(text(
+        "SELECT status, count(*), min(next_attempt_at), count(*) FILTER (WHERE next_attempt_at > :now) "
+        "FROM outbound_messages GROUP BY status"
+    ), {"now": datetime.utcnow()}).all()
+    stats = {}
+    for status, count, oldest, scheduled in rows:
+        stats[status] = {"count": count, "oldest_due": oldest.isoformat() if oldest and status == OUTBOX_PENDING else None}
+        if status == OUTBOX_PENDING:
+            stats[status]["scheduled"] = scheduled
+    return stats
@@ -0,0 +1,315 @@
+# profiler.py
+"""
+本番で有効にしておけるサンプリングプロファイラーとメモリのスナップショット（/admin/profile）
+
+サンプリングプロファイラー:
+- 対象に選ばれたリクエスト・スケジューラーのジョブの実行中だけ、別スレッドが PROFILE_INTERVAL_MS ごとに
+  そのスレッドのスタックを取り、(エンドポイント, bot_id, スタック) ごとに回数を数える
+- 対象は PROFILE_ENDPOINTS（Flaskのエンドポイント名、ジョブは "job:<ジョブID>"）と PROFILE_BOTS に合うもののうち
+  PROFILE_SAMPLE_RATE の割合。X-Profile-Token ヘッダーに ADMIN_TOKEN を付けたリクエストは必ず対象になる
+- 対象でないリクエストの負荷は乱数1回だけ。スタックを取るのにかかった時間は sampler_seconds で確認できる
+- 出力は flamegraph.pl / speedscope で読める collapsed 形式（"エンドポイント;bot_id;関数;関数 回数"）
+
+メモリ:
+- tracemalloc が有効（PROFILE_TRACEMALLOC、または /admin/profile/memory で開始）な間、
+  リマインダーのジョブの後と要求時にスナップショットを取り、直近 PROFILE_MEMORY_SNAPSHOTS 個を残す
+- 2つのスナップショットの差分（どこで増えたか）を確認でき、Snapshot.load で読めるファイルとしても取り出せる
+"""
+import os
+import sys
+import time
+import random
+import tempfile
+import functools
+import threading
+import tracemalloc
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime
+from config import (PROFILE_SAMPLE_RATE, PROFILE_ENDPOINTS, PROFILE_BOTS, PROFILE_INTERVAL_MS, PROFILE_MAX_STACKS,
+                    PROFILE_TRACEMALLOC, PROFILE_TRACEMALLOC_FRAMES, PROFILE_MEMORY_SNAPSHOTS)
+
+MAX_STACK_DEPTH = 128
+OTHER_STACK = "[other]"  # スタックの種類が上限を超えた分
+
+def _parse_names(value):
+    return {name.strip() for name in (value or "").split(",") if name.strip()}
+
+def frame_name(code):
+    """スタックの1フレームの表示名（関数名と定義位置）"""
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+def collapse_stack(frame):
+    """フレームから呼び出し元をたどり、"外側;...;内側" の文字列にする"""
+    names = []
+    while frame is not None and len(names) < MAX_STACK_DEPTH:
+        names.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+class SamplingProfiler:
+    """対象のスレッドのスタックを一定間隔で取って数える"""
+
+    def __init__(self, sample_rate=PROFILE_SAMPLE_RATE, endpoints=PROFILE_ENDPOINTS, bots=PROFILE_BOTS,
+                 interval=PROFILE_INTERVAL_MS / 1000, max_stacks=PROFILE_MAX_STACKS):
+        self.lock = threading.Lock()
+        self.sample_rate = sample_rate
+        self.endpoints = _parse_names(endpoints)
+        self.bots = _parse_names(bots)
+        self.interval = interval
+        self.max_stacks = max_stacks
+        self.active = {}     # スレッドID -> (エンドポイント, bot_id)
+        self.stacks = {}     # (エンドポイント, bot_id, スタック) -> 回数
+        self.profiled = {}   # (エンドポイント, bot_id) -> [回数, 秒数]
+        self.samples = 0
+        self.sampler_seconds = 0.0
+        self.started_at = datetime.utcnow()
+        self.wakeup = threading.Event()
+        self.thread = None
+
+    def configure(self, sample_rate=None, endpoints=None, bots=None):
+        """実行中に対象を変える（None の項目はそのまま）"""
+        with self.lock:
+            if sample_rate is not None:
+                if not 0 <= sample_rate <= 1:
+                    raise ValueError("sample_rate must be between 0 and 1")
+                self.sample_rate = sample_rate
+            if endpoints is not None:
+                self.endpoints = set(endpoints)
+            if bots is not None:
+                self.bots = set(bots)
+
+    def should_profile(self, name, bot_id, forced=False):
+        if forced:
+            return True
+        if not self.sample_rate or name is None:
+            return False
+        if self.endpoints and name not in self.endpoints:
+            return False
+        if self.bots and bot_id not in self.bots:
+            return False
+        return random.random() < self.sample_rate
+
+    def begin(self, name, bot_id=None, forced=False):
+        """
+        対象ならこのスレッドのスタックの収集を始め、end に渡す値を返す（対象でなければNone）
+        同じスレッドで収集中の場合（ジョブの中のジョブなど）は外側だけを数える
+        """
+        if not self.should_profile(name, bot_id, forced):
+            return None
+        thread_id = threading.get_ident()
+        with self.lock:
+            if thread_id in self.active:
+                return None
+            self.active[thread_id] = (name, bot_id or "-")
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+                self.thread.start()
+        self.wakeup.set()
+        return thread_id, time.perf_counter()
+
+    def end(self, token):
+        if token is None:
+            return
+        thread_id, started = token
+        with self.lock:
+            label = self.active.pop(thread_id, None)
+            if label is not None:
+                entry = self.profiled.setdefault(label, [0, 0.0])
+                entry[0] += 1
+                entry[1] += time.perf_counter() - started
+
+    @contextmanager
+    def profile(self, name, bot_id=None, forced=False):
+        token = self.begin(name, bot_id, forced)
+        try:
+            yield token is not None
+        finally:
+            self.end(token)
+
+    def _run(self):
+        while True:
+            with self.lock:
+                targets = dict(self.active)
+            if not targets:
+                self.wakeup.wait()
+                self.wakeup.clear()
+                continue
+            started = time.perf_counter()
+            frames = sys._current_frames()
+            collected = [(label, collapse_stack(frames[thread_id]))
+                         for thread_id, label in targets.items() if thread_id in frames]
+            del frames
+            with self.lock:
+                for (name, bot_id), stack in collected:
+                    key = (name, bot_id, stack)
+                    if key not in self.stacks and len(self.stacks) >= self.max_stacks:
+                        key = (name, bot_id, OTHER_STACK)
+                    self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples += len(collected)
+                self.sampler_seconds += time.perf_counter() - started
+            time.sleep(self.interval)
+
+    def reset(self):
+        with self.lock:
+            self.stacks.clear()
+            self.profiled.clear()
+            self.samples = 0
+            self.sampler_seconds = 0.0
+            self.started_at = datetime.utcnow()
+
+    def collapsed(self, name=None, bot_id=None):
+        """flamegraph用の collapsed 形式（1行に "エンドポイント;bot_id;スタック 回数"）"""
+        with self.lock:
+            items = sorted(self.stacks.items())
+        return "".join(
+            f"{n};{b};{stack} {count}\n" for (n, b, stack), count in items
+            if (name is None or n == name) and (bot_id is None or b == bot_id)
+        )
+
+    def summary(self, top=20):
+        """/admin/profile 用：設定・対象ごとの件数と時間・よく出るスタック"""
+        with self.lock:
+            stacks = sorted(self.stacks.items(), key=lambda item: -item[1])[:top]
+            profiled = {f"{name}:{bot_id}": {"count": count, "seconds": round(seconds, 3)}
+                        for (name, bot_id), (count, seconds) in sorted(self.profiled.items())}
+            profiled_seconds = sum(seconds for _, seconds in self.profiled.values())
+            return {
+                "settings": {
+                    "sample_rate": self.sample_rate,
+                    "endpoints": sorted(self.endpoints),
+                    "bots": sorted(self.bots),
+                    "interval_ms": self.interval * 1000,
+                },
+                "since": self.started_at.isoformat(),
+                "profiled": profiled,
+                "in_progress": len(self.active),
+                "samples": self.samples,
+                "distinct_stacks": len(self.stacks),
+                # スタックを取るのにかかった時間（対象の処理の時間に対する割合）
+                "sampler_seconds": round(self.sampler_seconds, 3),
+                "sampler_overhead": round(self.sampler_seconds / profiled_seconds, 4) if profiled_seconds else None,
+                "top_stacks": [
+                    {"endpoint": name, "bot_id": bot_id, "samples": count, "leaf": stack.rsplit(";", 1)[-1]}
+                    for (name, bot_id, stack), count in stacks
+                ],
+            }
+
+class MemorySnapshots:
+    """tracemalloc のスナップショット（直近 keep 個）"""
+
+    def __init__(self, keep=PROFILE_MEMORY_SNAPSHOTS):
+        self.lock = threading.Lock()
+        self.snapshots = deque(maxlen=keep)  # (情報の辞書, Snapshot)
+        self.next_id = 1
+
+    @staticmethod
+    def tracing():
+        return tracemalloc.is_tracing()
+
+    def start(self, frames=PROFILE_TRACEMALLOC_FRAMES):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            print(f"tracemalloc started ({frames} frames)")
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            print("tracemalloc stopped")
+
+    def take(self, label):
+        """スナップショットを取って情報を返す（tracemalloc が無効ならNone）"""
+        if not tracemalloc.is_tracing():
+            return None
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+        current, peak = tracemalloc.get_traced_memory()
+        stats = snapshot.statistics("filename")
+        with self.lock:
+            info = {
+                "id": self.next_id,
+                "label": label,
+                "taken_at": datetime.utcnow().isoformat(),
+                "size": sum(stat.size for stat in stats),
+                "blocks": sum(stat.count for stat in stats),
+                "traced_current": current,
+                "traced_peak": peak,
+            }
+            self.next_id += 1
+            self.snapshots.append((info, snapshot))
+        return info
+
+    def list(self):
+        with self.lock:
+            return [info for info, _ in self.snapshots]
+
+    def get(self, snapshot_id):
+        with self.lock:
+            for info, snapshot in self.snapshots:
+                if info["id"] == snapshot_id:
+                    return info, snapshot
+        return None, None
+
+    def top(self, snapshot_id, compare_id=None, key="lineno", limit=30):
+        """
+        割り当ての多い場所（compare_id があればそのスナップショットからの増加の多い場所）
+        :param key: "lineno" / "filename" / "traceback"
+        """
+        info, snapshot = self.get(snapshot_id)
+        if snapshot is None:
+            raise KeyError(snapshot_id)
+        if compare_id is not None:
+            _, base = self.get(compare_id)
+            if base is None:
+                raise KeyError(compare_id)
+            stats = snapshot.compare_to(base, key)
+        else:
+            stats = snapshot.statistics(key)
+        return [
+            {
+                "location": str(stat.traceback) if key != "traceback" else stat.traceback.format(),
+                "size": stat.size,
+                "count": stat.count,
+                **({"size_diff": stat.size_diff, "count_diff": stat.count_diff} if compare_id is not None else {}),
+            }
+            for stat in stats[:limit]
+        ]
+
+    def dump(self, snapshot_id):
+        """Snapshot.load で読めるファイルの内容（バイト列）"""
+        _, snapshot = self.get(snapshot_id)
+        if snapshot is None:
+            raise KeyError(snapshot_id)
+        fd, path = tempfile.mkstemp(suffix=".tracemalloc")
+        os.close(fd)
+        try:
+            snapshot.dump(path)
+            with open(path, "rb") as f:
+                return f.read()
+        finally:
+            os.remove(path)
+
+profiler = SamplingProfiler()
+memory_snapshots = MemorySnapshots()
+if PROFILE_TRACEMALLOC:
+    memory_snapshots.start()
+
+def profiled_job(job_id, snapshot=False):
+    """
+    スケジューラーのジョブをプロファイラーの対象にする（エンドポイント名は "job:<job_id>"）
+    snapshot=True なら、tracemalloc が有効な場合にジョブの後でメモリのスナップショットを取る
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                with profiler.profile(f"job:{job_id}"):
+                    return func(*args, **kwargs)
+            finally:
+                if snapshot and memory_snapshots.tracing():
+                    memory_snapshots.take(f"after job:{job_id}")
+        return wrapper
+    return decorator
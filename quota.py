@@ -0,0 +1,266 @@
+# quota.py
+"""
+LINEの月間メッセージ通数の追跡と、残りに応じたpushの優先度制御
+
+pushとmulticastは企業（チャネル）ごとの月間通数に数えられ、上限に達すると全て429で失敗する。
+企業ごとの QuotaTracker が上限と今月の使用数を QUOTA_REFRESH_SECONDS ごとにMessaging APIから取得してキャッシュし、
+問い合わせの間はこのプロセスで送った通数を加えて残りを見積もる。
+
+送信前に admit(優先度, 通数) で送ってよいかを判定する（許可した通数は使用数に加え、送れなかったら release で戻す）。
+
+- PRIORITY_HIGH（reply_fallback：ユーザーの操作への応答）: 残りがある限り送る。なければ送らない（REJECT）
+- PRIORITY_NORMAL（reminder）: 残りが QUOTA_REMINDER_RESERVE を下回ったら来月に延期する。
+  残りが上限の QUOTA_THROTTLE_BELOW を下回ったら、残りを月末までの日数で割った通数を1日の上限にし、超えた分は翌日に延期する
+- PRIORITY_LOW（campaign）: 送信後の残りが CAMPAIGN_QUOTA_RESERVE を下回る場合と、リマインダーを日ごとに配分している間は送らない
+
+LINEが月間通数の上限（429）を返した場合は、問い合わせで残りが増えたことが分かるか月が変わるまで使い切ったものとして扱う。
+月と日の区切りは日本時間（LINEの月間通数の集計と同じ）。
+使用数は問い合わせのたびに他のワーカーの送信分も含めて合わせ直す（問い合わせの間は他のワーカーの分を含まない）。
+
+    tracker = get_quota_tracker("company3")
+    decision, until = tracker.admit(PRIORITY_NORMAL)
+    if decision == ALLOW:
+        ...  # 送信し、送れなかったら tracker.release()
+"""
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from metrics import metrics
+from config import (get_line_client, LINE_HTTP_TIMEOUT, QUOTA_REFRESH_SECONDS, QUOTA_THROTTLE_BELOW,
+                    QUOTA_REMINDER_RESERVE, CAMPAIGN_QUOTA_RESERVE)
+
+QUOTA_TIMEZONE = ZoneInfo("Asia/Tokyo")  # LINEの月間通数は日本時間の月ごとに数えられる
+
+# 送信の優先度
+PRIORITY_HIGH = "high"
+PRIORITY_NORMAL = "normal"
+PRIORITY_LOW = "low"
+KIND_PRIORITIES = {"reply_fallback": PRIORITY_HIGH, "reminder": PRIORITY_NORMAL, "campaign": PRIORITY_LOW}
+
+# admit の判定
+ALLOW = "allow"
+DEFER = "defer"    # until（UTC、naive）以降に送る
+REJECT = "reject"  # 今月は送れない（延期すると意味がなくなる送信）
+
+metrics.describe("line_quota_limit", "gauge", "Monthly LINE message quota (-1 when unlimited)")
+metrics.describe("line_quota_used", "gauge", "Messages used this month (last fetched usage plus local sends)")
+metrics.describe("line_quota_decisions_total", "counter", "Quota admission decisions by priority (allow, defer, reject)")
+metrics.describe("line_quota_refresh_errors_total", "counter", "Failed quota/consumption fetches")
+
+def kind_priority(kind):
+    """アウトボックスの送信の種類の優先度（未知の種類は PRIORITY_NORMAL）"""
+    return KIND_PRIORITIES.get(kind, PRIORITY_NORMAL)
+
+def message_quota(api):
+    """LINEの月間通数の上限と今月の使用数（上限なしなら limit=None）"""
+    quota = api.get_message_quota(_request_timeout=LINE_HTTP_TIMEOUT)
+    consumption = api.get_message_quota_consumption(_request_timeout=LINE_HTTP_TIMEOUT)
+    return {"limit": quota.value if quota.type == "limited" else None, "used": consumption.total_usage}
+
+def _local(now):
+    return now.replace(tzinfo=timezone.utc).astimezone(QUOTA_TIMEZONE)
+
+def _to_utc(local):
+    return local.astimezone(timezone.utc).replace(tzinfo=None)
+
+def next_day_start(now):
+    """次の日（日本時間）の始まり（UTC、naive）"""
+    local = _local(now)
+    return _to_utc(datetime.combine(local.date() + timedelta(days=1), datetime.min.time(), tzinfo=QUOTA_TIMEZONE))
+
+def next_month_start(now):
+    """次の月（日本時間）の始まり（UTC、naive）"""
+    local = _local(now)
+    year, month = (local.year + 1, 1) if local.month == 12 else (local.year, local.month + 1)
+    return _to_utc(datetime(year, month, 1, tzinfo=QUOTA_TIMEZONE))
+
+def days_left_in_month(now):
+    """今日を含む月末までの日数（日本時間）"""
+    local = _local(now)
+    return (_local(next_month_start(now)).date() - local.date()).days
+
+class QuotaTracker:
+    """1つの企業（チャネル）の月間通数"""
+
+    def __init__(self, bot_id, refresh_seconds=QUOTA_REFRESH_SECONDS, fetch=None, clock=time.monotonic):
+        self.bot_id = bot_id
+        self.refresh_seconds = refresh_seconds
+        self.fetch = fetch or (lambda: message_quota(get_line_client(bot_id)))
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.limit = None        # 上限（上限なし・未取得ならNone）
+        self.used = 0            # 問い合わせた使用数＋その後に許可した通数
+        self.month = None        # "YYYY-MM"（日本時間）
+        self.day = None
+        self.day_sent = 0        # 今日（日本時間）このプロセスで許可した通数
+        self.exhausted = False   # LINEが上限に達したと返した
+        self.fetched_at = None   # 最後に問い合わせた時刻（clock）
+        self.last_fetched = None
+        self.last_error = None
+
+    def _roll(self, now):
+        """月・日が変わったら数え直す"""
+        local = _local(now)
+        if self.month != local.strftime("%Y-%m"):
+            if self.month is not None:
+                print(f"Quota {self.bot_id}: new month {local:%Y-%m}")
+            self.month = local.strftime("%Y-%m")
+            self.used = 0
+            self.exhausted = False
+            self.fetched_at = None  # 新しい月の使用数をすぐに問い合わせる
+        if self.day != local.date():
+            self.day = local.date()
+            self.day_sent = 0
+
+    def _remaining(self):
+        if self.exhausted:
+            return 0
+        if self.limit is None:
+            return None
+        return max(self.limit - self.used, 0)
+
+    def _publish(self):
+        with self.lock:
+            limit, used = self.limit, self.used
+        metrics.set_gauge("line_quota_limit", -1 if limit is None else limit, bot_id=self.bot_id)
+        metrics.set_gauge("line_quota_used", used, bot_id=self.bot_id)
+
+    def refresh(self, now=None, force=False):
+        """上限と使用数を問い合わせる（前回から refresh_seconds 未満なら何もしない）"""
+        now = now or datetime.utcnow()
+        with self.lock:
+            self._roll(now)
+            if not force and self.fetched_at is not None and self.clock() - self.fetched_at < self.refresh_seconds:
+                return False
+            # 失敗しても次の問い合わせまで待つ（同時に送信中の他のスレッドからは問い合わせない）
+            self.fetched_at = self.clock()
+        try:
+            quota = self.fetch()
+        except Exception as e:
+            with self.lock:
+                self.last_error = f"{type(e).__name__}: {(str(e).strip().splitlines() or [''])[0]}"
+            metrics.inc("line_quota_refresh_errors_total", bot_id=self.bot_id)
+            print(f"Quota {self.bot_id}: fetch failed: {self.last_error}")
+            return False
+        with self.lock:
+            self.limit = quota["limit"]
+            # 使用数の集計は遅れることがあるので、このプロセスで数えた分より少なければ数えた分を使う
+            self.used = max(quota["used"], self.used)
+            if self.exhausted and (self.limit is None or self.used < self.limit):
+                print(f"Quota {self.bot_id}: quota available again ({self.used}/{self.limit})")
+                self.exhausted = False
+            self.last_fetched = now
+            self.last_error = None
+        self._publish()
+        return True
+
+    def remaining(self, now=None):
+        """今月の残りの通数の見積もり（上限なし・未取得ならNone）"""
+        self.refresh(now)
+        with self.lock:
+            return self._remaining()
+
+    def _decide(self, priority, count, remaining, now):
+        if remaining is None:
+            return ALLOW, None
+        if remaining < count:
+            return (REJECT, None) if priority == PRIORITY_HIGH else (DEFER, next_month_start(now))
+        if priority == PRIORITY_HIGH:
+            return ALLOW, None
+        throttled = self.limit is not None and remaining < self.limit * QUOTA_THROTTLE_BELOW
+        if priority == PRIORITY_LOW:
+            if throttled or remaining - count < CAMPAIGN_QUOTA_RESERVE:
+                return DEFER, next_month_start(now)
+            return ALLOW, None
+        if remaining - count < QUOTA_REMINDER_RESERVE:
+            return DEFER, next_month_start(now)
+        if throttled:
+            # 今日の始まりの残りを月末までの日数で均等に配分する
+            allowance = (remaining + self.day_sent) / days_left_in_month(now)
+            if self.day_sent + count > allowance:
+                return DEFER, next_day_start(now)
+        return ALLOW, None
+
+    def admit(self, priority, count=1, now=None):
+        """
+        count 通を送ってよいか判定し (ALLOW / DEFER / REJECT, 延期先の時刻) を返す
+        ALLOW の場合は使用数に加える（送れなかったら release で戻す）
+        """
+        now = now or datetime.utcnow()
+        self.refresh(now)
+        with self.lock:
+            self._roll(now)
+            decision, until = self._decide(priority, count, self._remaining(), now)
+            if decision == ALLOW:
+                self.used += count
+                self.day_sent += count
+        metrics.inc("line_quota_decisions_total", count, bot_id=self.bot_id, priority=priority, decision=decision)
+        self._publish()
+        return decision, until
+
+    def check(self, priority, count=1, now=None):
+        """admit と同じ判定を使用数に加えずに行う（送信を作るかどうかの事前確認）"""
+        now = now or datetime.utcnow()
+        self.refresh(now)
+        with self.lock:
+            self._roll(now)
+            return self._decide(priority, count, self._remaining(), now)
+
+    def release(self, count=1):
+        """admit で許可したが送らなかった（失敗した）通数を戻す"""
+        with self.lock:
+            self.used = max(self.used - count, 0)
+            self.day_sent = max(self.day_sent - count, 0)
+        self._publish()
+
+    def mark_exhausted(self):
+        """LINEが月間通数の上限（429）を返した"""
+        with self.lock:
+            if not self.exhausted:
+                print(f"Quota {self.bot_id}: monthly limit reached ({self.used}/{self.limit})")
+            self.exhausted = True
+            if self.limit is not None:
+                self.used = max(self.used, self.limit)
+        self._publish()
+
+    def snapshot(self):
+        with self.lock:
+            remaining = self._remaining()
+            return {
+                "month": self.month,
+                "limit": self.limit,
+                "used": self.used,
+                "remaining": remaining,
+                "exhausted": self.exhausted,
+                "throttled": bool(self.limit and remaining is not None and remaining < self.limit * QUOTA_THROTTLE_BELOW),
+                "sent_today": self.day_sent,
+                "fetched_at": self.last_fetched.isoformat() if self.last_fetched else None,
+                "last_error": self.last_error,
+            }
+
+# bot_id -> QuotaTracker
+quota_trackers = {}
+quota_trackers_lock = threading.Lock()
+
+def get_quota_tracker(bot_id):
+    """企業の QuotaTracker を取得（なければ作成）"""
+    tracker = quota_trackers.get(bot_id)
+    if tracker is None:
+        with quota_trackers_lock:
+            tracker = quota_trackers.get(bot_id)
+            if tracker is None:
+                tracker = QuotaTracker(bot_id)
+                quota_trackers[bot_id] = tracker
+    return tracker
+
+def refresh_quotas(bot_ids):
+    """企業ごとの上限と使用数を問い合わせる（スケジューラーから定期実行）"""
+    for bot_id in bot_ids:
+        get_quota_tracker(bot_id).refresh(force=True)
+
+def quota_snapshot():
+    """/health 用：企業ごとの月間通数"""
+    with quota_trackers_lock:
+        trackers = dict(quota_trackers)
+    return {bot_id: tracker.snapshot() for bot_id, tracker in trackers.items()}
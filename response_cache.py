@@ -0,0 +1,89 @@
+# response_cache.py
+"""
+履歴・管理APIのレスポンスキャッシュ
+
+キャッシュキーはエンドポイント名とクエリパラメータ、有効性は企業の data_version で判定する。
+data_version はユーザー作成や運動履歴の保存と同じトランザクションで加算されるため、
+複数ワーカーで動かしていても古いレスポンスを返すことはない。
+ETagもdata_versionから計算するので、If-None-Matchが一致すればペイロードを作らずに304を返す。
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import request, current_app, Response
+from config import RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES
+
+class ResponseCache:
+    """件数とバイト数に上限のあるLRUキャッシュ"""
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # key -> (version, body)
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "not_modified": 0, "evictions": 0}
+
+    def get(self, key, version):
+        """同じバージョンのキャッシュがあれば本文を返す"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key, version, body):
+        """本文を保存し、上限を超えた分を古い順に捨てる"""
+        if len(body) > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= len(old[1])
+            self.entries[key] = (version, body)
+            self.total_bytes += len(body)
+            while len(self.entries) > self.max_entries or self.total_bytes > self.max_bytes:
+                _, (_, evicted) = self.entries.popitem(last=False)
+                self.total_bytes -= len(evicted)
+                self.stats["evictions"] += 1
+
+    def count_not_modified(self):
+        with self.lock:
+            self.stats["not_modified"] += 1
+
+    def snapshot(self):
+        """/health 用の統計"""
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries), bytes=self.total_bytes)
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES)
+
+def cached_json_response(scope, version, build_payload):
+    """
+    キャッシュ付きでJSONレスポンスを返す
+
+    :param scope: エンドポイントと対象企業を表す文字列（例: "history:company3"）
+    :param version: 対象データのバージョン（data_version）
+    :param build_payload: キャッシュがない場合にペイロード(dict)を作る関数
+    """
+    params = "&".join(f"{k}={v}" for k, v in sorted(request.args.items(multi=True)))
+    key = f"{scope}?{params}"
+    etag = hashlib.sha1(f"{key}|{version}".encode()).hexdigest()[:32]
+
+    if request.if_none_match.contains(etag):
+        response_cache.count_not_modified()
+        response = Response(status=304)
+    else:
+        body = response_cache.get(key, version)
+        if body is None:
+            body = current_app.json.dumps(build_payload()).encode()
+            response_cache.put(key, version, body)
+        response = Response(body, mimetype="application/json")
+
+    response.set_etag(etag)
+    # キャッシュは使ってよいが、毎回ETagで再検証させる
+    response.headers["Cache-Control"] = "no-cache"
+    return response
@@ -0,0 +1,213 @@
+# rollups.py
+"""
+運動履歴の日次・週次集計テーブル（exercise_daily_stats / exercise_weekly_stats）
+
+process_exercise_days が履歴を保存するたびに同じトランザクションで加算し、
+/history/<bot_id> は全件を集計せずにこのテーブルだけを読む。
+既存データの取り込みや不整合の修復は rebuild で行う。
+
+    python rollups.py rebuild              # 全企業を再集計
+    python rollups.py rebuild --bot-id company3
+"""
+import argparse
+from datetime import timedelta
+from sqlalchemy import func, text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from db_models import ExerciseDailyStat, ExerciseWeeklyStat, Company, User, bump_company_versions
+
+# 集計キーの未設定値
+UNKNOWN_RESULT = "?"
+UNKNOWN_WEEK = 0
+
+def stat_key(company_id, response_date, foot_check_result, week_number):
+    """集計キー (company_id, 日付, 評価結果, 週番号)"""
+    return (
+        company_id,
+        response_date.date(),
+        foot_check_result or UNKNOWN_RESULT,
+        week_number or UNKNOWN_WEEK,
+    )
+
+def add_exercise_delta(deltas, company_id, response_date, foot_check_result, week_number, response_days):
+    """1件の回答を加算分 {キー: [件数, 日数合計]} に積む"""
+    key = stat_key(company_id, response_date, foot_check_result, week_number)
+    delta = deltas.setdefault(key, [0, 0])
+    delta[0] += 1
+    delta[1] += response_days or 0
+
+def _upsert_stats(session, model, period_column, rows):
+    """集計行を加算でupsertする"""
+    if not rows:
+        return
+    stmt = pg_insert(model).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[model.company_id, period_column, model.foot_check_result, model.week_number],
+        set_={
+            "response_count": model.response_count + stmt.excluded.response_count,
+            "response_days_sum": model.response_days_sum + stmt.excluded.response_days_sum,
+        }
+    )
+    session.execute(stmt)
+
+def apply_exercise_deltas(session, deltas):
+    """加算分を日次・週次テーブルに反映する（コミットは呼び出し側で行う）"""
+    daily = []
+    weekly = {}
+    # 同時実行時のデッドロックを避けるため、常にキー順で更新する
+    for (company_id, day, result, week_number), (count, days_sum) in sorted(deltas.items()):
+        daily.append({
+            "company_id": company_id, "stat_date": day,
+            "foot_check_result": result, "week_number": week_number,
+            "response_count": count, "response_days_sum": days_sum,
+        })
+        week_start = day - timedelta(days=day.weekday())
+        weekly_row = weekly.setdefault((company_id, week_start, result, week_number), {
+            "company_id": company_id, "week_start": week_start,
+            "foot_check_result": result, "week_number": week_number,
+            "response_count": 0, "response_days_sum": 0,
+        })
+        weekly_row["response_count"] += count
+        weekly_row["response_days_sum"] += days_sum
+
+    _upsert_stats(session, ExerciseDailyStat, ExerciseDailyStat.stat_date, daily)
+    _upsert_stats(session, ExerciseWeeklyStat, ExerciseWeeklyStat.week_start, [weekly[k] for k in sorted(weekly)])
+
+def rebuild_rollups(session, company_id=None):
+    """exercise_historyから集計テーブルを作り直す（コミットは呼び出し側で行う）"""
+    company_filter = "WHERE company_id = :company_id" if company_id is not None else ""
+    params = {"company_id": company_id} if company_id is not None else {}
+
+    # 再集計中の加算を待たせる（ロック解除後に加算されるので取りこぼしも二重計上もない）
+    session.execute(text("LOCK TABLE exercise_daily_stats, exercise_weekly_stats IN EXCLUSIVE MODE"))
+
+    for table, period in (("exercise_daily_stats", "day"), ("exercise_weekly_stats", "week")):
+        period_column = "stat_date" if period == "day" else "week_start"
+        session.execute(text(f"DELETE FROM {table} {company_filter}"), params)
+        session.execute(text(
+            f"INSERT INTO {table} (company_id, {period_column}, foot_check_result, week_number, "
+            f"response_count, response_days_sum) "
+            f"SELECT company_id, date_trunc('{period}', response_date)::date, "
+            f"COALESCE(foot_check_result, '{UNKNOWN_RESULT}'), COALESCE(week_number, {UNKNOWN_WEEK}), "
+            f"count(*), COALESCE(sum(response_days), 0) "
+            f"FROM exercise_history {company_filter} "
+            f"GROUP BY 1, 2, 3, 4"
+        ), params)
+
+    # 統計が変わるので、企業のレスポンスキャッシュ（data_version）を無効にする
+    company_ids = [company_id] if company_id is not None else [cid for cid, in session.query(Company.id)]
+    bump_company_versions(session, company_ids)
+
+def backfill_rollups(session):
+    """
+    運動履歴があるのに集計行が1件もない企業を再集計し、その企業IDを返す（コミットは呼び出し側で行う）
+    集計テーブルの追加後の初回起動で、既存の履歴を取り込むために run_migrations から呼ばれる。
+    """
+    company_ids = [company_id for company_id, in session.execute(text(
+        "SELECT c.id FROM companies c "
+        "WHERE EXISTS (SELECT 1 FROM exercise_history h WHERE h.company_id = c.id) "
+        "AND NOT EXISTS (SELECT 1 FROM exercise_daily_stats s WHERE s.company_id = c.id) "
+        "ORDER BY c.id"
+    ))]
+    for company_id in company_ids:
+        rebuild_rollups(session, company_id)
+    return company_ids
+
+def _average(days_sum, count):
+    return float(days_sum) / count if count else 0
+
+def company_stats(session, company, start=None, end=None, granularity=None):
+    """
+    集計テーブルから企業の統計を返す
+
+    :param start: 集計開始日（date、含む）
+    :param end: 集計終了日（date、含む）
+    :param granularity: "daily" / "weekly" を指定すると期間ごとの推移も返す
+    期間指定がなく日次の推移も不要な場合は、行数の少ない週次テーブルを使う。
+    """
+    use_daily = start is not None or end is not None or granularity == "daily"
+    model = ExerciseDailyStat if use_daily else ExerciseWeeklyStat
+    period = model.stat_date if use_daily else model.week_start
+
+    base = session.query(
+        period.label("period"),
+        model.foot_check_result,
+        model.week_number,
+        model.response_count,
+        model.response_days_sum,
+    ).filter(model.company_id == company.id)
+    if start is not None:
+        base = base.filter(period >= start)
+    if end is not None:
+        base = base.filter(period <= end)
+
+    total_count = 0
+    total_days = 0
+    by_result = {}
+    by_week = {}
+    series = {}
+    for row in base:
+        total_count += row.response_count
+        total_days += row.response_days_sum
+        for bucket, key in ((by_result, row.foot_check_result), (by_week, row.week_number)):
+            entry = bucket.setdefault(key, [0, 0])
+            entry[0] += row.response_count
+            entry[1] += row.response_days_sum
+        if granularity:
+            period_key = row.period
+            if granularity == "weekly" and use_daily:
+                period_key = row.period - timedelta(days=row.period.weekday())
+            entry = series.setdefault(period_key, [0, 0])
+            entry[0] += row.response_count
+            entry[1] += row.response_days_sum
+
+    total_users = session.query(func.count(User.id)).filter_by(company_id=company.id).scalar()
+
+    result = {
+        "company": company.name,
+        "total_users": total_users,
+        "total_responses": total_count,
+        "average_exercise_days": _average(total_days, total_count),
+        "by_foot_check_result": {
+            key: {"responses": count, "average_exercise_days": _average(days, count)}
+            for key, (count, days) in sorted(by_result.items())
+        },
+        "by_week_number": {
+            str(key): {"responses": count, "average_exercise_days": _average(days, count)}
+            for key, (count, days) in sorted(by_week.items())
+        },
+    }
+    if start is not None or end is not None:
+        result["period"] = {
+            "from": start.isoformat() if start else None,
+            "to": end.isoformat() if end else None,
+        }
+    if granularity:
+        result["series"] = [
+            {"period": key.isoformat(), "responses": count, "average_exercise_days": _average(days, count)}
+            for key, (count, days) in sorted(series.items())
+        ]
+    return result
+
+def main():
+    from config import DATABASE_URL
+    from db_models import get_db_session
+
+    parser = argparse.ArgumentParser(description="運動履歴の集計テーブルを管理する")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--bot-id", help="対象企業のbot_id（省略時は全企業）")
+    args = parser.parse_args()
+
+    with get_db_session(DATABASE_URL) as session:
+        company_id = None
+        if args.bot_id:
+            company = session.query(Company).filter_by(bot_id=args.bot_id).first()
+            if not company:
+                print(f"Company not found for bot_id: {args.bot_id}")
+                return
+            company_id = company.id
+        rebuild_rollups(session, company_id)
+        session.commit()
+        print(f"Rebuilt exercise rollups for {args.bot_id or 'all companies'}")
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,81 @@
 from datetime import datetime, timedelta
 from apscheduler.schedulers.background import BackgroundScheduler
-from linebot.v3.messaging import TextMessage, QuickReply, QuickReplyItem, MessageAction
-from db_models import get_db_session, User, Company
-from sqlalchemy import text
-from utils import send_line_message, log_message, log_error
-from config import get_line_client, BOT_CONFIGS, DATABASE_URL
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES
+from db_models import get_db_session, get_read_session, User, Company, OutboundMessage, OUTBOX_PENDING
+from sqlalchemy import text, func, update
+from utils import log_error, build_reminder_message
+from outbox import enqueue_push, dispatch_outbox
+from job_runs import job_run, record_skipped
+from send_window import get_send_window
+from quota import get_quota_tracker, refresh_quotas, PRIORITY_NORMAL, ALLOW as QUOTA_ALLOW
+from profiler import profiled_job
+from config import (BOT_CONFIGS, DATABASE_URL, DATABASE_READ_URL, OUTBOX_POLL_SECONDS, CAMPAIGN_RESUME_SECONDS,
+                    REMINDER_INTERVAL_HOURS, REMINDER_MAX_PUSH_PER_SECOND, QUOTA_REFRESH_SECONDS)
 
+# 実行履歴（scheduler_runs）に記録するジョブ
+TRACKED_JOBS = ('individual_reminder', 'message_log_maintenance')
+
+# start_scheduler で起動したスケジューラー
+background_scheduler = None
+
+@profiled_job('individual_reminder', snapshot=True)
 def send_weekly_reminder():
     """ユーザーごとに個別のリマインダーを送信する関数（定期チェック）"""
     print("Reminder check started at:", datetime.utcnow())
     
-    # 各企業ごとに処理
-    for bot_id, config in BOT_CONFIGS.items():
-        send_company_reminders(bot_id)
+    with job_run('individual_reminder') as run:
+        if run is None:
+            return  # 他のワーカーで実行中
+        run.set("tenants_total", len(BOT_CONFIGS))
+        
+        # 各企業ごとに処理
+        for bot_id, config in BOT_CONFIGS.items():
+            send_company_reminders(bot_id, run)
+        
+        # 追加したリマインダーをすぐに送信（残りは定期実行のディスパッチャーが送る）
+        run.set("outbox", run_outbox_dispatcher())
+
+def reminder_conditions(cutoff):
+    """リマインダーの対象（最後の回答から7日以上経過し、まだ質問を送っていない有効なユーザー）の条件"""
+    # question_sent=Falseで重複送信を防ぐ（ユーザーが回答するとFalseにリセットされる）
+    return (
+        User.active == True,  # ブロックしたユーザー・pushが届かないユーザーは除く
+        User.program_sent_date != None,
+        User.program_sent_date <= cutoff,
+        User.question_sent == False  # まだ質問を送っていない
+    )
+
+def find_reminder_candidates(bot_id, cutoff):
+    """リマインダーの対象になりそうなユーザーのIDを読み取り用DB（レプリカ）で検索する"""
+    with get_read_session(DATABASE_URL, DATABASE_READ_URL) as session:
+        rows = session.query(User.id).join(Company, Company.id == User.company_id).filter(
+            Company.bot_id == bot_id, *reminder_conditions(cutoff)
+        ).all()
+        return [user_id for user_id, in rows]
 
-def send_company_reminders(bot_id):
-    """指定された企業のユーザーにリマインダーを送信"""
+def last_scheduled_reminder(session, company_id):
+    """この企業の送信待ちのリマインダーの最も遅い送信予定時刻（なければNone）"""
+    return session.query(func.max(OutboundMessage.next_attempt_at)).filter(
+        OutboundMessage.company_id == company_id,
+        OutboundMessage.kind == "reminder",
+        OutboundMessage.status == OUTBOX_PENDING
+    ).scalar()
+
+def schedule_reminders(session, bot_id, company_id, count, now):
+    """
+    count 件のリマインダーの送信予定時刻を、次回の検索までの送信時間帯に割り振る
+    前回までに割り振った送信待ちがあれば、その後ろから割り振る（送信速度の上限を守るため）
+    """
+    since = max(now, last_scheduled_reminder(session, company_id) or now)
+    until = now + timedelta(hours=REMINDER_INTERVAL_HOURS)
+    return get_send_window(bot_id).spread(count, since, until, REMINDER_MAX_PUSH_PER_SECOND)
+
+def send_company_reminders(bot_id, run=None):
+    """指定された企業のユーザーにリマインダーを送信（run があれば件数を実行履歴に記録）"""
     print(f"Processing reminders for bot_id: {bot_id}")
-    api = get_line_client(bot_id)
-    
-    if not api:
-        print(f"Failed to get LINE API client for bot_id: {bot_id}")
-        return
+    if run:
+        run.start_tenant(bot_id)
+    due = 0
     
     with get_db_session(DATABASE_URL) as session:
         try:
@@ -37,6 +91,8 @@ def send_company_reminders(bot_id):
             company = session.query(Company).filter_by(bot_id=bot_id).first()
             if not company:
                 print(f"Company not found for bot_id: {bot_id}")
+                if run:
+                    run.finish_tenant(bot_id, error="company not found", due=0, queued=0, failed=0)
                 return
             
             # 現在時刻から7日前を計算
@@ -44,67 +100,177 @@ def send_company_reminders(bot_id):
             seven_days_ago = now - timedelta(days=7)
             
             # この企業に属するユーザーで、最後の回答から7日以上経過したユーザーを抽出
-            # question_sent=Falseで重複送信を防ぐ（ユーザーが回答するとFalseにリセットされる）
-            users = session.query(User).filter(
-                User.company_id == company.id,
-                User.program_sent_date != None,
-                User.program_sent_date <= seven_days_ago,
-                User.question_sent == False  # まだ質問を送っていない
-            ).all()
+            query = session.query(User).filter(User.company_id == company.id, *reminder_conditions(seven_days_ago))
+            if DATABASE_READ_URL:
+                # 全ユーザーの検索はレプリカで行い、プライマリでは候補だけを条件を再確認しながら読み込む
+                # （レプリカの遅延で漏れたユーザーは次回の実行で対象になる）
+                query = query.filter(User.id.in_(find_reminder_candidates(bot_id, seven_days_ago)))
+            users = query.all()
+            
+            due = len(users)
+            print(f"Found {due} users for company {company.name} to send weekly reminder")
+
+            # 月間通数の残りが少なくリマインダーを送れない間は作らない（作っても延期で取り消されるため）
+            # question_sent は False のままなので、送れるようになってからの実行で対象になる
+            decision, until = get_quota_tracker(bot_id).check(PRIORITY_NORMAL) if due else (QUOTA_ALLOW, None)
+            if decision != QUOTA_ALLOW:
+                print(f"Message quota low for company {company.name}, reminders held until {until}")
+                if run:
+                    run.finish_tenant(bot_id, due=due, queued=0, failed=0, quota_held_until=until.isoformat(),
+                                      quota_remaining=get_quota_tracker(bot_id).remaining())
+                return
             
-            print(f"Found {len(users)} users for company {company.name} to send weekly reminder")
+            # question_sent は対象の条件を再確認しながらCoreのUPDATEで立てる
+            # （ORMで更新すると、読み込んだ後に回答などで更新されたユーザーが1人でもいると state_version の
+            #   StaleDataError で企業全体がロールバックされる。条件に合わなくなったユーザーには送らない）
+            marked = set(session.execute(
+                update(User)
+                .where(User.id.in_([user.id for user in users]), *reminder_conditions(seven_days_ago))
+                .values(question_sent=True, state_version=User.state_version + 1)
+                .returning(User.id)
+                .execution_options(synchronize_session=False)
+            ).scalars())
+            users = [user for user in users if user.id in marked]
             
-            # 各ユーザーにメッセージを送信
-            for user in users:
-                print(f"Sending to user {user.id}, last program: {user.program_sent_date}, question_sent: {user.question_sent}")
-                
-                # クイックリプライの選択肢を作成
-                quick_reply = QuickReply(
-                    items=[
-                        QuickReplyItem(
-                            action=MessageAction(label="0回", text="0回")
-                        ),
-                        QuickReplyItem(
-                            action=MessageAction(label="1~3回", text="1~3回")
-                        ),
-                        QuickReplyItem(
-                            action=MessageAction(label="4~7回", text="4~7回")
-                        )
-                    ]
-                )
-                
-                # クイックリプライ付きメッセージ
-                message_text = f"{user.username}さん、{company.name}の足健康プログラムからお知らせです。この1週間で運動は何回できましたか？0〜7回でご回答ください。"
-                message = TextMessage(text=message_text, quick_reply=quick_reply)
-                
-                success = send_line_message(
-                    api, "push", user.line_user_id,
-                    [message],
-                    user, session, bot_id
-                )
-                
-                if success:
-                    # 送信成功したらフラグを立てる
-                    user.question_sent = True
-                    session.commit()
-                    print(f"Updated user {user.line_user_id} status")
+            # リマインダーをアウトボックスに追加し、question_sentと同じトランザクションでコミット
+            # （送信は dispatch_outbox が行うので、送信とフラグ更新の間で落ちても二重送信にならない）
+            # 送信時刻は送信時間帯に分散し、dispatch_outbox は送信予定時刻を過ぎたものから送る
+            slots = schedule_reminders(session, bot_id, company.id, len(users), now)
+            for user, send_at in zip(users, slots):
+                print(f"Queueing reminder for user {user.id}, last program: {user.program_sent_date}, send at: {send_at}")
+                enqueue_push(session, company, user, [build_reminder_message(user, company)], "reminder", send_at)
+            session.commit()
+            print(f"Queued {len(users)} reminders for company {company.name}")
+            if run:
+                # 月間通数の残りが少ない場合、追加したリマインダーはディスパッチャーが翌日・来月に延期する
+                schedule = {"window": str(get_send_window(bot_id)), "quota_remaining": get_quota_tracker(bot_id).remaining()}
+                if slots:
+                    schedule.update(first_send_at=slots[0].isoformat(), last_send_at=slots[-1].isoformat())
+                # 読み込んだ後に条件に合わなくなったユーザー（回答した・ブロックしたなど）は changed に数える
+                run.finish_tenant(bot_id, due=due, queued=len(users), failed=0, changed=due - len(users), **schedule)
                 
         except Exception as e:
             log_error(f"send_company_reminders({bot_id})", e, None, session)
+            if run:
+                # コミット前に失敗した場合、その企業の対象者は1人も追加されていない
+                run.finish_tenant(bot_id, error=e, due=due, queued=0, failed=due)
+
+@profiled_job('outbox_dispatcher')
+def run_outbox_dispatcher():
+    """アウトボックスの送信待ちメッセージを送信する"""
+    try:
+        return dispatch_outbox()
+    except Exception as e:
+        print(f"Outbox dispatch failed: {e}")
+        return {"error": str(e)}
+
+def refresh_message_quotas():
+    """各企業のLINEの月間通数の上限と使用数を問い合わせる（送信の判定に使うキャッシュを更新）"""
+    try:
+        refresh_quotas(BOT_CONFIGS)
+    except Exception as e:
+        print(f"Quota refresh failed: {e}")
+
+def resume_campaigns():
+    """status が running なのにこのプロセスで送信していないキャンペーンを引き継ぐ"""
+    from campaigns import resume_running_campaigns
+
+    try:
+        resume_running_campaigns()
+    except Exception as e:
+        print(f"Campaign resume failed: {e}")
+
+def maintain_message_logs():
+    """message_logsの翌月以降のパーティション作成と、保持期間切れパーティションのアーカイブ"""
+    from log_retention import archive_message_logs
+    from job_runs import prune_runs
+    from outbox import prune_outbox
+    from config import (MESSAGE_LOG_RETENTION_MONTHS, MESSAGE_LOG_ARCHIVE_DIR, SCHEDULER_RUN_RETENTION_DAYS,
+                        OUTBOX_RETENTION_DAYS)
+
+    try:
+        with job_run('message_log_maintenance') as run:
+            if run is None:
+                return
+            archived = archive_message_logs(DATABASE_URL, MESSAGE_LOG_RETENTION_MONTHS, MESSAGE_LOG_ARCHIVE_DIR)
+            run.set("archived_partitions", len(archived))
+            # スケジューラーの実行履歴も保持期間を過ぎたものを削除
+            run.set("pruned_runs", prune_runs(SCHEDULER_RUN_RETENTION_DAYS))
+            # 送信済み・失敗のアウトボックスの行（/health の集計が大きくならないように）
+            run.set("pruned_outbox", prune_outbox(OUTBOX_RETENTION_DAYS))
+            print(f"message_logs maintenance finished, archived {len(archived)} partition(s)")
+    except Exception as e:
+        print(f"message_logs maintenance failed: {e}")
+
+def on_job_max_instances(event):
+    """前回の実行が終わっていないため実行されなかったジョブを記録する"""
+    if event.job_id in TRACKED_JOBS:
+        record_skipped(event.job_id, "previous run still in progress")
+
+def scheduled_jobs():
+    """/admin/scheduler 用：登録済みのジョブと次回の実行時刻"""
+    if background_scheduler is None:
+        return []
+    return [
+        {"id": job.id, "trigger": str(job.trigger),
+         "next_run_time": job.next_run_time.isoformat() if job.next_run_time else None}
+        for job in background_scheduler.get_jobs()
+    ]
 
 def start_scheduler():
     """スケジューラーを起動する関数"""
+    global background_scheduler
     print("Starting scheduler...")
     scheduler = BackgroundScheduler()
+    background_scheduler = scheduler
     
-    # 6時間ごとに実行（1日4回チェック）
-    # これにより、各ユーザーの回答時刻から正確に7日後にメッセージを送信
+    # REMINDER_INTERVAL_HOURS（既定6時間）ごとに対象者を検索
+    # 送信は次回の検索までの送信時間帯に分散する（send_window.py）
     scheduler.add_job(
         send_weekly_reminder, 
         'interval', 
-        hours=6,
+        hours=REMINDER_INTERVAL_HOURS,
         id='individual_reminder'
     )
     
+    # アウトボックスの送信（再送待ちのメッセージもここで送られる）
+    scheduler.add_job(
+        run_outbox_dispatcher,
+        'interval',
+        seconds=OUTBOX_POLL_SECONDS,
+        id='outbox_dispatcher',
+        max_instances=1,
+        coalesce=True
+    )
+    
+    # LINEの月間通数の問い合わせ（送信の間はプロセス内で数えて見積もる）
+    scheduler.add_job(
+        refresh_message_quotas,
+        'interval',
+        seconds=QUOTA_REFRESH_SECONDS,
+        id='quota_refresh',
+        max_instances=1,
+        coalesce=True
+    )
+    
+    # お知らせ配信の引き継ぎ（再起動や他のワーカーの停止で止まったキャンペーンを再開）
+    scheduler.add_job(
+        resume_campaigns,
+        'interval',
+        seconds=CAMPAIGN_RESUME_SECONDS,
+        id='campaign_resume',
+        max_instances=1,
+        coalesce=True
+    )
+    
+    # 1日1回、message_logsのパーティション作成とアーカイブ
+    scheduler.add_job(
+        maintain_message_logs,
+        'interval',
+        days=1,
+        id='message_log_maintenance'
+    )
+    
+    scheduler.add_listener(on_job_max_instances, EVENT_JOB_MAX_INSTANCES)
     scheduler.start()
-    print("Individual reminder scheduler started (checks every 6 hours)")
+    print(f"Individual reminder scheduler started (checks every {REMINDER_INTERVAL_HOURS} hours)")
@@ -0,0 +1,111 @@
+# send_window.py
+"""
+リマインダーの送信時間帯と送信時刻の分散
+
+スケジューラーは REMINDER_INTERVAL_HOURS ごとに対象者を検索するため、そのまま送ると
+前回の検索以降に対象になったユーザーへのpushが一度に集中し（LINE APIのレート制限とDBの負荷）、
+深夜に届くこともある。そこで対象者ごとに送信予定時刻を決め、アウトボックスの next_attempt_at に入れる。
+
+- 時刻は企業のタイムゾーン（既定は REMINDER_TIMEZONE = Asia/Tokyo）で指定する
+- 送信時間帯（REMINDER_SEND_WINDOW、企業ごとに REMINDER_SEND_WINDOWS）の外は送らない（静かな時間帯）
+- 次回の検索までの送信時間帯に均等に割り振り、各人の時刻はその枠の中でランダムにずらす（ジッター）
+- 間隔は 1 / REMINDER_MAX_PUSH_PER_SECOND 秒以上にする。収まらない分は次の送信時間帯に回る
+
+    window = get_send_window("company3")
+    slots = window.spread(len(users), now, now + timedelta(hours=6), max_per_second=5)
+"""
+import random
+from datetime import datetime, time, timedelta, timezone
+from zoneinfo import ZoneInfo
+from config import REMINDER_TIMEZONE, REMINDER_SEND_WINDOW, REMINDER_SEND_WINDOWS
+
+class SendWindow:
+    """1日の送信時間帯（start > end なら日をまたぐ。start == end なら終日）"""
+
+    def __init__(self, start, end, tz):
+        self.start = start
+        self.end = end
+        self.tz = tz
+
+    def __str__(self):
+        return f"{self.start:%H:%M}-{self.end:%H:%M}@{self.tz.key}"
+
+    def _to_utc(self, local):
+        return local.astimezone(timezone.utc).replace(tzinfo=None)
+
+    def iter_open_periods(self, since):
+        """since（UTC、naive）以降の送信できる期間 (開始, 終了) を順に返す（UTC、naive）"""
+        if self.start == self.end:
+            yield since, datetime.max
+            return
+        day = since.replace(tzinfo=timezone.utc).astimezone(self.tz).date() - timedelta(days=1)
+        while True:
+            opens = self._to_utc(datetime.combine(day, self.start, tzinfo=self.tz))
+            closes_on = day if self.end > self.start else day + timedelta(days=1)
+            closes = self._to_utc(datetime.combine(closes_on, self.end, tzinfo=self.tz))
+            if closes > since:
+                yield max(opens, since), closes
+            day += timedelta(days=1)
+
+    def open_seconds(self, since, until):
+        """since〜until の間に送信できる秒数"""
+        total = 0.0
+        for opens, closes in self.iter_open_periods(since):
+            if opens >= until:
+                break
+            total += (min(closes, until) - opens).total_seconds()
+        return total
+
+    def spread(self, count, since, until, max_per_second=None, rng=random):
+        """
+        count 件の送信時刻（UTC、naive、昇順）を since〜until の送信時間帯に均等に割り振る
+        max_per_second を超える場合や、期間内に送信時間帯がない場合は until より後にもはみ出す
+        （since が until 以降の場合は max_per_second の間隔で送信時間帯に詰める）
+        """
+        if count <= 0:
+            return []
+        available = self.open_seconds(since, until)
+        if available <= 0 and until > since:
+            # 次回の検索まで静かな時間帯の場合は、送信時間帯が始まってから同じ長さの間に割り振る
+            opens, _ = next(self.iter_open_periods(since))
+            available = self.open_seconds(opens, opens + (until - since))
+        interval = available / count
+        if max_per_second:
+            interval = max(interval, 1.0 / max_per_second)
+
+        slots = []
+        periods = self.iter_open_periods(since)
+        opens, closes = next(periods)
+        consumed = 0.0  # これまでの期間の送信できる秒数の合計
+        for i in range(count):
+            offset = (i + rng.random()) * interval
+            while offset - consumed >= (closes - opens).total_seconds():
+                consumed += (closes - opens).total_seconds()
+                opens, closes = next(periods)
+            slots.append(opens + timedelta(seconds=offset - consumed))
+        return slots
+
+def parse_window(value, default_tz):
+    """"09:00-21:00" または "09:00-21:00@Asia/Bangkok" を SendWindow にする"""
+    spec, _, tz_name = value.strip().partition("@")
+    start, end = (time.fromisoformat(part.strip()) for part in spec.split("-", 1))
+    return SendWindow(start, end, ZoneInfo(tz_name.strip()) if tz_name else default_tz)
+
+def parse_send_windows(value, default_tz):
+    """"company1=10:00-19:00,company3=08:00-20:00@Asia/Bangkok" 形式の企業ごとの送信時間帯"""
+    windows = {}
+    for item in (value or "").split(","):
+        if "=" in item:
+            bot_id, spec = item.split("=", 1)
+            try:
+                windows[bot_id.strip()] = parse_window(spec, default_tz)
+            except (ValueError, KeyError) as e:
+                print(f"REMINDER_SEND_WINDOWS の値が不正です: {item} ({e})")
+    return windows
+
+default_timezone = ZoneInfo(REMINDER_TIMEZONE)
+default_window = parse_window(REMINDER_SEND_WINDOW, default_timezone)
+tenant_windows = parse_send_windows(REMINDER_SEND_WINDOWS, default_timezone)
+
+def get_send_window(bot_id):
+    return tenant_windows.get(bot_id, default_window)
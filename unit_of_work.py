@@ -0,0 +1,220 @@
+# unit_of_work.py
+import time
+from utils import send_line_message, add_message_log
+from db_models import LogEvent, bump_company_versions
+from rollups import add_exercise_delta, apply_exercise_deltas
+from user_state_cache import user_state_cache, state_from_user
+from metrics import metrics
+from config import REPLY_TOKEN_TTL_SECONDS, REPLY_DEADLINE_MARGIN_SECONDS, REPLY_FALLBACK_PUSH
+
+metrics.describe("reply_path_total", "counter",
+                 "Webhook responses by path (reply, push_fallback, skipped_expired, failed)")
+metrics.describe("reply_event_age_seconds_sum", "counter", "Total age of webhook events when their reply was sent")
+metrics.describe("reply_event_age_seconds_count", "counter", "Replies sent with a known event age")
+
+def reply_deadline(event):
+    """イベントのreply tokenを使える期限（time.time()）。タイムスタンプがなければNone"""
+    timestamp = getattr(event, "timestamp", None)
+    if not timestamp:
+        return None
+    return timestamp / 1000 + REPLY_TOKEN_TTL_SECONDS - REPLY_DEADLINE_MARGIN_SECONDS
+
+class EventUnitOfWork:
+    """
+    Webhookイベント1件分の処理単位
+
+    ユーザー更新・メッセージログ・運動履歴はすべて同じトランザクションに積み、
+    commit() で1回だけコミットする。LINEへの返信はコミット成功後に送信するため、
+    DBが部分的に更新された状態で返信だけが届くことはない。
+    返信の送信ログ（*_SENT）は送信に成功してから記録する（失敗した返信は REPLY_FAILED だけが残る）。
+
+    返信はイベントのタイムスタンプから計算した期限（reply_deadline）までに送る。
+    期限を過ぎた返信は、fallback_push=True のもの（状態が変わったことを伝える返信）は
+    アウトボックス経由のpushに切り替え、それ以外は送らない。
+    """
+
+    def __init__(self, session, api, bot_id):
+        self.session = session
+        self.api = api
+        self.bot_id = bot_id
+        # コミット後に送信する返信 (reply_token, messages, user, fallback_push, sent_event, detail)
+        self.pending_replies = []
+        # reply_token -> (イベントのタイムスタンプ, 返信の期限)
+        self.reply_deadlines = {}
+        # pushに切り替える返信の送り先の企業（handle_eventsで設定）
+        self.company = None
+        # コミット後にすぐ送信するアウトボックスの行（期限切れの返信の代わりのpush）
+        self.fallback_rows = []
+        # 集計テーブルへの加算分
+        self.exercise_deltas = {}
+        # データが変わった企業（コミット時にdata_versionを加算）
+        self.touched_companies = set()
+        # コミット後にユーザー状態キャッシュへ書き込むユーザー
+        self.tracked_users = []
+
+    def log(self, user, message_type, event, detail=None):
+        """メッセージログを追加（コミットはまとめて行う）"""
+        add_message_log(self.session, user, message_type, event, detail)
+
+    def register_events(self, events):
+        """イベントのタイムスタンプと返信の期限を記録する"""
+        for event in events:
+            reply_token = getattr(event, "reply_token", None)
+            if reply_token:
+                self.reply_deadlines[reply_token] = (getattr(event, "timestamp", None), reply_deadline(event))
+
+    def reply_expired(self, reply_token):
+        """reply tokenの期限を過ぎているか（期限が分からない場合はFalse）"""
+        deadline = self.reply_deadlines.get(reply_token, (None, None))[1]
+        return deadline is not None and time.time() > deadline
+
+    def skip_expired(self, reply_token, user):
+        """期限切れのため返信しない（返信のための処理も省く）"""
+        print(f"Reply token expired for bot {self.bot_id}, skipping reply")
+        self.log(user, "error", LogEvent.REPLY_EXPIRED, (reply_token or "")[:10])
+        metrics.inc("reply_path_total", bot_id=self.bot_id, path="skipped_expired")
+
+    def reply(self, reply_token, messages, user, sent_event=None, detail=None, fallback_push=False):
+        """
+        返信を予約する。sent_eventを指定すると、送信に成功した後に送信ログを記録する
+        （pushに切り替えた場合はアウトボックスの行に持たせ、pushが届いたときに記録する）
+        :param fallback_push: 期限切れの場合にpushで送るか（Falseなら送らない）
+        """
+        fallback_push = fallback_push and REPLY_FALLBACK_PUSH and user is not None
+        if not reply_token or self.reply_expired(reply_token):
+            if not fallback_push:
+                self.skip_expired(reply_token, user)
+                return
+            self._queue_push(messages, user, sent_event, detail)
+        else:
+            self.pending_replies.append((reply_token, messages, user, fallback_push, sent_event, detail))
+
+    def _queue_push(self, messages, user, sent_event=None, detail=None):
+        """返信の代わりにpushをアウトボックスに追加する（コミット後にすぐ送信）"""
+        from outbox import enqueue_push
+        row = enqueue_push(self.session, self.company, user, messages, "reply_fallback",
+                           sent_event=sent_event, sent_detail=detail)
+        self.fallback_rows.append(row)
+        metrics.inc("reply_path_total", bot_id=self.bot_id, path="push_fallback")
+
+    def record_exercise(self, history):
+        """運動履歴を集計テーブルへの加算分に積む（コミット時にまとめて反映）"""
+        add_exercise_delta(
+            self.exercise_deltas, history.company_id, history.response_date,
+            history.foot_check_result, history.week_number, history.response_days
+        )
+        self.touch_company(history.company_id)
+
+    def track_users(self, users):
+        """コミット成功後に状態をキャッシュするユーザーを登録する"""
+        self.tracked_users.extend(users)
+
+    def touch_company(self, company_id):
+        """企業のデータが変わったことを記録（レスポンスキャッシュの無効化用）"""
+        self.touched_companies.add(company_id)
+
+    def commit(self):
+        """DB更新を1回でコミットし、成功したら予約済みの返信を送信する"""
+        try:
+            if self.exercise_deltas:
+                apply_exercise_deltas(self.session, self.exercise_deltas)
+            if self.touched_companies:
+                # 企業行のロック時間を短くするため、コミット直前に更新する
+                bump_company_versions(self.session, self.touched_companies)
+            # コミットすると属性が期限切れになるため、flush後（state_version確定後）に状態を取り出しておく
+            states = []
+            if self.tracked_users:
+                self.session.flush()
+                states = [state_from_user(user) for user in self.tracked_users]
+            # 処理中に期限を過ぎた返信のうちpushに切り替えるものは、同じトランザクションでアウトボックスに追加
+            for reply in [r for r in self.pending_replies if r[3] and self.reply_expired(r[0])]:
+                self.pending_replies.remove(reply)
+                self._queue_push(reply[1], reply[2], reply[4], reply[5])
+            fallback_ids = []
+            if self.fallback_rows:
+                self.session.flush()
+                fallback_ids = [row.id for row in self.fallback_rows]
+            self.session.commit()
+        except Exception:
+            self.session.rollback()
+            self.pending_replies = []
+            raise
+        finally:
+            self.exercise_deltas = {}
+            self.touched_companies = set()
+            self.tracked_users = []
+            self.fallback_rows = []
+        user_state_cache.put_many(states)
+        all_sent = self.send_replies()
+        self.dispatch_fallbacks(fallback_ids)
+        return all_sent
+
+    def send_replies(self):
+        """予約済みの返信を送信。成功した分は送信ログを、失敗した分はエラーログを追記する"""
+        replies, self.pending_replies = self.pending_replies, []
+        all_sent = True
+        expired = []
+        logs = []  # (user, message_type, event, detail)
+        for reply_token, messages, user, fallback_push, sent_event, detail in replies:
+            timestamp, deadline = self.reply_deadlines.get(reply_token, (None, None))
+            result = send_line_message(
+                self.api, "reply", reply_token, messages,
+                None, None, self.bot_id, deadline=deadline
+            )
+            if result:
+                metrics.inc("reply_path_total", bot_id=self.bot_id, path="reply")
+                if timestamp:
+                    metrics.inc("reply_event_age_seconds_sum", time.time() - timestamp / 1000, bot_id=self.bot_id)
+                    metrics.inc("reply_event_age_seconds_count", bot_id=self.bot_id)
+                if sent_event is not None:
+                    logs.append((user, "sent", sent_event, detail))
+                continue
+            all_sent = False
+            if fallback_push and result.reply_token_unusable:
+                expired.append((messages, user, sent_event, detail))
+                continue
+            metrics.inc("reply_path_total", bot_id=self.bot_id, path="failed")
+            if user is not None:
+                logs.append((user, "error", LogEvent.REPLY_FAILED, reply_token[:10]))
+        self._add_logs(logs)
+        if expired:
+            self.push_expired_replies(expired)
+        return all_sent
+
+    def _add_logs(self, logs):
+        """返信の送信ログ・エラーログをまとめて記録する（コミット済みなので別のトランザクション）"""
+        if not logs:
+            return
+        try:
+            for user, message_type, event, detail in logs:
+                self.log(user, message_type, event, detail)
+            self.session.commit()
+        except Exception as e:
+            print(f"Failed to log replies for bot {self.bot_id}: {e}")
+            self.session.rollback()
+
+    def push_expired_replies(self, expired):
+        """送信時に期限切れになった返信をpushで送り直す（コミット済みなので別のトランザクション）"""
+        try:
+            for messages, user, sent_event, detail in expired:
+                self._queue_push(messages, user, sent_event, detail)
+            self.session.flush()
+            ids = [row.id for row in self.fallback_rows]
+            self.session.commit()
+        except Exception as e:
+            print(f"Failed to queue fallback push for bot {self.bot_id}: {e}")
+            self.session.rollback()
+            return
+        finally:
+            self.fallback_rows = []
+        self.dispatch_fallbacks(ids)
+
+    def dispatch_fallbacks(self, ids):
+        """返信の代わりのpushをすぐに送信する（失敗した分はディスパッチャーが再送する）"""
+        if not ids:
+            return
+        from outbox import dispatch_now
+        try:
+            dispatch_now(ids)
+        except Exception as e:
+            print(f"Fallback push dispatch failed for bot {self.bot_id}: {e}")
@@ -0,0 +1,127 @@
+# user_state_cache.py
+"""
+Webhook処理用のユーザー状態キャッシュ（ワーカープロセスごと）
+
+キーは (company_id, line_user_id)。値は返信の分岐に必要な項目だけを持つ UserState。
+キャッシュにあるユーザーはSELECTせずに User を組み立ててセッションに載せる（user_from_state）。
+
+- コミットに成功したイベント処理の後、関係したユーザーの状態を書き込む（EventUnitOfWork.commit）
+- users.state_version は SQLAlchemy の version_id_col なので、古い状態のまま更新すると
+  UPDATE ... WHERE state_version = <古い値> が0件になり StaleDataError になる。
+  その場合は該当ユーザーをキャッシュから消し、DBから読み直して処理し直す（handle_events）
+- 更新を伴わない返信（その他のメッセージなど）は古い表示名を使う可能性があるため、
+  USER_STATE_CACHE_TTL_SECONDS で有効期限を設ける
+"""
+import time
+import threading
+from collections import OrderedDict
+from sqlalchemy.orm import make_transient_to_detached
+from db_models import User
+from config import USER_STATE_CACHE_MAX_ENTRIES, USER_STATE_CACHE_TTL_SECONDS
+
+class UserState:
+    """キャッシュする1ユーザー分の状態"""
+    __slots__ = ("id", "company_id", "line_user_id", "username", "foot_check_result",
+                 "current_week", "question_sent", "active", "state_version", "cached_at")
+
+    def __init__(self, id, company_id, line_user_id, username, foot_check_result,
+                 current_week, question_sent, active, state_version, cached_at=None):
+        self.id = id
+        self.company_id = company_id
+        self.line_user_id = line_user_id
+        self.username = username
+        self.foot_check_result = foot_check_result
+        self.current_week = current_week
+        self.question_sent = question_sent
+        self.active = active
+        self.state_version = state_version
+        self.cached_at = cached_at
+
+def state_from_user(user):
+    """読み込み済みの User から UserState を作る（属性は読み込み済みであること）"""
+    return UserState(
+        user.id, user.company_id, user.line_user_id, user.username, user.foot_check_result,
+        user.current_week, user.question_sent, user.active, user.state_version
+    )
+
+def user_from_state(session, state):
+    """
+    UserState から User を組み立て、SELECTせずにセッションに載せる
+
+    キャッシュしていない列（program_sent_date など）は未読み込み扱いになり、
+    参照した場合だけDBから読み込まれる。代入して更新する分には読み込みは発生しない。
+    """
+    user = User(
+        id=state.id, company_id=state.company_id, line_user_id=state.line_user_id,
+        username=state.username, foot_check_result=state.foot_check_result,
+        current_week=state.current_week, question_sent=state.question_sent,
+        active=state.active, state_version=state.state_version
+    )
+    make_transient_to_detached(user)
+    session.add(user)
+    return user
+
+class UserStateCache:
+    """件数と有効期限に上限のあるLRUキャッシュ"""
+
+    def __init__(self, max_entries, ttl_seconds, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.clock = clock
+        self.entries = OrderedDict()  # (company_id, line_user_id) -> UserState
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "stale": 0, "evictions": 0}
+
+    def get_many(self, company_id, line_user_ids):
+        """キャッシュにあるユーザーの状態を {line_user_id: UserState} で返す"""
+        found = {}
+        now = self.clock()
+        with self.lock:
+            for line_user_id in line_user_ids:
+                key = (company_id, line_user_id)
+                state = self.entries.get(key)
+                if state is not None and now - state.cached_at > self.ttl_seconds:
+                    del self.entries[key]
+                    self.stats["expired"] += 1
+                    state = None
+                if state is None:
+                    self.stats["misses"] += 1
+                    continue
+                self.entries.move_to_end(key)
+                self.stats["hits"] += 1
+                found[line_user_id] = state
+        return found
+
+    def put_many(self, states):
+        """状態を保存する（キャッシュ済みのものより古いバージョンは無視する）"""
+        now = self.clock()
+        with self.lock:
+            for state in states:
+                key = (state.company_id, state.line_user_id)
+                current = self.entries.get(key)
+                if current is not None and current.state_version > state.state_version:
+                    continue
+                state.cached_at = now
+                self.entries[key] = state
+                self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def invalidate(self, company_id, line_user_ids, stale=False):
+        """ユーザーの状態を削除する（stale=True は他のワーカーの更新を検知した場合）"""
+        with self.lock:
+            for line_user_id in line_user_ids:
+                if self.entries.pop((company_id, line_user_id), None) is not None and stale:
+                    self.stats["stale"] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def snapshot(self):
+        """/health 用の統計"""
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries))
+
+user_state_cache = UserStateCache(USER_STATE_CACHE_MAX_ENTRIES, USER_STATE_CACHE_TTL_SECONDS)
@@ -1,16 +1,32 @@
 # utils.py
 import time
-from requests.exceptions import RequestException, ConnectionError, Timeout
-from urllib3.exceptions import ProtocolError, HTTPError
-import socket
 from linebot.v3.messaging import ReplyMessageRequest, PushMessageRequest
 from sqlalchemy.exc import SQLAlchemyError
-from db_models import MessageLog
+from db_models import MessageLog, LogEvent
+from config import LINE_HTTP_TIMEOUT
+from circuit_breaker import get_breaker, is_breaker_failure
+from line_errors import (classify_error, SendResult, REASON_TOKEN_REUSED, REASON_CIRCUIT_OPEN,
+                         REASON_DEADLINE_EXCEEDED)
+from metrics import metrics
 
 # bot_idごとに別々のreply_token記録を保持する辞書
 used_reply_tokens = {}
 
-def send_line_message(api, message_type, identifier, messages, user=None, session=None, bot_id=None):
+metrics.describe("line_send_errors_total", "counter", "Failed LINE send attempts by operation, error class and reason")
+metrics.describe("line_send_retries_total", "counter", "LINE send attempts retried after a transient error")
+metrics.describe("line_send_retry_sleep_seconds_total", "counter", "Seconds slept before retrying a LINE send")
+metrics.describe("line_send_retries_avoided_total", "counter", "Retries not made because the error was permanent")
+metrics.describe("line_send_retry_seconds_avoided_total", "counter", "Backoff seconds not slept because the error was permanent")
+
+# 送信の最大試行回数とバックオフ（2秒, 4秒, ...）
+SEND_MAX_ATTEMPTS = 3
+SEND_BACKOFF_FACTOR = 2
+
+def avoided_backoff_seconds(attempt, max_attempts=SEND_MAX_ATTEMPTS, backoff_factor=SEND_BACKOFF_FACTOR):
+    """attempt 回目で打ち切った場合に、全エラーをリトライしていたら待っていた残りの秒数"""
+    return sum(backoff_factor ** n for n in range(attempt, max_attempts))
+
+def send_line_message(api, message_type, identifier, messages, user=None, session=None, bot_id=None, deadline=None):
     """
     LINE APIへのメッセージ送信関数（汎用）
     :param api: MessagingApiオブジェクト
@@ -20,7 +36,12 @@ def send_line_message(api, message_type, identifier, messages, user=None, sessio
     :param user: Userオブジェクト（オプション）
     :param session: DBセッション（オプション）
     :param bot_id: Bot識別子（オプション）
-    :return: 成功したかどうかを示すブール値
+    :param deadline: この時刻（time.time()）を過ぎたら送信・リトライしない（replyの有効期限、オプション）
+    :return: SendResult（真偽値としては成功したかどうか）
+    失敗は line_errors.classify_error で分類し、ネットワークエラー・5xx・429（Retry-Afterを尊重）だけをリトライする。
+    無効なreply token・401/403・友だちでないなど、送り直しても成功しないエラーはすぐに打ち切る。
+    bot_idを指定した場合はbot_id×message_typeのサーキットブレーカーを通し、
+    openの間はリトライせずに即座に失敗を返す（pushは question_sent が立たないため次回の実行で再送される）。
     """
     global used_reply_tokens
     
@@ -36,8 +57,8 @@ def send_line_message(api, message_type, identifier, messages, user=None, sessio
         if identifier in used_reply_tokens[bot_id]:
             print(f"WARNING: Attempt to reuse reply_token for bot {bot_id}: {token_preview}")
             if user and session:
-                log_message(session, user, "error", f"Reply token reuse detected for bot {bot_id}: {token_preview}")
-            return False
+                log_message(session, user, "error", LogEvent.REPLY_TOKEN_REUSED, token_preview)
+            return SendResult.skipped(REASON_TOKEN_REUSED)
         
         # 有効なトークンを記録
         used_reply_tokens[bot_id].add(identifier)
@@ -47,15 +68,27 @@ def send_line_message(api, message_type, identifier, messages, user=None, sessio
         if len(used_reply_tokens[bot_id]) > 500:
             used_reply_tokens[bot_id] = set(list(used_reply_tokens[bot_id])[-250:])
     
-    max_retries = 3
-    retry_count = 0
-    backoff_factor = 2  # 指数バックオフの基数
+    breaker = get_breaker(bot_id, message_type) if bot_id else None
+    botid_info = f" for bot {bot_id}" if bot_id else ""
+    attempt = 0
     
-    while retry_count < max_retries:
+    while True:
+        # 期限を過ぎたreply tokenは送っても無効なので打ち切る
+        if deadline is not None and time.time() > deadline:
+            print(f"Reply deadline exceeded{botid_info}, skipping {message_type}")
+            return SendResult.skipped(REASON_DEADLINE_EXCEEDED, attempt)
+        
+        # LINE側の障害中はリトライで待たずに打ち切る
+        if breaker and not breaker.allow():
+            print(f"Circuit open for {message_type}{botid_info}, skipping send")
+            if user and session:
+                log_message(session, user, "error", LogEvent.CIRCUIT_OPEN, message_type)
+            return SendResult.skipped(REASON_CIRCUIT_OPEN, attempt)
+        
+        attempt += 1
         try:
             # リクエストの詳細をログに記録
             msg_preview = str([m.type if hasattr(m, 'type') else 'unknown' for m in messages])
-            botid_info = f" for bot {bot_id}" if bot_id else ""
             print(f"Attempting to send {message_type} message{botid_info}: {msg_preview}")
             
             if message_type == "reply":
@@ -63,85 +96,98 @@ def send_line_message(api, message_type, identifier, messages, user=None, sessio
                     ReplyMessageRequest(
                         reply_token=identifier,
                         messages=messages
-                    )
+                    ),
+                    _request_timeout=LINE_HTTP_TIMEOUT
                 )
+                if breaker:
+                    breaker.record_success()
                 if user and session:
-                    message_content = f"Reply送信成功{botid_info}: {[m.text if hasattr(m, 'text') else m.type for m in messages]}"
-                    log_message(session, user, "sent", message_content)
-                print(f"Successfully sent reply message{botid_info} with token: {token_preview}")
+                    log_message(session, user, "sent", LogEvent.REPLY_SENT, msg_preview)
+                print(f"Successfully sent reply message{botid_info} with token: {identifier[:10]}...")
             else:  # push
                 api.push_message(
                     PushMessageRequest(
                         to=identifier,
                         messages=messages
-                    )
+                    ),
+                    _request_timeout=LINE_HTTP_TIMEOUT
                 )
+                if breaker:
+                    breaker.record_success()
                 if user and session:
-                    log_message(session, user, "sent", f"Push送信成功{botid_info}")
+                    log_message(session, user, "sent", LogEvent.PUSH_SENT, msg_preview)
                 print(f"Successfully sent push message{botid_info} to user: {identifier[:8]}...")
             
-            return True
-            
-        except (RequestException, ConnectionError, Timeout, ProtocolError, HTTPError, socket.error) as e:
-            retry_count += 1
-            wait_time = backoff_factor ** retry_count
-            
-            botid_info = f" for bot {bot_id}" if bot_id else ""
-            error_message = f"Network error in {message_type} attempt {retry_count}{botid_info}: {e} - Retrying in {wait_time}s"
-            print(error_message)
-            
-            if user and session:
-                log_message(session, user, "error", error_message)
-            
-            if retry_count == max_retries:
-                print(f"Failed to send {message_type}{botid_info} after {max_retries} attempts")
-                return False
-            else:
-                time.sleep(wait_time)
+            return SendResult.sent(attempt)
         
         except Exception as e:
-            retry_count += 1
-            wait_time = backoff_factor ** retry_count
+            error_class = classify_error(e)
+            if breaker:
+                # ネットワークエラー・5xx・429・401/403は失敗、個別のリクエストの問題（その他の4xx）はAPI自体は正常とみなす
+                if error_class.status is None or is_breaker_failure(e):
+                    breaker.record_failure(e)
+                else:
+                    breaker.record_success()
+            metrics.inc("line_send_errors_total", operation=message_type, kind=error_class.kind, reason=error_class.reason)
             
-            # 詳細なエラー情報をログに記録
-            error_detail = str(e)
+            # 詳細なエラー情報をログに記録（ApiExceptionはステータスと本文も）
+            error_detail = str(e).strip().splitlines()[0] if str(e).strip() else type(e).__name__
             response_info = ""
-            
-            # ApiExceptionからより詳細な情報を取得
-            if hasattr(e, 'body') and hasattr(e, 'headers'):
-                try:
-                    error_body = e.body if isinstance(e.body, str) else str(e.body)
-                    headers_info = str(e.headers) if hasattr(e, 'headers') else "No headers"
-                    status_code = str(e.status) if hasattr(e, 'status') else "Unknown status"
-                    response_info = f"\nStatus: {status_code}\nHeaders: {headers_info}\nBody: {error_body}"
-                except:
-                    response_info = "\nCould not extract response details"
-            
-            botid_info = f" for bot {bot_id}" if bot_id else ""
-            error_message = f"Unexpected error in {message_type} attempt {retry_count}{botid_info}: {error_detail}{response_info} - Retrying in {wait_time}s"
-            print(error_message)
-            
+            if error_class.status is not None:
+                response_info = f"\nStatus: {error_class.status}\nBody: {getattr(e, 'body', '')}"
+            print(f"{error_class.kind} error ({error_class.reason}) in {message_type} attempt {attempt}{botid_info}: "
+                  f"{error_detail}{response_info}")
             if user and session:
-                log_message(session, user, "error", f"API error{botid_info}: {error_detail}")
+                event = LogEvent.SEND_NETWORK_ERROR if error_class.status is None else LogEvent.SEND_API_ERROR
+                log_message(session, user, "error", event, f"{message_type} attempt {attempt}: {error_class.reason}")
             
-            if retry_count == max_retries:
-                print(f"Failed to send {message_type}{botid_info} after {max_retries} attempts due to: {error_detail}")
-                return False
-            else:
-                time.sleep(wait_time)
-    
-    return False
+            if not error_class.retryable:
+                # 送り直しても成功しないので打ち切る（以前は全エラーをリトライしていた分の呼び出しと待ち時間を数える）
+                if attempt < SEND_MAX_ATTEMPTS:
+                    metrics.inc("line_send_retries_avoided_total", SEND_MAX_ATTEMPTS - attempt,
+                                operation=message_type, reason=error_class.reason)
+                    metrics.inc("line_send_retry_seconds_avoided_total", avoided_backoff_seconds(attempt),
+                                operation=message_type, reason=error_class.reason)
+                print(f"Not retrying {message_type}{botid_info}: {error_class.reason}")
+                return SendResult.failed(error_class, attempt, e)
+            if attempt >= SEND_MAX_ATTEMPTS:
+                print(f"Failed to send {message_type}{botid_info} after {attempt} attempts due to: {error_detail}")
+                return SendResult.failed(error_class, attempt, e)
+            
+            wait_time = SEND_BACKOFF_FACTOR ** attempt
+            if error_class.retry_after:
+                wait_time = max(wait_time, error_class.retry_after)
+            if deadline is not None and time.time() + wait_time > deadline:
+                # 待っている間にreply tokenの期限が切れる
+                print(f"Reply deadline would pass while waiting {wait_time}s{botid_info}, giving up {message_type}")
+                return SendResult.skipped(REASON_DEADLINE_EXCEEDED, attempt)
+            print(f"Retrying {message_type}{botid_info} in {wait_time}s")
+            metrics.inc("line_send_retries_total", operation=message_type, reason=error_class.reason)
+            metrics.inc("line_send_retry_sleep_seconds_total", wait_time, operation=message_type, reason=error_class.reason)
+            time.sleep(wait_time)
+
+def add_message_log(session, user, message_type, event, detail=None, user_id=None):
+    """
+    メッセージログをセッションに追加する（コミットは呼び出し側で行う）
+    :param message_type: "received" / "sent" / "system" / "error"
+    :param event: LogEvent のイベントコード
+    :param detail: 補足情報（255文字で切り詰める）
+    :param user_id: Userを読み込んでいない場合はIDで指定する
+    """
+    owner = {"user": user} if user is not None else {"user_id": user_id}
+    log = MessageLog(
+        message_type=message_type,
+        event_code=int(event),
+        detail=str(detail)[:255] if detail is not None else None,
+        **owner
+    )
+    session.add(log)
+    return log
 
-# ログ記録関数
-def log_message(session, user, message_type, content):
+def log_message(session, user, message_type, event, detail=None):
     """メッセージログを記録する関数"""
     try:
-        log = MessageLog(
-            user_id=user.id,
-            message_type=message_type,
-            message_content=content
-        )
-        session.add(log)
+        add_message_log(session, user, message_type, event, detail)
         session.commit()
     except SQLAlchemyError as e:
         print(f"Failed to log message: {e}")
@@ -156,7 +202,7 @@ def log_error(context, error, user=None, session=None):
     error_message = f"Error in {context}: {error}"
     print(error_message)
     if user and session:
-        log_message(session, user, "error", error_message)
+        log_message(session, user, "error", LogEvent.HANDLER_ERROR, f"{context}: {error}")
     if session:
         session.rollback()
 
@@ -231,3 +277,28 @@ def create_exercise_video_flex_message(video_url, thumbnail_url):
         alt_text="今週の運動メニュー",
         contents=FlexContainer.from_dict(flex_content)
     )
+
+# リマインダーメッセージ生成関数
+def build_reminder_message(user, company):
+    """
+    運動回数を尋ねる週次リマインダー（クイックリプライ付き）を生成する
+    
+    Args:
+        user: 送信先のUser
+        company: ユーザーの所属企業
+    
+    Returns:
+        TextMessage
+    """
+    from linebot.v3.messaging import TextMessage, QuickReply, QuickReplyItem, MessageAction
+    
+    quick_reply = QuickReply(
+        items=[
+            QuickReplyItem(action=MessageAction(label="0回", text="0回")),
+            QuickReplyItem(action=MessageAction(label="1~3回", text="1~3回")),
+            QuickReplyItem(action=MessageAction(label="4~7回", text="4~7回"))
+        ]
+    )
+    
+    message_text = f"{user.username}さん、{company.name}の足健康プログラムからお知らせです。この1週間で運動は何回できましたか？0〜7回でご回答ください。"
+    return TextMessage(text=message_text, quick_reply=quick_reply)
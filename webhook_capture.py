@@ -0,0 +1,185 @@
+# webhook_capture.py
+"""
+Webhookの記録（本番の性能問題をローカルで再現するため）
+
+WEBHOOK_CAPTURE_BOTS に指定した企業のWebhookを、受信時刻・ヘッダー・本文と処理結果（ステータス・所要時間）ごと
+gzip圧縮したJSON Lines（1行1リクエスト）に追記する。再生は webhook_replay.py で行う。
+
+- ファイルは WEBHOOK_CAPTURE_DIR/<bot_id>/webhooks-<開始時刻>.jsonl.gz。
+  圧縮前で WEBHOOK_CAPTURE_ROTATE_MB を超えたら次のファイルに切り替え、
+  企業ごとに WEBHOOK_CAPTURE_MAX_FILES を超えた古いファイルは削除する
+- 1件ごとに圧縮ストリームをフラッシュするので、プロセスが落ちても書き込み済みの行は読める
+- WEBHOOK_CAPTURE_PSEUDONYMIZE が true なら、ユーザー・グループ・トークルームのIDを
+  WEBHOOK_CAPTURE_SALT を鍵にしたHMACの仮名（元と同じ形式の先頭1文字＋32桁）に置き換える。
+  同じユーザーは同じ仮名になるので、再生してもユーザーごとの状態の変化は変わらない（メッセージの本文はそのまま）
+- 署名（X-Line-Signature）は保存しない（本文を書き換えるため。再生時に署名し直す）
+- 記録に失敗してもWebhookの処理は続ける
+"""
+import os
+import re
+import gzip
+import hmac
+import json
+import atexit
+import hashlib
+import secrets
+import threading
+from datetime import datetime
+from config import (WEBHOOK_CAPTURE_BOTS, WEBHOOK_CAPTURE_DIR, WEBHOOK_CAPTURE_PSEUDONYMIZE, WEBHOOK_CAPTURE_SALT,
+                    WEBHOOK_CAPTURE_ROTATE_MB, WEBHOOK_CAPTURE_MAX_FILES)
+
+# 保存するヘッダー（署名は保存しない）
+CAPTURED_HEADERS = ("Content-Type", "User-Agent", "X-Line-Retry-Key")
+# 仮名にするID
+ID_KEYS = ("userId", "groupId", "roomId")
+CAPTURE_FILE_PATTERN = re.compile(r"^webhooks-\d{8}T\d{12}\.jsonl\.gz$")
+
+capture_bots = {bot_id.strip() for bot_id in WEBHOOK_CAPTURE_BOTS.split(",") if bot_id.strip()}
+# 鍵がなければ起動ごとにランダム（同じ記録ファイルの中では同じユーザーは同じ仮名になる）
+capture_salt = (WEBHOOK_CAPTURE_SALT or secrets.token_hex(16)).encode()
+
+def capture_enabled(bot_id):
+    return "*" in capture_bots or bot_id in capture_bots
+
+def pseudonymize_id(value, salt=None):
+    """LINEのID（U/C/R＋32桁の16進数）を同じ形式の仮名にする"""
+    digest = hmac.new(salt or capture_salt, value.encode(), hashlib.sha256).hexdigest()[:32]
+    prefix = value[0] if value[:1] in ("U", "C", "R") else "U"
+    return prefix + digest
+
+def _pseudonymize(value, salt):
+    if isinstance(value, dict):
+        return {
+            key: pseudonymize_id(item, salt) if key in ID_KEYS and isinstance(item, str) else _pseudonymize(item, salt)
+            for key, item in value.items()
+        }
+    if isinstance(value, list):
+        return [_pseudonymize(item, salt) for item in value]
+    return value
+
+def pseudonymize_body(body, salt=None):
+    """Webhookの本文のユーザー・グループ・トークルームのIDを仮名にする（JSONでなければそのまま）"""
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return body
+    return json.dumps(_pseudonymize(payload, salt or capture_salt), ensure_ascii=False, separators=(",", ":"))
+
+class CaptureWriter:
+    """1つの企業の記録ファイル（サイズで切り替え、古いファイルを削除）"""
+
+    def __init__(self, directory, rotate_bytes, max_files):
+        self.directory = directory
+        self.rotate_bytes = rotate_bytes
+        self.max_files = max_files
+        self.lock = threading.Lock()
+        self.file = None
+        self.path = None
+        self.written = 0
+        self.records = 0
+
+    def _rotate(self):
+        if self.file is not None:
+            self.file.close()
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"webhooks-{datetime.utcnow():%Y%m%dT%H%M%S%f}.jsonl.gz")
+        self.file = gzip.open(self.path, "ab")
+        self.written = 0
+        files = sorted(name for name in os.listdir(self.directory) if CAPTURE_FILE_PATTERN.match(name))
+        for name in files[:max(len(files) - self.max_files, 0)]:
+            os.remove(os.path.join(self.directory, name))
+            print(f"Removed old webhook capture: {name}")
+
+    def write(self, record):
+        line = (json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n").encode("utf-8")
+        with self.lock:
+            if self.file is None or self.written >= self.rotate_bytes:
+                self._rotate()
+            self.file.write(line)
+            self.file.flush()  # 書き込み済みの行は途中で落ちても読めるようにする
+            self.written += len(line)
+            self.records += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    def snapshot(self):
+        with self.lock:
+            return {"file": self.path, "bytes": self.written, "records": self.records}
+
+# bot_id -> CaptureWriter
+capture_writers = {}
+capture_writers_lock = threading.Lock()
+
+def get_capture_writer(bot_id):
+    with capture_writers_lock:
+        writer = capture_writers.get(bot_id)
+        if writer is None:
+            writer = CaptureWriter(os.path.join(WEBHOOK_CAPTURE_DIR, bot_id),
+                                   int(WEBHOOK_CAPTURE_ROTATE_MB * 1024 * 1024), WEBHOOK_CAPTURE_MAX_FILES)
+            capture_writers[bot_id] = writer
+        return writer
+
+def capture_webhook(bot_id, body, headers, received_at, status, duration):
+    """
+    1件のWebhookを記録する（記録しない企業なら何もしない）
+    :param received_at: 受信時刻（UNIX時間）
+    :param status: 返したHTTPステータス
+    :param duration: 処理にかかった秒数
+    """
+    if not capture_enabled(bot_id):
+        return
+    try:
+        get_capture_writer(bot_id).write({
+            "bot_id": bot_id,
+            "received_at": round(received_at, 6),
+            "status": status,
+            "duration_ms": round(duration * 1000, 2),
+            "headers": {name: headers[name] for name in CAPTURED_HEADERS if headers.get(name)},
+            "pseudonymized": WEBHOOK_CAPTURE_PSEUDONYMIZE,
+            "body": pseudonymize_body(body) if WEBHOOK_CAPTURE_PSEUDONYMIZE else body,
+        })
+    except Exception as e:
+        print(f"Webhook capture failed for {bot_id}: {e}")
+
+def capture_files(paths):
+    """ファイルとディレクトリ（その下の記録ファイル）のリストを、記録ファイルのパスのリスト（古い順）にする"""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, names in os.walk(path):
+                files.extend(os.path.join(root, name) for name in names if CAPTURE_FILE_PATTERN.match(name))
+        else:
+            files.append(path)
+    return sorted(files, key=os.path.basename)
+
+def read_captures(paths):
+    """記録を受信時刻の順に返す（書き込み中・途中で落ちたファイルの末尾の不完全な行は飛ばす）"""
+    records = []
+    for path in capture_files(paths):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            try:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        break
+            except EOFError:
+                pass  # 閉じていないファイル（フラッシュ済みの行までは読める）
+    return sorted(records, key=lambda record: record["received_at"])
+
+def capture_snapshot():
+    """/health 用：記録中の企業とファイル"""
+    with capture_writers_lock:
+        writers = dict(capture_writers)
+    return {"bots": sorted(capture_bots), "writers": {bot_id: w.snapshot() for bot_id, w in writers.items()}}
+
+@atexit.register
+def close_captures():
+    with capture_writers_lock:
+        writers = list(capture_writers.values())
+    for writer in writers:
+        writer.close()
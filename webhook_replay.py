@@ -0,0 +1,188 @@
+# webhook_replay.py
+"""
+記録したWebhook（webhook_capture.py）をローカルのインスタンスに再生する
+
+記録した本文をテスト用の企業のチャネルシークレットで署名し直し、/callback/<bot_id> に送る。
+間隔は記録どおり（--speed 1）、--speed 倍に速めて、または待たずに（--speed 0）送る。
+1件ずつ順に送り、各リクエストの応答時間と、その間に増えた /metrics の db_statements_total（SQLの数）・
+line_api_calls_total（LINE APIの呼び出し数）を記録する（再生先は他の処理をしていない1プロセスのインスタンスにする）。
+
+- イベントのタイムスタンプは、受信時と同じ経過時間になるよう再生時刻に合わせてずらす（reply tokenの期限の判定が変わらない）
+- reply token は使用済みにならないよう新しい値にする（--keep-reply-tokens で元の値のまま）
+- 前のリクエストの処理が終わらず予定時刻を過ぎた場合は、遅れ（lag_ms）として記録する
+
+    python webhook_replay.py capture/webhooks/company3 --target http://127.0.0.1:5000 --bot-id company1 --speed 10
+    python webhook_replay.py capture/webhooks/company3/webhooks-20251020T000000000000.jsonl.gz --speed 0 --report replay.jsonl
+"""
+import re
+import hmac
+import json
+import time
+import uuid
+import base64
+import hashlib
+import argparse
+import requests
+import numpy as np
+from webhook_capture import read_captures
+
+METRIC_LINE = re.compile(r'^(\w+)(?:\{(.*)\})? ([-+\d.eE]+|NaN)$')
+LABEL = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+def sign_body(body, channel_secret):
+    return base64.b64encode(hmac.new(channel_secret.encode(), body.encode(), hashlib.sha256).digest()).decode()
+
+def prepare_body(body, received_at, now, fresh_reply_tokens=True):
+    """タイムスタンプを再生時刻に合わせ、reply token を新しくした本文を返す"""
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return body, []
+    shift_ms = int((now - received_at) * 1000)
+    types = []
+    for event in payload.get("events", []):
+        types.append(event.get("type"))
+        if isinstance(event.get("timestamp"), int):
+            event["timestamp"] += shift_ms
+        if fresh_reply_tokens and event.get("replyToken"):
+            event["replyToken"] = uuid.uuid4().hex
+    return json.dumps(payload, ensure_ascii=False, separators=(",", ":")), types
+
+def read_counters(session, target):
+    """再生先の /metrics から、SQLの数とLINE APIの呼び出し数（操作ごと）を読む"""
+    counts = {"db_statements": 0.0, "line_calls": {}}
+    for line in session.get(f"{target}/metrics", timeout=10).text.splitlines():
+        match = METRIC_LINE.match(line)
+        if not match:
+            continue
+        name, labels, value = match.group(1), dict(LABEL.findall(match.group(2) or "")), float(match.group(3))
+        if name == "db_statements_total":
+            counts["db_statements"] += value
+        elif name == "line_api_calls_total" and labels.get("outcome") != "rejected":
+            operation = labels.get("operation", "")
+            counts["line_calls"][operation] = counts["line_calls"].get(operation, 0) + value
+    return counts
+
+def counter_delta(before, after):
+    return {
+        "db_statements": int(after["db_statements"] - before["db_statements"]),
+        "line_calls": {op: int(n - before["line_calls"].get(op, 0))
+                       for op, n in after["line_calls"].items() if n - before["line_calls"].get(op, 0)},
+    }
+
+def replay(records, target, bot_id, channel_secret, speed=1.0, fresh_reply_tokens=True, count_calls=True,
+           sleep=time.sleep, clock=time.time):
+    """
+    記録を順に再生し、1件ごとの結果のリストを返す
+    :param speed: 再生速度（1なら記録どおりの間隔、0なら待たずに送る）
+    """
+    session = requests.Session()
+    results = []
+    if not records:
+        return results
+    started = clock()
+    first = records[0]["received_at"]
+    counters = read_counters(session, target) if count_calls else None
+    for index, record in enumerate(records):
+        due = started + (record["received_at"] - first) / speed if speed else clock()
+        wait = due - clock()
+        if wait > 0:
+            sleep(wait)
+        sent_at = clock()
+        body, types = prepare_body(record["body"], record["received_at"], sent_at, fresh_reply_tokens)
+        headers = {"Content-Type": "application/json", "X-Line-Signature": sign_body(body, channel_secret)}
+        try:
+            response = session.post(f"{target}/callback/{bot_id}", data=body.encode("utf-8"), headers=headers, timeout=60)
+            status = response.status_code
+        except requests.RequestException as e:
+            status = None
+            print(f"Replay request {index} failed: {e}")
+        latency = clock() - sent_at
+        result = {
+            "index": index,
+            "received_at": record["received_at"],
+            "events": types,
+            "status": status,
+            "latency_ms": round(latency * 1000, 2),
+            "lag_ms": round(max(sent_at - due, 0) * 1000, 2),
+            "original_status": record.get("status"),
+            "original_ms": record.get("duration_ms"),
+        }
+        if count_calls:
+            after = read_counters(session, target)
+            result.update(counter_delta(counters, after))
+            counters = after
+        results.append(result)
+    return results
+
+def summarize(results, elapsed):
+    """再生結果の集計（応答時間のパーセンタイル、ステータスごとの件数、SQL・LINE APIの呼び出し数）"""
+    latency = np.array([r["latency_ms"] for r in results])
+    original = np.array([r["original_ms"] for r in results if r.get("original_ms") is not None])
+    statuses = {}
+    line_calls = {}
+    for r in results:
+        statuses[str(r["status"])] = statuses.get(str(r["status"]), 0) + 1
+        for op, n in r.get("line_calls", {}).items():
+            line_calls[op] = line_calls.get(op, 0) + n
+
+    def percentiles(values):
+        if not len(values):
+            return None
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        return {"p50": round(p50, 2), "p95": round(p95, 2), "p99": round(p99, 2), "max": round(float(values.max()), 2)}
+
+    db = [r["db_statements"] for r in results if "db_statements" in r]
+    return {
+        "requests": len(results),
+        "events": sum(len(r["events"]) for r in results),
+        "elapsed_seconds": round(elapsed, 2),
+        "statuses": statuses,
+        "status_changed": sum(1 for r in results if r["original_status"] is not None and r["status"] != r["original_status"]),
+        "latency_ms": percentiles(latency),
+        "original_latency_ms": percentiles(original),
+        "max_lag_ms": max((r["lag_ms"] for r in results), default=0),
+        "db_statements": {"total": sum(db), "per_request": round(sum(db) / len(db), 2)} if db else None,
+        "line_calls": line_calls,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="記録したWebhookをローカルのインスタンスに再生する")
+    parser.add_argument("paths", nargs="+", help="記録ファイル、または記録ファイルのあるディレクトリ")
+    parser.add_argument("--target", default="http://127.0.0.1:5000", help="再生先のURL")
+    parser.add_argument("--bot-id", help="再生先の企業のbot_id（省略時は記録した企業）")
+    parser.add_argument("--channel-secret", help="署名に使うチャネルシークレット（省略時は BOT_CONFIGS の値）")
+    parser.add_argument("--speed", type=float, default=1.0, help="再生速度（1なら記録どおり、0なら待たずに送る）")
+    parser.add_argument("--limit", type=int, help="再生する件数")
+    parser.add_argument("--keep-reply-tokens", action="store_true", help="reply tokenを記録した値のまま送る")
+    parser.add_argument("--no-metrics", action="store_true", help="/metrics からSQL・LINE APIの呼び出し数を数えない")
+    parser.add_argument("--report", help="1件ごとの結果を書き出すJSON Linesファイル")
+    args = parser.parse_args()
+
+    records = read_captures(args.paths)[:args.limit]
+    if not records:
+        print("No captured webhooks found")
+        return
+    bot_id = args.bot_id or records[0]["bot_id"]
+    channel_secret = args.channel_secret
+    if not channel_secret:
+        from config import BOT_CONFIGS
+        channel_secret = BOT_CONFIGS.get(bot_id, {}).get("channel_secret")
+    if not channel_secret:
+        print(f"Channel secret for {bot_id} is not configured (use --channel-secret)")
+        return
+
+    print(f"Replaying {len(records)} webhook(s) to {args.target}/callback/{bot_id} at speed {args.speed or 'max'}")
+    started = time.time()
+    results = replay(records, args.target.rstrip("/"), bot_id, channel_secret, args.speed,
+                     not args.keep_reply_tokens, not args.no_metrics)
+    summary = summarize(results, time.time() - started)
+    if args.report:
+        with open(args.report, "w", encoding="utf-8") as f:
+            for result in results:
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        print(f"Wrote {len(results)} result(s) to {args.report}")
+    print(json.dumps(summary, ensure_ascii=False, indent=2))
+
+if __name__ == "__main__":
+    main()